@@ -0,0 +1,101 @@
+import time
+import metrics
+
+# Admission control in front of the message handlers. A global token bucket limits how fast new
+# connections are accepted; every connection gets token buckets for handshake frames (usernames,
+# resumes), chat lines and :: commands; frames longer than max_frame_size are rejected. What happens
+# to a frame over its limit is the policy's action:
+#   drop       - ignore the frame
+#   delay      - hold the connection until the bucket has a token again, then handle the frame
+#   warn       - ignore the frame and tell the client with a validation_error
+#   disconnect - close the connection
+# Buckets live on the client once it registered, so reconnecting and resuming doesn't refill them.
+
+ACTIONS = ('drop', 'delay', 'warn', 'disconnect')
+
+
+class TokenBucket():
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, now):
+        # 0 when a token was taken, else the seconds until one is available
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Policy():
+    # rate per second with bursts of up to burst frames; rate None means unlimited
+    def __init__(self, rate, burst=None, action='drop'):
+        if action not in ACTIONS:
+            raise ValueError('Unknown admission action {}, expected one of {}'.format(action, ', '.join(ACTIONS)))
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self.action = action
+
+    def bucket(self, now):
+        if not self.rate:
+            return None
+        return TokenBucket(self.rate, self.burst, now)
+
+
+class ConnectionLimits():
+    __slots__ = ('handshake', 'chat', 'command')
+
+    def __init__(self, handshake, chat, command):
+        self.handshake = handshake
+        self.chat = chat
+        self.command = command
+
+
+class AdmissionControl():
+    def __init__(self, connection_rate=200, connection_burst=500, handshake=None, chat=None, command=None,
+                 max_frame_size=4096, frame_action='warn'):
+        self.connections = TokenBucket(connection_rate, connection_burst) if connection_rate else None
+        self.policies = {
+            'handshake': handshake or Policy(2, 5, 'delay'),
+            'chat': chat or Policy(5, 10, 'warn'),
+            'command': command or Policy(10, 20, 'delay'),
+        }
+        if frame_action not in ACTIONS or frame_action == 'delay':
+            raise ValueError('Frame size action should be drop, warn or disconnect')
+        self.max_frame_size = max_frame_size
+        self.frame_action = frame_action
+        self.limited = metrics.Counter('skeleton_admission_limited_total', 'Connections and frames over an admission limit', ['kind', 'action'])
+
+    def admit_connection(self):
+        if self.connections is None or not self.connections.take(time.monotonic()):
+            return True
+        self.limited.inc(('connection', 'refuse'))
+        return False
+
+    def connection(self):
+        now = time.monotonic()
+        policies = self.policies
+        return ConnectionLimits(policies['handshake'].bucket(now), policies['chat'].bucket(now), policies['command'].bucket(now))
+
+    def check(self, limits, kind, text):
+        # None if the frame may be handled now, else (action, seconds until the bucket has a token)
+        if self.max_frame_size and len(text) > self.max_frame_size:
+            self.limited.inc(('frame_size', self.frame_action))
+            return self.frame_action, 0
+        bucket = getattr(limits, kind)
+        if bucket is None:
+            return None
+        wait = bucket.take(time.monotonic())
+        if not wait:
+            return None
+        action = self.policies[kind].action
+        if action == 'delay':
+            bucket.tokens -= 1 # the frame will be handled, so it owes its token
+        self.limited.inc((kind, action))
+        return action, wait
@@ -0,0 +1,709 @@
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import chatlog
+import history
+import server
+import skeletons
+import timerwheel
+import wire
+
+try:
+    from transitions import Machine
+except ImportError:
+    Machine = None
+
+try:
+    import combat
+except ImportError: # needs numpy
+    combat = None
+
+
+def noop(*args):
+    pass
+
+
+class BenchCreature(skeletons.Creature):
+    # Callbacks stubbed out so only state machine dispatch is measured
+    def alert_state_change(self):
+        pass
+
+    def on_begin_attack(self):
+        pass
+
+    def on_interrupt(self):
+        pass
+
+    def on_defend(self):
+        pass
+
+    def on_attack(self):
+        pass
+
+    def stop_defense(self):
+        pass
+
+    def on_death(self):
+        pass
+
+
+class TransitionsCreature():
+    # How Creature used to set up its state machine: one transitions.Machine per instance
+    def __init__(self):
+        self.machine = Machine(model=self, states=skeletons.Creature.states, initial='idle', after_state_change='alert_state_change')
+        self.machine.add_transition(trigger='begin_attack', source='idle', dest='attacking', after = 'on_begin_attack')
+        self.machine.add_transition(trigger='interrupt', source='attacking', dest='idle', after = 'on_interrupt')
+        self.machine.add_transition(trigger='begin_defense', source='idle', dest='defending', after = 'on_defend')
+        self.machine.add_transition(trigger='action_complete', source='attacking', dest='idle', after='on_attack')
+        self.machine.add_transition(trigger='action_complete', source='defending', dest='idle', after='stop_defense')
+
+        for state in skeletons.Creature.states:
+            if state != 'dead':
+                self.machine.add_transition(trigger='die', source=state, dest='dead', after='on_death')
+
+    alert_state_change = on_begin_attack = on_interrupt = on_defend = on_attack = stop_defense = on_death = noop
+
+
+def trigger_cycle(creature):
+    creature.begin_attack()
+    creature.action_complete()
+    creature.begin_defense()
+    creature.action_complete()
+    creature.begin_attack()
+    creature.interrupt()
+
+
+def report(name, number, seconds, unit='op'):
+    print('{:<40} {:>10.2f} us/{}'.format(name, seconds / number * 1e6, unit))
+    return seconds / number
+
+
+def bench_state_machine(number=20000):
+    print('State machine: compiled table vs transitions.Machine')
+    new = report('construct compiled', number, timeit.timeit(lambda: BenchCreature('bench'), number=number))
+    creature = BenchCreature('bench')
+    new_cycle = report('6 triggers compiled', number, timeit.timeit(lambda: trigger_cycle(creature), number=number), 'cycle')
+    if Machine is None:
+        print('transitions is not installed, skipping the comparison')
+        return
+    old_number = max(1, number // 10)
+    old = report('construct transitions', old_number, timeit.timeit(TransitionsCreature, number=old_number))
+    legacy = TransitionsCreature()
+    old_cycle = report('6 triggers transitions', number, timeit.timeit(lambda: trigger_cycle(legacy), number=number), 'cycle')
+    print('speedup: construct x{:.1f}, triggers x{:.1f}'.format(old / new, old_cycle / new_cycle))
+
+
+class DictLayout():
+    pass
+
+
+def slot_names(cls):
+    names = []
+    for klass in cls.__mro__:
+        names.extend(getattr(klass, '__slots__', ()))
+    return names
+
+
+def dict_copy(obj):
+    # Same attributes in a plain __dict__ instance, i.e. the layout these classes had before __slots__
+    copy = DictLayout()
+    for name in slot_names(type(obj)):
+        setattr(copy, name, getattr(obj, name))
+    return copy
+
+
+def instance_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def traced(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return objects, after - before
+
+
+def bench_memory(number=10000):
+    print('Memory: {} connected clients and {} messages'.format(number, number))
+    loop = asyncio.new_event_loop()
+    skeleton = skeletons.Skeleton('skeleton', loop=loop)
+
+    def connect():
+        connections = []
+        for i in range(number):
+            client = server.Client(username='user{}'.format(i))
+            client.player = skeletons.Player(client.username, uid=client.uid, loop=loop, target=skeleton, client=client)
+            connections.append(client)
+        return connections
+
+    def chat():
+        return [server.Message(client, 'hello') for client in connections]
+
+    def events():
+        return [server.GameSystemMessage(client.player, 'creature_health_report', [95]) for client in connections]
+
+    connections, connection_bytes = traced(connect)
+    messages, message_bytes = traced(chat)
+    sys_messages, sys_message_bytes = traced(events)
+    print('{:<40} {:>10.1f} bytes'.format('per connection (Client + Player)', connection_bytes / number))
+    print('{:<40} {:>10.1f} bytes'.format('per chat Message', message_bytes / number))
+    print('{:<40} {:>10.1f} bytes'.format('per GameSystemMessage', sys_message_bytes / number))
+
+    print('Instance size, __slots__ vs the same attributes in a __dict__:')
+    for name, obj in [('Client', connections[0]), ('Player', connections[0].player), ('Message', messages[0]), ('SystemMessage', sys_messages[0])]:
+        slotted = instance_size(obj)
+        unslotted = instance_size(dict_copy(obj))
+        print('{:<40} {:>5} vs {:>5} bytes ({:+d})'.format(name, slotted, unslotted, slotted - unslotted))
+    loop.close()
+
+
+def fight_events(skeleton, players):
+    # The events of one exchange of blows, the bulk of what a skeleton room sends
+    events = []
+    for player in players:
+        events.append(server.SystemMessage(player, 'creature_attack_started', []))
+        events.append(server.SystemMessage(player, 'creature_changed_state', ['attacking']))
+        events.append(server.SystemMessage(player, 'creature_attack_finished', []))
+        events.append(server.SystemMessage(skeleton, 'creature_took_damage', [20]))
+        events.append(server.SystemMessage(skeleton, 'creature_health_report', [80]))
+        events.append(server.SystemMessage(player, 'creature_changed_state', ['idle']))
+    events.append(server.SystemMessage(skeleton, 'ai_new_target', [players[0].uid]))
+    return events
+
+
+def decode_text(frame):
+    # What the clients do with a text frame
+    lines = frame[len('sysbatch|'):].split('\n') if frame.startswith('sysbatch|') else [frame]
+    events = []
+    for line in lines:
+        parts = line.split('|')
+        events.append((parts[1], parts[2], parts[3:]))
+    return events
+
+
+def encode_text(events):
+    if len(events) == 1:
+        return events[0].encode()
+    return 'sysbatch|{}'.format('\n'.join([msg.encode() for msg in events]))
+
+
+def bench_wire(number=20000):
+    print('Wire protocol: text frames vs {} binary frames'.format(wire.SUBPROTOCOL))
+    skeleton = skeletons.Creature('skeleton')
+    players = [skeletons.Creature('player{}'.format(i)) for i in range(4)]
+    events = fight_events(skeleton, players)
+    codec = server.WIRE
+    for name, batch in [('single health report', events[4:5]), ('{} event batch'.format(len(events)), events)]:
+        text = encode_text(batch)
+        binary = codec.encode(batch)
+        text_bytes = len(text.encode('utf-8'))
+        print('{:<40} {:>6} vs {:>6} bytes (x{:.1f})'.format(name, text_bytes, len(binary), text_bytes / len(binary)))
+        text_encode = report('  encode text', number, timeit.timeit(lambda: encode_text(batch), number=number), 'frame')
+        binary_encode = report('  encode binary', number, timeit.timeit(lambda: codec.encode(batch), number=number), 'frame')
+        text_decode = report('  decode text', number, timeit.timeit(lambda: decode_text(text), number=number), 'frame')
+        binary_decode = report('  decode binary', number, timeit.timeit(lambda: codec.decode(binary), number=number), 'frame')
+        print('  speedup: encode x{:.2f}, decode x{:.2f}'.format(text_encode / binary_encode, text_decode / binary_decode))
+
+
+def bench_combat(fights=500, players=2, number=200):
+    print('Combat: one exchange of blows in {} fights of {} players, Creature objects vs combat.CombatEngine'.format(fights, players))
+    if combat is None:
+        print('numpy is not installed, skipping the comparison')
+        return
+    loop = asyncio.new_event_loop()
+    classic = []
+    for i in range(fights):
+        skeleton = creature(skeletons.Skeleton, 'skeleton', '5{:07x}'.format(i), loop=loop)
+        classic.append((skeleton, [creature(skeletons.Player, 'player', 'c{:07x}'.format(i * players + j), loop=loop, target=skeleton) for j in range(players)]))
+    attacking = skeletons.Creature.compiled_machine().codes['attacking']
+    handle = DummyHandle()
+
+    def classic_round():
+        for skeleton, fighters in classic:
+            skeleton.health = 10 ** 6
+            for player in fighters:
+                player.state_code = attacking
+                player.action_task = handle
+                player.action_complete()
+
+    engine = combat.CombatEngine(loop, capacity=fights * (players + 1))
+    skeleton_rows, player_rows = [], []
+    for i in range(fights):
+        skeleton = engine.create_skeleton('skeleton')
+        skeleton.emit_message = noop
+        skeleton_rows.append(skeleton.row)
+        for j in range(players):
+            player = engine.create_player('player', target=skeleton)
+            player.emit_message = noop
+            player_rows.append(player.row)
+
+    def engine_round():
+        engine.health[skeleton_rows] = 10 ** 6
+        engine.state[player_rows] = combat.ATTACKING
+        engine.deadline[player_rows] = 0
+        engine.step(1.0)
+
+    old = report('  Creature objects', number, timeit.timeit(classic_round, number=number), 'round')
+    new = report('  CombatEngine.step', number, timeit.timeit(engine_round, number=number), 'round')
+    print('  speedup: x{:.2f}'.format(old / new))
+    engine.close()
+    loop.close()
+
+
+# Deterministic micro-benchmark suite: no sockets, fixed seed and uids, a fixed number of operations
+# per case. Each case is timed `repeat` times and the best run counts. Frames sent to the recording
+# websockets are counted too, so a change in what the server sends shows up next to the timings.
+
+class RecordingWebSocket():
+    subprotocol = None
+
+    def __init__(self):
+        self.frames = []
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+    async def close(self):
+        pass
+
+
+class DummyHandle():
+    def cancel(self):
+        pass
+
+
+class Context():
+    # What a case's setup builds: one event loop, plus servers and websockets to count and clean up
+    def __init__(self, loop):
+        self.loop = loop
+        self.websockets = []
+        self.servers = []
+        self.chat_logs = []
+
+    def websocket(self):
+        websocket = RecordingWebSocket()
+        self.websockets.append(websocket)
+        return websocket
+
+    def server(self, clients=0):
+        chat = server.ChatServer(loop=self.loop, session_grace=0, outbound_queue_size=10 ** 7)
+        for i in range(clients):
+            chat.register_client(self.client(i))
+        self.servers.append(chat)
+        return chat
+
+    def chat_log(self):
+        store = chatlog.ChatLogStore(tempfile.mkdtemp(prefix='bench-chatlog-'), self.loop)
+        self.chat_logs.append(store)
+        return store
+
+    def client(self, i):
+        return server.Client(uid='c{:07x}'.format(i), websocket=self.websocket(), username='user{}'.format(i))
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def drain(self):
+        # Let the writer tasks hand every queued frame to the websockets; returns how many they got
+        for _ in range(3):
+            self.run(asyncio.sleep(0))
+        frames = 0
+        for websocket in self.websockets:
+            frames += len(websocket.frames)
+            websocket.frames.clear()
+        return frames
+
+    def close(self):
+        for chat in self.servers:
+            for client in list(chat.clients_by_websocket.values()):
+                if client.outbox is not None:
+                    client.outbox.close()
+            for room in chat.rooms:
+                if isinstance(room, server.SkeletonRoom):
+                    room.skeleton.stop()
+            chat.timers.close()
+        self.drain()
+        for store in self.chat_logs:
+            store.close()
+            shutil.rmtree(store.directory, ignore_errors=True)
+
+
+def creature(cls=skeletons.Creature, name='bench', uid='0000c0de', **kwargs):
+    obj = cls(name, uid=uid, **kwargs)
+    obj.emit_message = noop
+    return obj
+
+
+def setup_construct(cls):
+    def setup(context):
+        timers = timerwheel.TimerWheel(context.loop)
+        if cls is skeletons.Creature:
+            return lambda: cls('bench', uid='0000c0de')
+        return lambda: cls('bench', uid='0000c0de', loop=context.loop, timers=timers)
+    return setup
+
+
+def setup_trigger(trigger, state='idle'):
+    def setup(context):
+        obj = creature()
+        code = obj.machine.codes[state]
+        fire = getattr(obj, trigger)
+        handle = DummyHandle()
+
+        def step():
+            obj.state_code = code
+            obj.action_task = handle
+            obj.defense = False
+            fire()
+        return step
+    return setup
+
+
+def setup_take_damage(state='idle', defense=False, health=100):
+    def setup(context):
+        skeleton = creature(skeletons.Skeleton, 'skeleton', '5ce1e700', loop=context.loop)
+        obj = creature(skeletons.Player, 'player', 'c0000000', loop=context.loop, target=skeleton)
+        skeleton.add_target(obj)
+        code = obj.machine.codes[state]
+        handle = DummyHandle()
+
+        def step():
+            obj.state_code = code
+            obj.action_task = handle
+            obj.defense = defense
+            obj.health = health
+            obj.alive = True
+            obj.take_damage(20)
+        return step
+    return setup
+
+
+def setup_attack_chain(context):
+    # A player's blow landing on an attacking skeleton: on_attack -> take_damage -> interrupt
+    skeleton = creature(skeletons.Skeleton, 'skeleton', '5ce1e700', loop=context.loop)
+    player = creature(skeletons.Player, 'player', 'c0000000', loop=context.loop, target=skeleton)
+    attacking = player.machine.codes['attacking']
+    handle = DummyHandle()
+
+    def step():
+        player.state_code = skeleton.state_code = attacking
+        player.action_task = skeleton.action_task = handle
+        skeleton.health = 100
+        player.action_complete()
+    return step
+
+
+def setup_think(players, retarget):
+    # One Skeleton.run decision: pick a target if needed, then roll attack or defense
+    def setup(context):
+        timers = timerwheel.TimerWheel(context.loop)
+        skeleton = creature(skeletons.Skeleton, 'skeleton', '5ce1e700', loop=context.loop, timers=timers)
+        targets = [creature(skeletons.Player, 'player{}'.format(i), 'c{:07x}'.format(i), loop=context.loop) for i in range(players)]
+        for target in targets:
+            skeleton.add_target(target)
+        skeleton.active = True
+        idle = skeleton.machine.codes['idle']
+
+        def step():
+            if retarget:
+                skeleton.target = None
+            skeleton.think()
+            skeleton.action_task.cancel()
+            skeleton.state_code = idle
+            skeleton.defense = False
+        return step
+    return setup
+
+
+def setup_history(size, targeted):
+    # targeted: every nth line is a private one addressed to the reading client
+    def setup(context):
+        room = server.Room(loop=context.loop, uid='r0000000', _name='bench')
+        room.history = history.RoomHistory(size)
+        reader = server.Client(uid='c0000000', username='reader')
+        authors = [server.Client(uid='c{:07x}'.format(i), username='user{}'.format(i)) for i in range(1, 20)]
+        for i in range(size):
+            targets = [reader] if targeted and i % targeted == 0 else None
+            room.log_message(server.Message(authors[i % len(authors)], 'message number {} {}'.format(i, 'x' * (i % 40)), targets))
+        return lambda: room.readable_history(reader)
+    return setup
+
+
+def fill_history(room_history, size, targeted, reader):
+    authors = ['user{}'.format(i) for i in range(1, 20)]
+    for i in range(size):
+        targets = [reader] if targeted and i % targeted == 0 else None
+        room_history.append('{}: message number {} {}'.format(authors[i % len(authors)], i, 'x' * (i % 40)), targets)
+
+
+def setup_history_page(store, size, targeted):
+    # The first '::history' page (50 lines) from a full room, from memory or from the chat log store
+    def setup(context):
+        reader = server.Client(uid='c0000000', username='reader')
+        if store:
+            room_history = context.chat_log().open('chat-bench', size)
+            fill_history(room_history, size, targeted, reader)
+            context.run(asyncio.sleep(0.2)) # written and read through the memory maps
+        else:
+            room_history = history.RoomHistory(size)
+            fill_history(room_history, size, targeted, reader)
+        return lambda: room_history.page(reader, None, 50)
+    return setup
+
+
+def setup_chatlog_append(context):
+    # The loop thread's share of logging a chat line; the writer thread is not timed
+    room_history = context.chat_log().open('chat-bench', 500)
+    line = 'user1: a typical chat line of some forty chars'
+    return lambda: room_history.append(line)
+
+
+def setup_send_system_message(clients):
+    def setup(context):
+        chat = context.server(clients)
+        room = chat.room
+        room.uid = 'l0bb0000'
+        for client in chat.clients_by_websocket.values():
+            room.clients.add(client)
+            client.room = room
+        emitter = next(iter(room.clients))
+
+        async def step():
+            await room.send_system_message(server.SystemMessage(room, 'client_joined_room', [emitter.uid, emitter.username]))
+        return step
+    return setup
+
+
+def setup_lookup(method, clients):
+    # Half of the lookups hit a connected client, half miss
+    def setup(context):
+        chat = context.server(clients)
+        rng = random.Random(clients)
+        connected = list(chat.clients_by_websocket.keys())
+        if method == 'get_client':
+            keys = [rng.choice(connected) if i % 2 else RecordingWebSocket() for i in range(1024)]
+            lookup = chat.get_client
+        else:
+            keys = ['user{}'.format(rng.randrange(clients * 2)) for i in range(1024)]
+            lookup = chat.valid_username
+        cycle = itertools.cycle(keys)
+        return lambda: lookup(next(cycle))
+    return setup
+
+
+def setup_claim_skeleton_name(free):
+    def setup(context):
+        chat = context.server()
+        names = chat.rooms.free_skeleton_names
+        if free is not None:
+            for name in sorted(chat.rooms.skeleton_names)[free:]:
+                names.take(name)
+
+        async def step():
+            await chat.claim_skeleton_name()
+        return step
+    return setup
+
+
+def setup_handle_skeleton(context):
+    # '::skeleton' from the lobby: allocate a free name, create the room and move the client there,
+    # then the client leaves and the room (and its name) is freed again
+    chat = context.server(1)
+    lobby = chat.room
+    client = next(iter(chat.clients_by_websocket.values()))
+    lobby.clients.add(client)
+    client.room = lobby
+    message = server.Message(client, '::skeleton')
+
+    async def step():
+        await lobby.handle_command(message)
+        await client.room.remove_client(client)
+        lobby.clients.add(client)
+        client.room = lobby
+        await asyncio.sleep(0) # let the skeleton's AI task start and stop
+    return step
+
+
+class Case():
+    def __init__(self, name, setup, number):
+        self.name = name
+        self.setup = setup
+        self.number = number
+
+
+suite = [
+    Case('creature.construct', setup_construct(skeletons.Creature), 20000),
+    Case('skeleton.construct', setup_construct(skeletons.Skeleton), 20000),
+    Case('player.construct', setup_construct(skeletons.Player), 20000),
+    Case('trigger.begin_attack', setup_trigger('begin_attack'), 50000),
+    Case('trigger.begin_defense', setup_trigger('begin_defense'), 50000),
+    Case('trigger.interrupt', setup_trigger('interrupt', 'attacking'), 50000),
+    Case('trigger.action_complete.attacking', setup_trigger('action_complete', 'attacking'), 50000),
+    Case('trigger.action_complete.defending', setup_trigger('action_complete', 'defending'), 50000),
+    Case('trigger.die', setup_trigger('die'), 50000),
+    Case('take_damage.hit', setup_take_damage(), 50000),
+    Case('take_damage.blocked', setup_take_damage('defending', defense=True), 50000),
+    Case('take_damage.interrupt', setup_take_damage('attacking'), 50000),
+    Case('take_damage.lethal', setup_take_damage(health=20), 50000),
+    Case('take_damage.attack_chain', setup_attack_chain, 50000),
+    Case('skeleton.think.decide', setup_think(2, False), 20000),
+    Case('skeleton.think.retarget_2', setup_think(2, True), 20000),
+    Case('skeleton.think.retarget_100', setup_think(100, True), 20000),
+    Case('history.readable.500', setup_history(500, None), 2000),
+    Case('history.readable.10k', setup_history(10000, None), 200),
+    Case('history.readable.10k_targeted', setup_history(10000, 10), 200),
+    Case('history.page.10k_targeted', setup_history_page(False, 10000, 10), 2000),
+    Case('chatlog.page.10k_targeted', setup_history_page(True, 10000, 10), 2000),
+    Case('chatlog.append', setup_chatlog_append, 20000),
+    Case('send_system_message.10', setup_send_system_message(10), 5000),
+    Case('send_system_message.1k', setup_send_system_message(1000), 200),
+    Case('get_client.10', setup_lookup('get_client', 10), 100000),
+    Case('get_client.1k', setup_lookup('get_client', 1000), 100000),
+    Case('get_client.100k', setup_lookup('get_client', 100000), 100000),
+    Case('valid_username.10', setup_lookup('valid_username', 10), 100000),
+    Case('valid_username.1k', setup_lookup('valid_username', 1000), 100000),
+    Case('valid_username.100k', setup_lookup('valid_username', 100000), 100000),
+    Case('claim_skeleton_name.all_free', setup_claim_skeleton_name(None), 20000),
+    Case('claim_skeleton_name.5_free', setup_claim_skeleton_name(5), 20000),
+    Case('handle_skeleton', setup_handle_skeleton, 2000),
+]
+
+
+def time_case(case, context, step, repeat):
+    runs = []
+    frames = 0
+    if asyncio.iscoroutinefunction(step):
+        async def run():
+            for _ in range(case.number):
+                await step()
+    else:
+        def run():
+            for _ in range(case.number):
+                step()
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            if asyncio.iscoroutinefunction(run):
+                context.run(run())
+            else:
+                run()
+            runs.append(time.perf_counter() - started)
+        finally:
+            gc.enable()
+        frames += context.drain()
+    return {
+        'number': case.number,
+        'best_us': min(runs) / case.number * 1e6,
+        'median_us': statistics.median(runs) / case.number * 1e6,
+        'frames_per_op': round(frames / (case.number * repeat), 3),
+    }
+
+
+def run_suite(patterns=None, repeat=5, seed=1):
+    results = {}
+    for case in suite:
+        if patterns and not any(case.name.startswith(pattern) for pattern in patterns):
+            continue
+        random.seed(seed)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        context = Context(loop)
+        try:
+            step = case.setup(context)
+            context.drain()
+            result = results[case.name] = time_case(case, context, step, repeat)
+        finally:
+            context.close()
+            loop.close()
+        print('{:<40} {:>10.3f} us/op {:>8} frames/op'.format(case.name, result['best_us'], result['frames_per_op']))
+    return results
+
+
+def compare(old, new, threshold):
+    # Regressions: cases more than threshold (a fraction) slower than before, or sending other frames
+    regressions = []
+    print('{:<40} {:>10} {:>10} {:>8}'.format('case', 'old us', 'new us', 'change'))
+    for name, result in new['cases'].items():
+        previous = old['cases'].get(name)
+        if not previous:
+            print('{:<40} {:>10} {:>10.3f}        new'.format(name, '', result['best_us']))
+            continue
+        change = result['best_us'] / previous['best_us'] - 1
+        flag = ''
+        if change > threshold:
+            flag = 'REGRESSION'
+        elif change < -threshold:
+            flag = 'faster'
+        if result['frames_per_op'] != previous['frames_per_op']:
+            flag = 'FRAMES {} -> {}'.format(previous['frames_per_op'], result['frames_per_op'])
+        if flag.isupper() or flag.startswith('FRAMES'):
+            regressions.append(name)
+        print('{:<40} {:>10.3f} {:>10.3f} {:>+7.1f}% {}'.format(name, previous['best_us'], result['best_us'], change * 100, flag))
+    return regressions
+
+
+benchmarks = {
+    'state_machine': bench_state_machine,
+    'memory': bench_memory,
+    'wire': bench_wire,
+    'combat': bench_combat,
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks. "suite" runs the deterministic micro-benchmarks, the rest print comparisons.')
+    parser.add_argument('names', nargs='*', help='any of suite, {}; all by default'.format(', '.join(benchmarks)))
+    parser.add_argument('--cases', default=None, help='comma-separated suite case name prefixes')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', default=None, help='write suite results to this file')
+    parser.add_argument('--compare', default=None, help='suite results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown that counts as a regression, 0.1 is 10%%')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    names = args.names or ['suite'] + list(benchmarks.keys())
+    for name in names:
+        if name != 'suite':
+            benchmarks[name]()
+            continue
+        results = {
+            'tool': 'bench',
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'repeat': args.repeat,
+        }
+        results['cases'] = run_suite(args.cases.split(',') if args.cases else None, args.repeat, args.seed)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            print('Results saved to {}'.format(args.json))
+        if args.compare:
+            with open(args.compare) as f:
+                regressions = compare(json.load(f), results, args.threshold)
+            if regressions:
+                print('{} regressions: {}'.format(len(regressions), ', '.join(regressions)))
+                sys.exit(1)
@@ -0,0 +1,413 @@
+import asyncio
+import json
+import logging
+import logs
+import secrets
+import sys
+import time
+
+logger = logs.get('broker')
+
+STREAM_LIMIT = 2 ** 24 # longest batch line a reader accepts
+
+# Several ChatServer nodes (processes, possibly on different hosts) act as one game through a broker:
+#   - presence: a username is claimed by one node at a time
+#   - room directory: a room name belongs to the node that claimed it first; a join from another node
+#     hands the client off to the owner, redirecting it there with a one-time token
+#   - pub/sub: lobby chat and the like is published on a channel and delivered to every other node
+#     subscribed to it
+#   - node table: where each node can be reached, pushed to every node when it changes
+# Broker is the interface ChatServer uses. InProcessBroker connects nodes in one process through a
+# shared Directory; SocketBroker talks to a BrokerServer over TCP. Neither needs outside services.
+
+
+class Directory():
+    # The broker's state, shared by every implementation. deliver(node, message) pushes to a node.
+    def __init__(self, deliver=None, handoff_ttl=30, clock=time.monotonic):
+        self.deliver = deliver
+        self.handoff_ttl = handoff_ttl
+        self.clock = clock
+        self.nodes = {} # node -> [host, port]
+        self.usernames = {} # username -> node
+        self.rooms = {} # room name -> node
+        self.handoffs = {} # token -> (handoff, expiry time)
+        self.subscriptions = {} # channel -> set of nodes
+        self.ops = {
+            'claim_username': self.claim_username,
+            'release_username': self.release_username,
+            'claim_room': self.claim_room,
+            'release_room': self.release_room,
+            'handoff': self.handoff,
+            'take_handoff': self.take_handoff,
+            'subscribe': self.subscribe,
+            'publish': self.publish,
+        }
+
+    def handle(self, node, message):
+        op = self.ops.get(message['op'])
+        if not op:
+            logger.error('Broker: unknown op from node {}: {}', node, message)
+            return None
+        return op(node, message)
+
+    def join(self, node, address):
+        logger.info('Broker: node {} joined at {}', node, address)
+        self.nodes[node] = list(address)
+        self.announce_nodes()
+
+    def leave(self, node):
+        # Whatever a gone node held is free again
+        logger.warning('Broker: node {} left', node)
+        self.nodes.pop(node, None)
+        for table in (self.usernames, self.rooms):
+            for name in [name for name, owner in table.items() if owner == node]:
+                del table[name]
+        for nodes in self.subscriptions.values():
+            nodes.discard(node)
+        self.announce_nodes()
+
+    def announce_nodes(self):
+        for node in self.nodes:
+            self.deliver(node, {'op': 'nodes', 'nodes': self.nodes})
+
+    def expire_handoffs(self):
+        now = self.clock()
+        for token in [token for token, (handoff, expiry) in self.handoffs.items() if expiry < now]:
+            handoff, expiry = self.handoffs.pop(token)
+            if self.usernames.get(handoff['username']) == handoff['target']:
+                del self.usernames[handoff['username']]
+
+    def claim_username(self, node, message):
+        self.expire_handoffs()
+        name = message['name']
+        if name in self.usernames:
+            return {'ok': False}
+        self.usernames[name] = node
+        return {'ok': True}
+
+    def release_username(self, node, message):
+        if self.usernames.get(message['name']) == node:
+            del self.usernames[message['name']]
+
+    def claim_room(self, node, message):
+        owner = self.rooms.get(message['name'])
+        if not owner in self.nodes:
+            owner = self.rooms[message['name']] = node
+        return {'owner': owner}
+
+    def release_room(self, node, message):
+        if self.rooms.get(message['name']) == node:
+            del self.rooms[message['name']]
+
+    def handoff(self, node, message):
+        # The username moves to the target node right away, so the source releasing it is a no-op
+        self.expire_handoffs()
+        target = message['target']
+        if not target in self.nodes:
+            return {'token': None}
+        token = secrets.token_urlsafe(16)
+        self.usernames[message['username']] = target
+        self.handoffs[token] = (message, self.clock() + self.handoff_ttl)
+        return {'token': token}
+
+    def take_handoff(self, node, message):
+        self.expire_handoffs()
+        handoff = self.handoffs.get(message['token'])
+        if not handoff or handoff[0]['target'] != node:
+            return {'handoff': None}
+        del self.handoffs[message['token']]
+        return {'handoff': handoff[0]}
+
+    def subscribe(self, node, message):
+        self.subscriptions.setdefault(message['channel'], set()).add(node)
+
+    def publish(self, node, message):
+        for subscriber in self.subscriptions.get(message['channel'], ()):
+            if subscriber != node:
+                self.deliver(subscriber, message)
+
+
+class Broker():
+    # Interface between a ChatServer node and the rest of the game
+    def __init__(self, node, address, loop=None):
+        if '.' in str(node):
+            raise ValueError('Node names can\'t contain dots: {}'.format(node)) # session tokens are '<node>.<secret>'
+        self.node = sys.intern(str(node))
+        self.address = tuple(address) # (host, port) clients are redirected to
+        self.loop = loop or asyncio.get_event_loop()
+        self.nodes = {}
+        self.channels = {} # channel -> callback(message)
+
+    async def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def address_of(self, node):
+        return self.nodes.get(node)
+
+    def deliver(self, message):
+        # A push from the broker
+        if message['op'] == 'nodes':
+            self.nodes = {node: tuple(address) for node, address in message['nodes'].items()}
+        elif message['op'] == 'publish':
+            callback = self.channels.get(message['channel'])
+            if callback:
+                callback(message['message'])
+
+    async def request(self, op, **fields):
+        raise NotImplementedError()
+
+    def notify(self, op, **fields):
+        raise NotImplementedError()
+
+    async def claim_username(self, name):
+        reply = await self.request('claim_username', name=name)
+        return reply['ok']
+
+    def release_username(self, name):
+        self.notify('release_username', name=name)
+
+    async def claim_room(self, name):
+        # Node owning the room, this one if nobody did
+        reply = await self.request('claim_room', name=name)
+        return reply['owner']
+
+    def release_room(self, name):
+        self.notify('release_room', name=name)
+
+    async def handoff(self, target, username, uid, command):
+        reply = await self.request('handoff', target=target, username=username, uid=uid, command=command)
+        return reply['token']
+
+    async def take_handoff(self, token):
+        reply = await self.request('take_handoff', token=token)
+        return reply['handoff']
+
+    def subscribe(self, channel, callback):
+        self.channels[channel] = callback
+        self.notify('subscribe', channel=channel)
+
+    def publish(self, channel, message):
+        self.notify('publish', channel=channel, message=message)
+
+
+class InProcessBroker(Broker):
+    # Nodes in one process sharing a Directory; pushes are delivered on the next loop iteration
+    def __init__(self, directory, node, address, loop=None):
+        super(InProcessBroker, self).__init__(node, address, loop)
+        self.directory = directory
+
+    async def start(self):
+        self.directory.brokers[self.node] = self
+        self.directory.join(self.node, self.address)
+
+    def close(self):
+        if self.directory.brokers.get(self.node) is self:
+            self.directory.leave(self.node)
+            del self.directory.brokers[self.node]
+
+    async def request(self, op, **fields):
+        fields['op'] = op
+        return self.directory.handle(self.node, fields)
+
+    def notify(self, op, **fields):
+        fields['op'] = op
+        self.directory.handle(self.node, fields)
+
+
+def local_directory(loop=None, **kwargs):
+    # Directory for InProcessBrokers
+    loop = loop or asyncio.get_event_loop()
+    brokers = {}
+    directory = Directory(lambda node, message: loop.call_soon(brokers[node].deliver, message), **kwargs)
+    directory.brokers = brokers
+    return directory
+
+
+class Batcher():
+    # Collects outgoing messages and writes them as one JSON list per line, once per loop iteration
+    # or every max_batch messages
+    def __init__(self, writer, loop, max_batch=512):
+        self.writer = writer
+        self.loop = loop
+        self.max_batch = max_batch
+        self.messages = []
+        self.flush_handle = None
+        self.batches = 0
+        self.sent = 0
+
+    def send(self, message):
+        self.messages.append(message)
+        if len(self.messages) >= self.max_batch:
+            self.flush()
+        elif not self.flush_handle:
+            self.flush_handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.writer.is_closing():
+            self.messages = [] # nobody will read them
+        if not self.messages:
+            return
+        self.writer.write(json.dumps(self.messages).encode('utf-8') + b'\n')
+        self.batches += 1
+        self.sent += len(self.messages)
+        self.messages = []
+
+    def close(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.writer.close()
+
+
+class SocketBroker(Broker):
+    # Talks to a BrokerServer. Everything a node sends during one loop iteration goes out in one
+    # batch, so fan-out and fire-and-forget notifications never wait on a round trip. Once the
+    # connection is lost requests fail with ConnectionError and notifications are dropped.
+    def __init__(self, node, address, broker_address, loop=None, request_timeout=10):
+        super(SocketBroker, self).__init__(node, address, loop)
+        self.broker_address = broker_address
+        self.request_timeout = request_timeout
+        self.batcher = None
+        self.next_id = 0
+        self.requests = {} # request id -> future
+        self.listen_task = None
+        self.lost = False
+
+    async def start(self):
+        reader, writer = await asyncio.open_connection(*self.broker_address, limit=STREAM_LIMIT)
+        self.batcher = Batcher(writer, self.loop)
+        self.notify('hello', node=self.node, address=self.address)
+        self.listen_task = self.loop.create_task(self.listen(reader))
+
+    async def listen(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    logger.error('Node {}: lost the broker', self.node)
+                    break
+                for message in json.loads(line.decode('utf-8')):
+                    if 'id' in message:
+                        future = self.requests.pop(message['id'], None)
+                        if future and not future.done():
+                            future.set_result(message)
+                    else:
+                        self.deliver(message)
+        except (ConnectionError, ValueError) as e:
+            logger.error('Node {}: lost the broker: {!r}', self.node, e)
+        finally:
+            self.lost = True
+            for future in self.requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Broker connection lost'))
+            self.requests.clear()
+
+    async def request(self, op, **fields):
+        if self.lost:
+            raise ConnectionError('Broker connection lost')
+        self.next_id += 1
+        request_id = self.next_id
+        future = self.loop.create_future()
+        self.requests[request_id] = future
+        fields['id'] = request_id
+        self.notify(op, **fields)
+        try:
+            return await asyncio.wait_for(future, self.request_timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError('Broker did not answer {} within {}s'.format(op, self.request_timeout))
+        finally:
+            self.requests.pop(request_id, None)
+
+    def notify(self, op, **fields):
+        if self.lost:
+            return
+        fields['op'] = op
+        self.batcher.send(fields)
+
+    def close(self):
+        self.lost = True
+        if self.listen_task:
+            self.listen_task.cancel()
+        if self.batcher:
+            self.batcher.close()
+
+
+class BrokerServer():
+    # Stand-in broker service: a Directory behind a TCP socket, batching replies and pushes per node
+    def __init__(self, loop=None, handoff_ttl=30):
+        self.loop = loop or asyncio.get_event_loop()
+        self.directory = Directory(self.deliver, handoff_ttl)
+        self.connections = {} # node -> Batcher
+        self.server = None
+
+    def deliver(self, node, message):
+        batcher = self.connections.get(node)
+        if batcher:
+            batcher.send(message)
+
+    async def start(self, host='127.0.0.1', port=0, sock=None):
+        if sock:
+            self.server = await asyncio.start_server(self.handle_node, sock=sock, limit=STREAM_LIMIT)
+        else:
+            self.server = await asyncio.start_server(self.handle_node, host, port, limit=STREAM_LIMIT)
+        return self.server
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle_node(self, reader, writer):
+        node = None
+        batcher = Batcher(writer, self.loop)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for message in json.loads(line.decode('utf-8')):
+                    if message['op'] == 'hello':
+                        node = message['node']
+                        self.connections[node] = batcher
+                        self.directory.join(node, message['address'])
+                        continue
+                    reply = self.directory.handle(node, message)
+                    if 'id' in message:
+                        reply = reply or {}
+                        reply['id'] = message['id']
+                        batcher.send(reply)
+        except (ConnectionError, ValueError) as e:
+            logger.error('Broker: lost node {}: {!r}', node, e)
+        finally:
+            if node is not None and self.connections.get(node) is batcher:
+                del self.connections[node]
+                self.directory.leave(node)
+            batcher.close()
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+
+if __name__ == '__main__':
+    # Standalone broker for nodes on several hosts: python broker.py [host] [port]
+    logging.basicConfig(level=logging.INFO)
+    args = sys.argv[1:]
+    host = args[0] if len(args) > 0 else '0.0.0.0'
+    port = int(args[1]) if len(args) > 1 else 8764
+    loop = asyncio.get_event_loop()
+    broker = BrokerServer(loop)
+    loop.run_until_complete(broker.start(host, port))
+    logger.info('Broker listening on {}:{}', host, port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.close()
+        loop.close()
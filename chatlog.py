@@ -0,0 +1,371 @@
+import array
+import asyncio
+import bisect
+import concurrent.futures
+import mmap
+import os
+import struct
+import time
+import urllib.parse
+import history
+import logs
+import metrics
+
+logger = logs.get('chatlog')
+
+# Persistent room history: an append-only log per room, split into segment files of about
+# segment_bytes each and named after the first seq they hold. A record is a header (line bytes,
+# target bytes, seq, timestamp) followed by the targets (recipient usernames joined by '\n') and the
+# line, both UTF-8.
+#
+# The loop thread owns all state: it assigns seqs and offsets, keeps appended records readable from
+# memory until they are on disk, and indexes every record by seq (offset and timestamp per segment),
+# public seqs and seqs per recipient. Records are written in batches every flush_interval seconds by a
+# single writer thread; reads of written records go through a read-only memory map of their segment.
+# A room shows the same window as RoomHistory (the last max_messages, none older than max_age);
+# segments that fall entirely out of it are deleted. On start the segments are scanned to rebuild the
+# index, and a record torn by a crash is cut off.
+
+RECORD = struct.Struct('<IIQd') # line bytes, targets bytes, seq, timestamp
+
+
+def recipient(client):
+    # Recipients are stored by username so private lines survive reconnects and restarts
+    return getattr(client, 'username', None) or str(client)
+
+
+class Segment():
+    def __init__(self, path, first_seq, size=0):
+        self.path = path
+        self.first_seq = first_seq
+        self.offsets = array.array('Q') # offset of seq first_seq + i
+        self.times = array.array('d')
+        self.size = size # bytes, including records not written yet
+        self.written = size # bytes known to be on disk
+        self.buffer = bytearray() # encoded records waiting for the writer
+        self.unwritten = {} # seq -> HistoryEntry, until its batch is on disk
+        self.file = None
+        self.map = None
+
+    @property
+    def last_seq(self):
+        return self.first_seq + len(self.offsets) - 1
+
+    def read(self, seq):
+        entry = self.unwritten.get(seq)
+        if entry is not None:
+            return entry
+        offset = self.offsets[seq - self.first_seq]
+        if self.map is None or len(self.map) < self.written:
+            self.remap()
+        line_size, targets_size, seq, timestamp = RECORD.unpack_from(self.map, offset)
+        start = offset + RECORD.size
+        targets = self.map[start:start + targets_size].decode('utf-8').split('\n') if targets_size else None
+        line = self.map[start + targets_size:start + targets_size + line_size].decode('utf-8')
+        return history.HistoryEntry(seq, timestamp, targets, line)
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class RoomLog():
+    # Drop-in for history.RoomHistory, backed by a ChatLogStore
+    def __init__(self, store, directory, max_messages=500, max_age=None, clock=time.time):
+        self.store = store
+        self.directory = directory
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.clock = clock
+        self.segments = []
+        self.seq = 0
+        self.public_seqs = array.array('Q')
+        self.by_recipient = {} # username -> array of seqs
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+        self.retain()
+
+    def __len__(self):
+        if not self.segments:
+            return 0
+        return self.seq - self.first_visible() + 1
+
+    def __iter__(self):
+        if not self.segments:
+            return iter(())
+        return (self.read(seq) for seq in range(self.first_visible(), self.seq + 1))
+
+    # Writing
+
+    def append(self, line, targets=None):
+        self.seq += 1
+        now = self.clock()
+        names = [recipient(client) for client in targets] if targets else None
+        target_bytes = '\n'.join(names).encode('utf-8') if names else b''
+        line_bytes = line.encode('utf-8')
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or segment.size >= self.store.segment_bytes:
+            segment = self.new_segment()
+        segment.offsets.append(segment.size)
+        segment.times.append(now)
+        segment.buffer += RECORD.pack(len(line_bytes), len(target_bytes), self.seq, now)
+        segment.buffer += target_bytes
+        segment.buffer += line_bytes
+        segment.size += RECORD.size + len(target_bytes) + len(line_bytes)
+        entry = history.HistoryEntry(self.seq, now, names, line)
+        segment.unwritten[self.seq] = entry
+        if names:
+            for name in names:
+                seqs = self.by_recipient.get(name)
+                if seqs is None:
+                    seqs = self.by_recipient[name] = array.array('Q')
+                seqs.append(self.seq)
+        else:
+            self.public_seqs.append(self.seq)
+        self.store.appended(self, segment)
+        if len(self.segments) > 1 and self.segments[0].last_seq < self.first_visible():
+            self.retain()
+        return entry
+
+    def new_segment(self):
+        segment = Segment(os.path.join(self.directory, '{:020d}.log'.format(self.seq)), self.seq)
+        self.segments.append(segment)
+        return segment
+
+    def retain(self):
+        # Drop segments with nothing left in the window; the newest one is always kept
+        if not self.segments:
+            return
+        first = self.first_visible()
+        dropped = 0
+        while len(self.segments) > 1 and self.segments[0].last_seq < first:
+            self.store.delete(self.segments.pop(0))
+            dropped += 1
+        if not dropped or not self.segments:
+            return
+        oldest = self.segments[0].first_seq
+        del self.public_seqs[:bisect.bisect_left(self.public_seqs, oldest)]
+        for name, seqs in list(self.by_recipient.items()):
+            del seqs[:bisect.bisect_left(seqs, oldest)]
+            if not seqs:
+                del self.by_recipient[name]
+
+    # Reading
+
+    def first_visible(self):
+        first = max(self.segments[0].first_seq, self.seq - self.max_messages + 1)
+        if self.max_age is not None:
+            oldest = self.clock() - self.max_age
+            for segment in self.segments:
+                if segment.last_seq < first or segment.times[-1] < oldest:
+                    continue
+                index = bisect.bisect_left(segment.times, oldest, max(0, first - segment.first_seq))
+                return segment.first_seq + index
+            return self.seq + 1
+        return first
+
+    def segment(self, seq):
+        for segment in reversed(self.segments): # reads are nearly always of recent records
+            if segment.first_seq <= seq:
+                return segment
+
+    def read(self, seq):
+        return self.segment(seq).read(seq)
+
+    def visible_seqs(self, client, before=None, limit=None):
+        # Newest seqs visible to client with seq < before, newest first; and whether older ones exist
+        if not self.segments:
+            return [], False
+        first = self.first_visible()
+        end = self.seq + 1 if before is None else min(before, self.seq + 1)
+        public = self.public_seqs
+        received = self.by_recipient.get(recipient(client), ())
+        i, i_start = bisect.bisect_left(public, end), bisect.bisect_left(public, first)
+        j, j_start = bisect.bisect_left(received, end), bisect.bisect_left(received, first)
+        seqs = []
+        while (limit is None or len(seqs) < limit) and (i > i_start or j > j_start):
+            if j > j_start and (i <= i_start or received[j - 1] > public[i - 1]):
+                j -= 1
+                seqs.append(received[j])
+            else:
+                i -= 1
+                seqs.append(public[i])
+        return seqs, i > i_start or j > j_start
+
+    def render(self, client):
+        seqs, more = self.visible_seqs(client)
+        return '\n'.join([self.read(seq).line for seq in reversed(seqs)])
+
+    def page(self, client, before=None, limit=50):
+        # The newest `limit` entries visible to client with seq < before, oldest first
+        seqs, more = self.visible_seqs(client, before, limit)
+        return [(seq, self.read(seq).line) for seq in reversed(seqs)], more
+
+    # Recovery
+
+    def recover(self):
+        names = sorted([name for name in os.listdir(self.directory) if name.endswith('.log')])
+        for name in names:
+            path = os.path.join(self.directory, name)
+            segment = Segment(path, int(name[:-4]), os.path.getsize(path))
+            if self.segments and segment.first_seq != self.seq + 1:
+                logger.warning('Chat log {}: gap before {}, dropping older segments', self.directory, name)
+                for old in self.segments:
+                    self.store.delete(old)
+                self.segments = []
+                self.public_seqs = array.array('Q')
+                self.by_recipient = {}
+            self.scan(segment)
+            if not segment.offsets:
+                segment.close()
+                os.remove(path)
+                continue
+            self.segments.append(segment)
+            self.seq = segment.last_seq
+
+    def scan(self, segment):
+        if not segment.size:
+            return
+        segment.remap()
+        data = segment.map
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            line_size, targets_size, seq, timestamp = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + targets_size + line_size
+            if end > len(data) or seq != segment.first_seq + len(segment.offsets):
+                break
+            segment.offsets.append(offset)
+            segment.times.append(timestamp)
+            if targets_size:
+                start = offset + RECORD.size
+                for name in data[start:start + targets_size].decode('utf-8').split('\n'):
+                    seqs = self.by_recipient.get(name)
+                    if seqs is None:
+                        seqs = self.by_recipient[name] = array.array('Q')
+                    seqs.append(seq)
+            else:
+                self.public_seqs.append(seq)
+            offset = end
+        if offset < segment.size:
+            logger.warning('Chat log {}: cutting {} torn bytes off the end', segment.path, segment.size - offset)
+            segment.close()
+            os.truncate(segment.path, offset)
+            segment.size = segment.written = offset
+
+
+class ChatLogStore():
+    # Opens the RoomLogs under directory and writes their records in batches off the loop
+    def __init__(self, directory, loop=None, segment_bytes=4 * 1024 * 1024, flush_interval=0.05, fsync=False):
+        self.directory = directory
+        self.loop = loop or asyncio.get_event_loop()
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.logs = {} # key -> RoomLog
+        self.dirty = {} # segment -> its RoomLog, with records waiting for the writer
+        self.deleted = [] # paths of dropped segments, removed by the writer
+        self.flush_handle = None
+        self.writing = None # future of the batch being written
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='chatlog')
+        os.makedirs(directory, exist_ok=True)
+
+        self.records = metrics.Counter('skeleton_chatlog_records_total', 'Chat log records appended')
+        self.flush_seconds = metrics.Histogram('skeleton_chatlog_flush_seconds', 'Time the writer thread took to write a batch of chat log records',
+            buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+
+    def open(self, key, max_messages=500, max_age=None):
+        # The same RoomLog for every room opened under key, so a room that is recreated keeps its history
+        room_log = self.logs.get(key)
+        if room_log is None:
+            path = os.path.join(self.directory, urllib.parse.quote(key, safe=''))
+            room_log = self.logs[key] = RoomLog(self, path, max_messages, max_age)
+        return room_log
+
+    def unwritten(self):
+        return sum([len(segment.unwritten) for segment in self.dirty])
+
+    def appended(self, room_log, segment):
+        self.records.inc()
+        self.dirty[segment] = room_log
+        if not self.flush_handle and not self.writing:
+            self.flush_handle = self.loop.call_later(self.flush_interval, self.flush)
+
+    def delete(self, segment):
+        self.dirty.pop(segment, None)
+        segment.close()
+        self.deleted.append(segment.path)
+
+    def take_batch(self):
+        batch = []
+        for segment in self.dirty:
+            batch.append((segment, segment.path, bytes(segment.buffer), list(segment.unwritten)))
+            segment.buffer = bytearray()
+        self.dirty = {}
+        deleted, self.deleted = self.deleted, []
+        return batch, deleted
+
+    def flush(self):
+        self.flush_handle = None
+        if self.writing or not (self.dirty or self.deleted):
+            return
+        batch, deleted = self.take_batch()
+        self.writing = self.loop.run_in_executor(self.executor, self.write, batch, deleted)
+        self.writing.add_done_callback(lambda future: self.written_batch(batch, future))
+
+    def write(self, batch, deleted):
+        # Writer thread: only file I/O, no shared state
+        started = time.perf_counter()
+        for segment, path, data, seqs in batch:
+            if data:
+                with open(path, 'ab') as f:
+                    f.write(data)
+                    if self.fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+        for path in deleted:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return time.perf_counter() - started
+
+    def written_batch(self, batch, future):
+        self.writing = None
+        try:
+            seconds = future.result()
+        except Exception:
+            # The records stay readable from memory; their segments are not appended to again
+            logger.exception('Could not write chat log batch of {} segments', len(batch))
+            for segment, path, data, seqs in batch:
+                segment.size = max(segment.size, self.segment_bytes)
+        else:
+            for segment, path, data, seqs in batch:
+                segment.written += len(data)
+                for seq in seqs:
+                    segment.unwritten.pop(seq, None)
+            self.flush_seconds.observe(seconds)
+        if self.dirty or self.deleted:
+            self.flush_handle = self.loop.call_later(self.flush_interval, self.flush)
+
+    def close(self):
+        # Writes whatever is left on the calling thread
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.executor.shutdown(wait=True) # the batch being written is on disk after this
+        batch, deleted = self.take_batch()
+        self.write(batch, deleted)
+        for room_log in self.logs.values():
+            for segment in room_log.segments:
+                segment.close()
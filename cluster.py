@@ -0,0 +1,77 @@
+import asyncio
+import logs
+import multiprocessing
+import socket
+
+import broker
+
+logger = logs.get('cluster')
+
+# Multi-process mode: N worker processes each run a ChatServer node on the same port (SO_REUSEPORT,
+# the kernel spreads connections between them) plus a private port of their own, worker_port_base +
+# index, that clients are redirected to. The nodes act as one game through a broker (see broker.py):
+# the supervisor runs a local BrokerServer unless broker_address points at a shared one, in which
+# case workers on several hosts join the same game.
+
+
+def run_worker(server_class, node, host, port, address, broker_address, server_kwargs):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    link = broker.SocketBroker(node, address, broker_address, loop=loop)
+    worker(server_class, link, host, port, server_kwargs).run()
+
+
+def worker(server_class, link, host, port, server_kwargs):
+    # One node of the game on the link's loop; every worker serves the same public port
+    return server_class(loop=link.loop, host=host, port=port, broker=link, **server_kwargs)
+
+
+def worker_specs(workers, worker_port_base, advertise_host, node_prefix, server_kwargs):
+    # (node name, address clients are redirected to, server kwargs) of each worker; each serves its
+    # own metrics, on metrics_port + index
+    server_kwargs = dict(server_kwargs)
+    metrics_port = server_kwargs.pop('metrics_port', None)
+    specs = []
+    for index in range(workers):
+        kwargs = dict(server_kwargs)
+        if metrics_port is not None:
+            kwargs['metrics_port'] = int(metrics_port) + index
+        specs.append(('{}{}'.format(node_prefix, index), (advertise_host, worker_port_base + index), kwargs))
+    return specs
+
+
+def run(workers, host, port, server_class, worker_port_base=None, broker_address=None, advertise_host='127.0.0.1', node_prefix=None, **server_kwargs):
+    # Supervisor: one server_class (a ChatServer) process per worker. advertise_host is where clients
+    # reach this box; node names must be unique across the game, hence the host name prefix
+    worker_port_base = worker_port_base or int(port) + 1
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    broker_server = None
+    if not broker_address:
+        broker_server = broker.BrokerServer(loop)
+        loop.run_until_complete(broker_server.start('127.0.0.1', 0))
+        broker_address = ('127.0.0.1', broker_server.port)
+    if not node_prefix:
+        node_prefix = 'w' if broker_server else '{}-'.format(socket.gethostname().replace('.', '-'))
+    logger.info('Starting {} workers on port {}, broker at {}', workers, port, broker_address)
+
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for index, (node, address, kwargs) in enumerate(worker_specs(workers, worker_port_base, advertise_host, node_prefix, server_kwargs)):
+        process = context.Process(target=run_worker, name='worker-{}'.format(index),
+            args=(server_class, node, host, int(port), address, tuple(broker_address), kwargs))
+        process.start()
+        processes.append(process)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if broker_server:
+            broker_server.close()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        loop.close()
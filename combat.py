@@ -0,0 +1,415 @@
+import asyncio
+import logs
+import uuid
+
+import numpy as np
+
+logger = logs.get('combat')
+
+IDLE, ATTACKING, DEFENDING, DEAD = range(4)
+STATE_NAMES = ['idle', 'attacking', 'defending', 'dead']
+NO_TARGET = -1
+NEVER = np.inf
+
+
+class CombatEngine():
+    # Struct-of-arrays combat engine: every creature in the process is a row in columnar arrays and
+    # step() resolves all due actions, damage, interrupts and deaths for all fights in vectorized passes.
+    #
+    # Within one tick, actions complete before damage lands: a creature whose attack and death fall in
+    # the same tick still lands its hit, and a defense that ends in a tick no longer blocks that tick.
+    # Damage from several attackers is summed and reported with a single creature_health_report.
+    def __init__(self, loop=None, tick=0.05, capacity=1024, seed=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.tick = tick
+        self.rng = np.random.default_rng(seed)
+        self.capacity = 0
+        self.size = 0 # rows [0, size) have been handed out at some point
+        self.free_rows = []
+        self.tick_handle = None
+
+        self.used = np.zeros(0, dtype=bool)
+        self.health = np.zeros(0, dtype=np.int32)
+        self.max_health = np.zeros(0, dtype=np.int32)
+        self.damage = np.zeros(0, dtype=np.int32)
+        self.state = np.zeros(0, dtype=np.int8)
+        self.defense = np.zeros(0, dtype=bool)
+        self.target = np.zeros(0, dtype=np.int32)
+        self.deadline = np.zeros(0, dtype=np.float64)
+        self.action_time = np.zeros(0, dtype=np.float64)
+        self.ai = np.zeros(0, dtype=bool)
+        self.think_interval = np.zeros(0, dtype=np.float64)
+        self.next_think = np.zeros(0, dtype=np.float64)
+
+        # Per-row Python objects that don't vectorize
+        self.views = []
+        self.emitters = []
+        self.candidates = [] # AI rows only: set of rows the skeleton may pick as target
+        self.watchers = [] # AI rows that have this row among their candidates
+
+        self.grow(capacity)
+
+    def __len__(self):
+        return self.size - len(self.free_rows)
+
+    def grow(self, capacity):
+        def resized(column, fill):
+            new = np.full(capacity, fill, dtype=column.dtype)
+            new[:len(column)] = column
+            return new
+        self.used = resized(self.used, False)
+        self.health = resized(self.health, 0)
+        self.max_health = resized(self.max_health, 0)
+        self.damage = resized(self.damage, 0)
+        self.state = resized(self.state, DEAD)
+        self.defense = resized(self.defense, False)
+        self.target = resized(self.target, NO_TARGET)
+        self.deadline = resized(self.deadline, NEVER)
+        self.action_time = resized(self.action_time, 0)
+        self.ai = resized(self.ai, False)
+        self.think_interval = resized(self.think_interval, 0)
+        self.next_think = resized(self.next_think, NEVER)
+        extra = capacity - self.capacity
+        self.views.extend([None] * extra)
+        self.emitters.extend([None] * extra)
+        self.candidates.extend([None] * extra)
+        self.watchers.extend([None] * extra)
+        self.capacity = capacity
+
+    def add(self, view_class, name, uid=None, max_health=100, damage=5, action_time=3, ai=False, think_interval=1, **kwargs):
+        if self.free_rows:
+            row = self.free_rows.pop()
+        else:
+            if self.size == self.capacity:
+                self.grow(self.capacity * 2)
+            row = self.size
+            self.size += 1
+        self.used[row] = True
+        self.health[row] = max_health
+        self.max_health[row] = max_health
+        self.damage[row] = damage
+        self.state[row] = IDLE
+        self.defense[row] = False
+        self.target[row] = NO_TARGET
+        self.deadline[row] = NEVER
+        self.action_time[row] = action_time
+        self.ai[row] = ai
+        self.think_interval[row] = think_interval
+        self.next_think[row] = NEVER
+        self.candidates[row] = set() if ai else None
+        self.watchers[row] = set()
+        view = view_class(self, row, uid or str(uuid.uuid4())[:8], name, **kwargs)
+        self.views[row] = view
+        self.emitters[row] = None
+        self.ensure_ticking()
+        return view
+
+    def create_skeleton(self, name, uid=None, max_health=100, damage=5, action_time=3, think_interval=1):
+        return self.add(SkeletonView, name, uid, max_health, damage, action_time, ai=True, think_interval=think_interval)
+
+    def create_player(self, name, uid=None, max_health=100, damage=20, action_time=2, target=None, client=None):
+        player = self.add(PlayerView, name, uid, max_health, damage, action_time, client=client)
+        player.target = target
+        return player
+
+    def release(self, view):
+        row = view.row
+        if not self.used[row] or self.views[row] is not view: # already released, maybe reused since
+            return
+        self.used[row] = False
+        self.state[row] = DEAD
+        self.ai[row] = False
+        self.deadline[row] = NEVER
+        self.next_think[row] = NEVER
+        self.target[row] = NO_TARGET
+        self.target[:self.size][self.target[:self.size] == row] = NO_TARGET
+        for ai_row in self.watchers[row]:
+            self.candidates[ai_row].discard(row)
+        for candidate in self.candidates[row] or []:
+            self.watchers[candidate].discard(row)
+        self.views[row] = None
+        self.emitters[row] = None
+        self.candidates[row] = None
+        self.watchers[row] = None
+        self.free_rows.append(row)
+
+    def emit(self, row, msg_type, *args):
+        emitter = self.emitters[row]
+        if emitter is not None:
+            emitter(self.views[row], msg_type, *args)
+
+    def alive(self, row):
+        return bool(self.used[row]) and self.state[row] != DEAD
+
+    # Scalar transitions, used by the views for player commands and by step() for event emission
+
+    def begin_action(self, row, state, now=None):
+        now = self.loop.time() if now is None else now
+        self.state[row] = state
+        self.deadline[row] = now + self.action_time[row]
+        if state == ATTACKING:
+            self.emit(row, 'creature_attack_started')
+        else:
+            self.defense[row] = True
+            self.emit(row, 'creature_def')
+        self.emit(row, 'creature_changed_state', STATE_NAMES[state])
+
+    def interrupt(self, row):
+        self.state[row] = IDLE
+        self.deadline[row] = NEVER
+        self.emit(row, 'creature_action_interrupted')
+        self.emit(row, 'creature_changed_state', 'idle')
+
+    def die(self, row):
+        self.state[row] = DEAD
+        self.defense[row] = False
+        self.deadline[row] = NEVER
+        self.emit(row, 'creature_death')
+        self.emit(row, 'creature_changed_state', 'dead')
+
+    def take_damage(self, row, dmg):
+        if self.defense[row]:
+            self.emit(row, 'creature_blocked_damage')
+            return
+        if self.state[row] == ATTACKING:
+            self.interrupt(row)
+        self.emit(row, 'creature_took_damage', dmg)
+        self.health[row] -= dmg
+        self.emit(row, 'creature_health_report', int(self.health[row]))
+        if self.health[row] <= 0 and self.state[row] != DEAD:
+            self.die(row)
+
+    # Vectorized tick
+
+    def step(self, now=None):
+        now = self.loop.time() if now is None else now
+        n = self.size
+        used = self.used[:n]
+        state = self.state[:n]
+
+        due = used & (self.deadline[:n] <= now)
+        defenders = np.flatnonzero(due & (state == DEFENDING))
+        attackers = np.flatnonzero(due & (state == ATTACKING))
+
+        # 1. Complete every due action
+        self.state[defenders] = IDLE
+        self.defense[defenders] = False
+        self.deadline[defenders] = NEVER
+        self.state[attackers] = IDLE
+        self.deadline[attackers] = NEVER
+
+        # 2. Resolve all landed attacks at once
+        targets = self.target[attackers]
+        safe_targets = np.where(targets >= 0, targets, 0)
+        valid = (targets >= 0) & self.used[safe_targets] & (self.state[safe_targets] != DEAD)
+        hit_attackers = attackers[valid]
+        hit_targets = targets[valid]
+        blocked = self.defense[hit_targets]
+        landed_targets = hit_targets[~blocked]
+        total = np.bincount(landed_targets, weights=self.damage[hit_attackers[~blocked]], minlength=n).astype(np.int32)
+        wounded = np.unique(landed_targets)
+        interrupted = wounded[self.state[wounded] == ATTACKING]
+        self.state[interrupted] = IDLE
+        self.deadline[interrupted] = NEVER
+        self.health[:n] -= total
+        died = wounded[self.health[wounded] <= 0]
+        self.state[died] = DEAD
+        self.defense[died] = False
+
+        # 3. Let AI rows decide, all idle skeletons with a living target at once
+        thinking = np.flatnonzero(used & self.ai[:n] & (state == IDLE) & (self.next_think[:n] <= now))
+        retarget = []
+        if len(thinking):
+            current = self.target[thinking]
+            safe_current = np.where(current >= 0, current, 0)
+            has_target = (current >= 0) & self.used[safe_current] & (self.state[safe_current] != DEAD)
+            for row in thinking[~has_target]:
+                living = [c for c in self.candidates[row] if self.used[c] and self.state[c] != DEAD]
+                if living:
+                    self.target[row] = living[self.rng.integers(len(living))]
+                    retarget.append(row)
+            current = self.target[thinking]
+            safe_current = np.where(current >= 0, current, 0)
+            thinking = thinking[(current >= 0) & self.used[safe_current] & (self.state[safe_current] != DEAD)]
+        dice = self.rng.integers(0, 2, size=len(thinking))
+        decided_defense = thinking[dice == 0]
+        decided_attack = thinking[dice == 1]
+        self.state[decided_defense] = DEFENDING
+        self.defense[decided_defense] = True
+        self.state[decided_attack] = ATTACKING
+        self.deadline[thinking] = now + self.action_time[thinking]
+        self.next_think[thinking] = now + self.think_interval[thinking]
+
+        # 4. Emit the resulting events. Rows go through tolist() first: indexing the per-row lists
+        # with numpy integers costs more than the emit itself
+        emit = self.emit
+        for row in defenders.tolist():
+            emit(row, 'creature_no_def')
+            emit(row, 'creature_changed_state', 'idle')
+        for row, target, was_blocked, dmg in zip(hit_attackers.tolist(), hit_targets.tolist(), blocked.tolist(), self.damage[hit_attackers].tolist()):
+            emit(row, 'creature_attack_finished')
+            if was_blocked:
+                emit(target, 'creature_blocked_damage')
+            else:
+                emit(target, 'creature_took_damage', dmg)
+        for row in attackers[~valid].tolist():
+            emit(row, 'creature_attack_finished')
+        for row in interrupted.tolist():
+            emit(row, 'creature_action_interrupted')
+            emit(row, 'creature_changed_state', 'idle')
+        for row, health in zip(wounded.tolist(), self.health[wounded].tolist()):
+            emit(row, 'creature_health_report', health)
+        for row in died.tolist():
+            emit(row, 'creature_death')
+            emit(row, 'creature_changed_state', 'dead')
+        for row in attackers[self.state[attackers] == IDLE].tolist():
+            emit(row, 'creature_changed_state', 'idle')
+        for row in retarget:
+            emit(row, 'ai_new_target', self.views[self.target[row]])
+        for row in decided_defense.tolist():
+            emit(row, 'creature_def')
+            emit(row, 'creature_changed_state', 'defending')
+        for row in decided_attack.tolist():
+            emit(row, 'creature_attack_started')
+            emit(row, 'creature_changed_state', 'attacking')
+
+    def ensure_ticking(self):
+        if not self.tick_handle:
+            self.tick_handle = self.loop.call_later(self.tick, self.on_tick)
+
+    def on_tick(self):
+        self.tick_handle = None
+        try:
+            self.step()
+        except Exception:
+            logger.exception('Error in combat engine step')
+        if len(self):
+            self.ensure_ticking()
+
+    def close(self):
+        if self.tick_handle:
+            self.tick_handle.cancel()
+            self.tick_handle = None
+
+
+class CreatureView():
+    # Thin handle over one engine row, exposing the same attributes as skeletons.Creature
+    def __init__(self, engine, row, uid, name):
+        self.engine = engine
+        self.row = row
+        self.uid = uid
+        self.name = name
+
+    @property
+    def health(self):
+        return int(self.engine.health[self.row])
+
+    @property
+    def max_health(self):
+        return int(self.engine.max_health[self.row])
+
+    @property
+    def damage(self):
+        return int(self.engine.damage[self.row])
+
+    @property
+    def released(self):
+        # The row went back to the engine and may belong to another creature by now
+        return self.engine.views[self.row] is not self
+
+    @property
+    def alive(self):
+        return not self.released and self.engine.alive(self.row)
+
+    @property
+    def state(self):
+        return STATE_NAMES[self.engine.state[self.row]]
+
+    @property
+    def defense(self):
+        return bool(self.engine.defense[self.row])
+
+    @property
+    def target(self):
+        row = self.engine.target[self.row]
+        if row == NO_TARGET:
+            return None
+        return self.engine.views[row]
+
+    @target.setter
+    def target(self, creature):
+        self.engine.target[self.row] = creature.row if creature else NO_TARGET
+
+    @property
+    def emit_message(self):
+        return self.engine.emitters[self.row]
+
+    @emit_message.setter
+    def emit_message(self, callback):
+        self.engine.emitters[self.row] = callback
+
+    def full_report(self):
+        rep = [str(x) for x in [self.uid, self.name, self.alive, self.max_health, self.health, self.state]]
+        if self.target:
+            rep.append(str(self.target.name))
+        return rep
+
+    def take_damage(self, dmg):
+        self.engine.take_damage(self.row, dmg)
+
+    def __repr__(self):
+        return 'creature|{}|{}|row {}'.format(self.uid, self.name, self.row)
+
+
+class SkeletonView(CreatureView):
+    @property
+    def active(self):
+        return bool(self.engine.ai[self.row]) and self.alive
+
+    @property
+    def targets(self):
+        if self.released:
+            return []
+        return [self.engine.views[row] for row in self.engine.candidates[self.row]]
+
+    def add_target(self, creature):
+        if self.released or creature.released:
+            return
+        self.engine.candidates[self.row].add(creature.row)
+        self.engine.watchers[creature.row].add(self.row)
+
+    def remove_target(self, creature):
+        # Releasing either row already dropped it from the candidates
+        if self.released or creature.released:
+            return
+        self.engine.candidates[self.row].discard(creature.row)
+        self.engine.watchers[creature.row].discard(self.row)
+        if self.target is creature:
+            self.target = None
+
+    async def run(self):
+        self.engine.emit(self.row, 'creature_start')
+        self.engine.next_think[self.row] = self.engine.loop.time()
+
+    def stop(self):
+        self.engine.release(self)
+
+
+class PlayerView(CreatureView):
+    def __init__(self, engine, row, uid, name, client=None):
+        super(PlayerView, self).__init__(engine, row, uid, name)
+        self.client = client
+
+    async def attack(self):
+        self.act(ATTACKING, "Can't attack now!")
+
+    async def defend(self):
+        self.act(DEFENDING, "Can't defend now!")
+
+    def act(self, state, refusal):
+        target = self.target
+        if self.alive and target and target.alive:
+            if self.engine.state[self.row] == IDLE:
+                self.engine.begin_action(self.row, state)
+            else:
+                self.engine.emit(self.row, "ply_notify", refusal)
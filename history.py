@@ -0,0 +1,144 @@
+import bisect
+import collections
+import time
+
+
+class HistoryEntry():
+    __slots__ = ('seq', 'timestamp', 'targets', 'line')
+
+    def __init__(self, seq, timestamp, targets, line):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.targets = targets
+        self.line = line
+
+
+class RoomHistory():
+    # Bounded room history: a ring of the last max_messages entries, none older than max_age seconds.
+    # Public lines are rendered once on append and kept as one cached text block that is extended and
+    # trimmed incrementally; targeted lines are indexed per recipient. Rendering a client's history
+    # costs O(messages targeted at that client) on top of copying the cached block.
+    def __init__(self, max_messages=500, max_age=None, clock=time.time):
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.clock = clock
+        self.seq = 0
+        self.entries = collections.deque()
+        self.by_recipient = {}
+
+        # Public lines, with their absolute end offsets in the rendered stream (each line plus its '\n')
+        self.public_seqs = []
+        self.public_ends = []
+        self.public_head = 0 # index of the oldest live public line
+        self.stream_start = 0 # absolute offset of the oldest live public line
+        self.stream_end = 0
+        self.block = '' # rendered public lines from block_start to block_end
+        self.block_start = 0
+        self.pending = [] # public lines appended since the block was last rendered
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def append(self, line, targets=None):
+        self.seq += 1
+        entry = HistoryEntry(self.seq, self.clock(), targets, line)
+        self.entries.append(entry)
+        if targets:
+            for client in targets:
+                self.by_recipient.setdefault(client, collections.deque()).append(entry)
+        else:
+            self.stream_end += len(line) + 1
+            self.public_seqs.append(entry.seq)
+            self.public_ends.append(self.stream_end)
+            self.pending.append(line)
+            if len(self.pending) > self.max_messages:
+                self.render_public()
+        self.trim()
+        return entry
+
+    def trim(self):
+        while len(self.entries) > self.max_messages:
+            self.evict()
+        if self.max_age is not None:
+            oldest = self.clock() - self.max_age
+            while self.entries and self.entries[0].timestamp < oldest:
+                self.evict()
+
+    def evict(self):
+        entry = self.entries.popleft()
+        if entry.targets:
+            for client in entry.targets:
+                received = self.by_recipient[client]
+                received.popleft()
+                if not received:
+                    del self.by_recipient[client]
+            return
+        self.stream_start = self.public_ends[self.public_head]
+        self.public_head += 1
+        if self.public_head > 64 and self.public_head * 2 > len(self.public_seqs):
+            del self.public_seqs[:self.public_head]
+            del self.public_ends[:self.public_head]
+            self.public_head = 0
+
+    def render_public(self):
+        # Extend the cached block with new lines and drop the evicted prefix, never re-rendering old lines
+        if self.pending:
+            self.block += ''.join([line + '\n' for line in self.pending])
+            self.pending = []
+        if self.block_start < self.stream_start:
+            self.block = self.block[self.stream_start - self.block_start:]
+            self.block_start = self.stream_start
+        return self.block
+
+    def public_offset(self, seq):
+        # Offset in the cached block where public lines newer than seq start
+        index = bisect.bisect_left(self.public_seqs, seq, self.public_head)
+        if index == self.public_head:
+            return 0
+        return self.public_ends[index - 1] - self.block_start
+
+    def render(self, client):
+        self.trim()
+        block = self.render_public()
+        received = self.by_recipient.get(client)
+        if not received:
+            return block[:-1]
+        parts = []
+        position = 0
+        for entry in received:
+            offset = self.public_offset(entry.seq)
+            parts.append(block[position:offset])
+            parts.append(entry.line + '\n')
+            position = offset
+        parts.append(block[position:])
+        return ''.join(parts)[:-1]
+
+    def page(self, client, before=None, limit=50):
+        # The newest `limit` entries visible to client with seq < before, oldest first
+        self.trim()
+        lines = []
+        public = len(self.public_seqs)
+        if before is not None:
+            public = bisect.bisect_left(self.public_seqs, before, self.public_head)
+        received = [entry for entry in self.by_recipient.get(client, ()) if before is None or entry.seq < before]
+        index = public - 1
+        while len(lines) < limit and (index >= self.public_head or received):
+            if received and (index < self.public_head or received[-1].seq > self.public_seqs[index]):
+                entry = received.pop()
+                lines.append((entry.seq, entry.line))
+            else:
+                lines.append((self.public_seqs[index], self.public_line(index)))
+                index -= 1
+        lines.reverse()
+        more = index >= self.public_head or bool(received)
+        return lines, more
+
+    def public_line(self, index):
+        self.render_public()
+        start = self.public_ends[index - 1] if index > 0 else self.stream_start
+        if index == self.public_head:
+            start = self.stream_start
+        return self.block[start - self.block_start:self.public_ends[index] - self.block_start - 1]
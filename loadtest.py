@@ -0,0 +1,460 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+import websockets
+import websockets.exceptions
+
+import wire
+
+# Headless load generator: thousands of bot sessions in one process speaking the same protocol as
+# client.html. Bots answer the username prompt, follow redirects and resume sessions, and run one of:
+#   chat   - lobby chat, latency until the server echoes the line back
+#   fight  - '::skeleton' with a partner, '::attack'/'::defense' until someone dies, '::leave', again
+#   storm  - drop the connection every few seconds and reconnect, resuming the session
+# Latency of '::attack' is measured until the bot's own creature_attack_started, '::defense' until
+# its creature_def. Results are printed and saved as JSON; --compare prints the change against an
+# earlier results file.
+
+SCENARIOS = ['chat', 'fight', 'storm']
+REFUSALS = ("Can't attack now!", "Can't defend now!")
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of sorted values
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class Stats():
+    def __init__(self):
+        self.counters = {}
+        self.latencies = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, seconds):
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def latency_summary(self):
+        summary = {}
+        for name, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            summary[name] = {
+                'count': len(values),
+                'mean': sum(values) / len(values) * 1000,
+                'p50': percentile(values, 50) * 1000,
+                'p95': percentile(values, 95) * 1000,
+                'p99': percentile(values, 99) * 1000,
+                'max': values[-1] * 1000,
+            }
+        return summary
+
+
+class Waiter():
+    __slots__ = ('match', 'future')
+
+    def __init__(self, match, future):
+        self.match = match
+        self.future = future
+
+
+class Bot():
+    def __init__(self, test, index, scenario):
+        self.test = test
+        self.config = test.config
+        self.stats = test.stats
+        self.loop = test.loop
+        self.index = index
+        self.scenario = scenario
+        self.rng = random.Random(self.config.seed * 100003 + index)
+        self.username = '{}{}'.format(self.config.prefix, index)
+        self.host = self.config.host
+        self.port = self.config.port
+        self.websocket = None
+        self.reader = None
+        self.codec = None
+        self.waiters = []
+
+        self.uid = None
+        self.session_token = None
+        self.frame_seq = 0
+        self.counting_frames = False
+        self.resuming = False
+        self.handoff_token = None
+        self.redirected = False
+        self.room_type = None
+        self.skeleton_uid = None
+        self.alive = True
+        self.skeleton_alive = True
+
+    # Connection handling
+
+    async def connect(self, resume=False):
+        # Open a connection and wait until it is registered (or resumed); returns False on failure
+        self.resuming = resume and self.session_token is not None
+        self.counting_frames = False # the new connection's prompt isn't part of the session
+        started = self.loop.time()
+        if not await self.open():
+            return False
+        kinds = ('registered', 'resumed', 'resume_failed')
+        result = await self.wait_for(lambda kind, uid, msg_type, args: msg_type in kinds, self.config.timeout)
+        if result is None:
+            self.stats.count('connect_timeouts')
+            return False
+        msg_type = result[2]
+        if msg_type == 'resume_failed':
+            self.stats.count('resume_failed')
+            result = await self.wait_for(lambda kind, uid, msg_type, args: msg_type == 'registered', self.config.timeout)
+            if result is None:
+                self.stats.count('connect_timeouts')
+                return False
+            msg_type = 'registered'
+        self.stats.record('resume' if msg_type == 'resumed' else 'connect', self.loop.time() - started)
+        self.test.connected += 1
+        return True
+
+    async def open(self):
+        subprotocols = [wire.SUBPROTOCOL] if self.config.binary else None
+        try:
+            self.websocket = await websockets.connect('ws://{}:{}'.format(self.host, self.port), subprotocols=subprotocols)
+        except (OSError, websockets.exceptions.WebSocketException, asyncio.TimeoutError):
+            self.stats.count('connect_errors')
+            return False
+        self.stats.count('connections')
+        self.reader = self.loop.create_task(self.read(self.websocket))
+        return True
+
+    async def disconnect(self):
+        websocket, self.websocket = self.websocket, None
+        if websocket:
+            await websocket.close()
+        if self.reader and not self.reader.done():
+            self.reader.cancel()
+
+    async def read(self, websocket):
+        try:
+            async for frame in websocket:
+                self.stats.count('frames')
+                self.stats.count('bytes', len(frame))
+                if self.counting_frames:
+                    self.frame_seq += 1
+                self.handle_frame(frame)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        if self.redirected and websocket is self.websocket:
+            # The server asked us to reconnect elsewhere, usually to join a room hosted there
+            self.redirected = False
+            self.counting_frames = False
+            if await self.open():
+                self.stats.count('redirects')
+
+    def handle_frame(self, frame):
+        if isinstance(frame, bytes):
+            for uid, msg_type, args in self.codec.decode(frame):
+                self.handle_event(uid, msg_type, args)
+        elif frame.startswith('sysbatch|'):
+            for line in frame[len('sysbatch|'):].split('\n'):
+                self.handle_system_message(line)
+        elif frame.startswith('sysmsg|'):
+            self.handle_system_message(frame)
+        else:
+            self.notify('text', None, None, frame)
+
+    def handle_system_message(self, line):
+        parts = line.split('|')
+        self.handle_event(parts[1], parts[2], parts[3:])
+
+    def handle_event(self, uid, msg_type, args):
+        if msg_type == 'protocol':
+            self.codec = wire.Codec(args[1].split(','), args[2].split(','))
+        elif msg_type == 'username_prompt':
+            self.answer_prompt()
+        elif msg_type == 'username_invalid':
+            self.username = '{}{}-{}'.format(self.config.prefix, self.index, self.rng.randrange(10 ** 6))
+        elif msg_type == 'registered':
+            self.uid = args[0]
+            self.session_token = args[2] if len(args) > 2 and args[2] else None
+            self.frame_seq = 1
+            self.counting_frames = True
+            self.room_type = 'lobby'
+        elif msg_type == 'resumed':
+            self.frame_seq = int(args[0])
+            self.counting_frames = True
+        elif msg_type == 'resume_failed':
+            self.session_token = None
+        elif msg_type == 'redirect':
+            self.host, self.port, self.handoff_token = args[0], int(args[1]), args[2] or None
+            self.redirected = True
+        elif msg_type == 'joined_room':
+            self.room_type = args[2]
+            self.alive = self.skeleton_alive = True
+        elif msg_type == 'room_snapshot':
+            for i in range(1, len(args) - 6, 7):
+                if args[i + 1] == 'skeleton':
+                    self.skeleton_uid = args[i]
+        elif msg_type == 'creature_death':
+            if uid == self.uid:
+                self.alive = False
+            elif uid == self.skeleton_uid:
+                self.skeleton_alive = False
+        self.notify('sysmsg', uid, msg_type, args)
+
+    def answer_prompt(self):
+        if self.handoff_token:
+            text, self.handoff_token = '::handoff {}'.format(self.handoff_token), None
+        elif self.resuming:
+            text, self.resuming = '::resume {} {}'.format(self.session_token, self.frame_seq), False
+        else:
+            text = self.username
+        self.loop.create_task(self.send(text))
+
+    async def send(self, text):
+        try:
+            await self.websocket.send(text)
+            self.stats.count('sent')
+            return True
+        except (AttributeError, websockets.exceptions.ConnectionClosed):
+            self.stats.count('send_errors')
+            return False
+
+    def notify(self, kind, uid, msg_type, args):
+        for waiter in list(self.waiters):
+            if not waiter.future.done() and waiter.match(kind, uid, msg_type, args):
+                waiter.future.set_result((kind, uid, msg_type, args))
+
+    async def wait_for(self, match, timeout):
+        waiter = Waiter(match, self.loop.create_future())
+        self.waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.waiters.remove(waiter)
+
+    async def command(self, text, match, name):
+        # Send a command and record how long until the matching frame
+        started = self.loop.time()
+        if not await self.send(text):
+            return None
+        result = await self.wait_for(match, self.config.timeout)
+        if result is None:
+            self.stats.count('{}_timeouts'.format(name))
+        elif result[0] == 'text' and result[3] in REFUSALS:
+            self.stats.count('{}_refused'.format(name))
+        else:
+            self.stats.record(name, self.loop.time() - started)
+        return result
+
+    # Scenarios
+
+    async def run(self):
+        try:
+            if await self.connect():
+                await getattr(self, 'run_{}'.format(self.scenario))()
+        except Exception as e:
+            self.stats.count('bot_errors')
+            if self.config.verbose:
+                print('bot {} failed: {!r}'.format(self.index, e), file=sys.stderr)
+        await self.disconnect()
+
+    def running(self):
+        return self.loop.time() < self.test.deadline
+
+    async def pause(self):
+        await asyncio.sleep(self.config.interval * (0.5 + self.rng.random()))
+
+    async def run_chat(self):
+        n = 0
+        while self.running():
+            n += 1
+            line = '{}: load {} {}'.format(self.username, self.index, n)
+            await self.command('load {} {}'.format(self.index, n), lambda kind, uid, msg_type, args: kind == 'text' and args == line, 'chat')
+            await self.pause()
+
+    def own_event(self, *msg_types):
+        def match(kind, uid, msg_type, args):
+            if kind == 'text':
+                return args in REFUSALS
+            return uid == self.uid and msg_type in msg_types
+        return match
+
+    async def run_fight(self):
+        round = 0
+        while self.running():
+            round += 1
+            # Bots pair up: both of a pair ask for the same skeleton each round
+            room = '{}fight{}-{}'.format(self.config.prefix, self.index // 2, round)
+            joined = await self.command('::skeleton {}'.format(room),
+                lambda kind, uid, msg_type, args: msg_type == 'room_snapshot', 'join')
+            if not joined:
+                await self.pause()
+                continue
+            while self.running() and self.alive and self.skeleton_alive:
+                if self.rng.random() < self.config.attack_ratio:
+                    await self.command('::attack', self.own_event('creature_attack_started'), 'attack')
+                else:
+                    await self.command('::defense', self.own_event('creature_def'), 'defense')
+                await self.pause()
+            self.stats.count('fights')
+            await self.command('::leave', lambda kind, uid, msg_type, args: msg_type == 'joined_room' and args[2] == 'lobby', 'leave')
+
+    async def run_storm(self):
+        while self.running():
+            await asyncio.sleep(self.config.storm_interval * (0.5 + self.rng.random()))
+            await self.disconnect()
+            self.stats.count('storm_drops')
+            if not await self.connect(resume=True):
+                await self.pause()
+                await self.connect()
+
+
+class LoadTest():
+    def __init__(self, config, loop=None):
+        self.config = config
+        self.loop = loop or asyncio.get_event_loop()
+        self.stats = Stats()
+        self.connected = 0
+        self.deadline = None
+
+    def scenario_for(self, rng):
+        weights = self.config.mix
+        pick = rng.random() * sum(weights.values())
+        for scenario in SCENARIOS:
+            pick -= weights.get(scenario, 0)
+            if pick < 0:
+                return scenario
+        return SCENARIOS[0]
+
+    async def run(self):
+        config = self.config
+        rng = random.Random(config.seed)
+        started = self.loop.time()
+        self.deadline = started + config.ramp + config.duration
+        tasks = []
+        for index in range(config.bots):
+            bot = Bot(self, index, self.scenario_for(rng))
+            self.stats.count('bots_{}'.format(bot.scenario))
+            tasks.append(self.loop.create_task(bot.run()))
+            if config.ramp:
+                # Spread the connects evenly over the ramp-up period
+                await asyncio.sleep(max(0, started + config.ramp * (index + 1) / config.bots - self.loop.time()))
+        ramp_elapsed = self.loop.time() - started
+        await asyncio.wait(tasks)
+        elapsed = self.loop.time() - started
+        return self.results(elapsed, ramp_elapsed)
+
+    def results(self, elapsed, ramp_elapsed):
+        counters = self.stats.counters
+        return {
+            'tool': 'loadtest',
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time() - elapsed)),
+            'config': {key: value for key, value in vars(self.config).items() if key not in ('output', 'compare')},
+            'elapsed': elapsed,
+            'counters': counters,
+            'rates': {
+                'connects_per_second': self.connected / elapsed,
+                'ramp_connects_per_second': min(self.connected, self.config.bots) / ramp_elapsed if ramp_elapsed else None,
+                'frames_per_second': counters.get('frames', 0) / elapsed,
+                'bytes_per_second': counters.get('bytes', 0) / elapsed,
+                'commands_per_second': counters.get('sent', 0) / elapsed,
+            },
+            'latency_ms': self.stats.latency_summary(),
+        }
+
+
+def print_results(results):
+    print('{} bots, {:.1f}s'.format(results['config']['bots'], results['elapsed']))
+    for name, value in sorted(results['rates'].items()):
+        if value is not None:
+            print('{:<32} {:>12.1f}'.format(name, value))
+    for name, value in sorted(results['counters'].items()):
+        print('{:<32} {:>12}'.format(name, value))
+    print('{:<12} {:>8} {:>9} {:>9} {:>9} {:>9}'.format('latency ms', 'count', 'p50', 'p95', 'p99', 'max'))
+    for name, summary in results['latency_ms'].items():
+        print('{:<12} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(name, summary['count'], summary['p50'], summary['p95'], summary['p99'], summary['max']))
+
+
+def change(old, new):
+    if not old or new is None:
+        return ''
+    return '{:+.1f}%'.format((new - old) / old * 100)
+
+
+def print_comparison(old, new):
+    print('Compared with run of {}:'.format(old.get('started')))
+    for name, value in sorted(new['rates'].items()):
+        previous = old['rates'].get(name)
+        if value is not None and previous is not None:
+            print('{:<32} {:>12.1f} -> {:>12.1f} {:>9}'.format(name, previous, value, change(previous, value)))
+    for name, summary in new['latency_ms'].items():
+        previous = old['latency_ms'].get(name)
+        if not previous:
+            continue
+        for key in ('p50', 'p95', 'p99'):
+            print('{:<32} {:>12.2f} -> {:>12.2f} {:>9}'.format('{} {} ms'.format(name, key), previous[key], summary[key], change(previous[key], summary[key])))
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if not name in SCENARIOS:
+            raise argparse.ArgumentTypeError('Unknown scenario {}, expected one of {}'.format(name, ', '.join(SCENARIOS)))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Load the skeleton fighting server with bot players.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--bots', type=int, default=100)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('fight=0.6,chat=0.3,storm=0.1'), help='scenario weights, e.g. fight=0.6,chat=0.3,storm=0.1')
+    parser.add_argument('--ramp', type=float, default=10, help='seconds over which bots connect')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to keep running after the ramp')
+    parser.add_argument('--interval', type=float, default=1, help='mean seconds between a bot\'s commands')
+    parser.add_argument('--attack-ratio', type=float, default=0.7)
+    parser.add_argument('--storm-interval', type=float, default=5, help='mean seconds between a storm bot\'s reconnects')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--binary', action='store_true', help='negotiate the binary protocol')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--prefix', default='bot', help='username and room name prefix')
+    parser.add_argument('--output', default=None, help='results file, loadtest-<time>.json by default')
+    parser.add_argument('--compare', default=None, help='earlier results file to compare with')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    config = parse_args(argv)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(LoadTest(config, loop).run())
+    finally:
+        # Let connections that are still closing finish before the loop goes away
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+    print_results(results)
+    output = config.output or 'loadtest-{}.json'.format(time.strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results saved to {}'.format(output))
+    if config.compare:
+        with open(config.compare) as f:
+            print_comparison(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
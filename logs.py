@@ -0,0 +1,210 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+
+# Logging for the server's hot paths. Modules log through a category logger:
+#     logger = logs.get('room')
+#     logger.debug('{} : removing client {}', self._name, client, room=self._name)
+# The message is only formatted (str.format style) once a record is known to be emitted, and keyword
+# arguments become structured fields. Each category has its own level, sample fraction and rate
+# limit, and debug records of traced rooms always pass, so one room can be debugged in production.
+# Emitted records go through a queue to a listener thread that does the file writes and rotation;
+# the file gets one JSON object per line.
+
+ROOT = 'skeleton_fighting'
+PLAIN_TYPES = (str, int, float, bool, type(None))
+
+categories = {}
+traced_rooms = set()
+listener = None
+queue_handler = None
+
+
+class BraceMessage():
+    __slots__ = ('fmt', 'args')
+
+    def __init__(self, fmt, args):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        if not self.args:
+            return str(self.fmt)
+        return self.fmt.format(*self.args)
+
+
+class Category():
+    # level None follows the root logger; sample is the fraction of records below WARNING kept;
+    # rate limits records per second with bursts of up to burst records
+    def __init__(self, name):
+        self.name = name
+        self.level = None
+        self.sample = 1.0
+        self.rate = None
+        self.burst = None
+        self.tokens = 0
+        self.updated = 0
+        self.dropped = 0
+
+    def configure(self, level=None, sample=None, rate=None, burst=None):
+        if level is not None:
+            self.level = logging._checkLevel(level.upper() if isinstance(level, str) else level)
+        if sample is not None:
+            self.sample = min(1.0, max(0.0, float(sample)))
+        if rate is not None:
+            self.rate = float(rate) if float(rate) > 0 else None
+            self.burst = float(burst) if burst else max(1.0, self.rate)
+            self.tokens = self.burst
+            self.updated = time.monotonic()
+
+    def admit(self, level):
+        if self.sample < 1 and level < logging.WARNING and random.random() >= self.sample:
+            return False
+        if self.rate is None:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.dropped += 1
+            return False
+        self.tokens -= 1
+        return True
+
+    def describe(self):
+        return '{}: level {}, sample {}, rate {}, dropped {}'.format(self.name,
+            logging.getLevelName(self.level) if self.level is not None else 'default', self.sample, self.rate or 'unlimited', self.dropped)
+
+
+class CategoryLogger():
+    def __init__(self, category):
+        self.logger = logging.getLogger(ROOT)
+        self.category = category
+
+    def enabled(self, level, fields):
+        threshold = self.category.level
+        if threshold is None:
+            threshold = self.logger.getEffectiveLevel()
+        if level >= threshold:
+            return True
+        return level == logging.DEBUG and traced_rooms and fields.get('room') in traced_rooms
+
+    def log(self, level, msg, args, fields, exc_info=None):
+        if not self.enabled(level, fields) or not self.category.admit(level):
+            return
+        category = self.category
+        if category.dropped:
+            fields['dropped'] = category.dropped # rate limited since the last record that got through
+            category.dropped = 0
+        caller = sys._getframe(2)
+        record = self.logger.makeRecord(self.logger.name, level, caller.f_code.co_filename, caller.f_lineno,
+            BraceMessage(msg, args), None, exc_info, caller.f_code.co_name)
+        record.category = category.name
+        record.fields = fields
+        self.logger.handle(record)
+
+    def debug(self, msg, *args, **fields):
+        self.log(logging.DEBUG, msg, args, fields)
+
+    def info(self, msg, *args, **fields):
+        self.log(logging.INFO, msg, args, fields)
+
+    def warning(self, msg, *args, **fields):
+        self.log(logging.WARNING, msg, args, fields)
+
+    def error(self, msg, *args, **fields):
+        self.log(logging.ERROR, msg, args, fields)
+
+    def exception(self, msg, *args, **fields):
+        self.log(logging.ERROR, msg, args, fields, sys.exc_info())
+
+
+def get(name):
+    category = categories.get(name)
+    if category is None:
+        category = categories[name] = Category(name)
+    return CategoryLogger(category)
+
+
+def configure(name, level=None, sample=None, rate=None, burst=None):
+    get(name).category.configure(level, sample, rate, burst)
+
+
+def trace_room(name, on=True):
+    # Debug records of this room pass whatever the levels
+    if on:
+        traced_rooms.add(name)
+    else:
+        traced_rooms.discard(name)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # Formats the message on the calling thread, where its arguments are safe to read, and leaves
+    # everything else to the listener thread
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        fields = getattr(record, 'fields', None)
+        if fields:
+            record.fields = {key: value if isinstance(value, PLAIN_TYPES) else str(value) for key, value in fields.items()}
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            't': round(record.created, 6),
+            'level': record.levelname,
+            'category': getattr(record, 'category', None),
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup(path='skeleton.log', level=logging.INFO, console_level=logging.INFO, max_bytes=3e7, backups=5):
+    # Console and rotating JSON lines file, both written by a listener thread
+    global listener, queue_handler
+    if listener:
+        return listener
+    logger = logging.getLogger(ROOT)
+    logger.setLevel(level)
+    records = queue.SimpleQueue()
+    console = logging.StreamHandler()
+    console.setLevel(console_level)
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8', delay=True)
+    file_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(records, console, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(shutdown)
+    queue_handler = LogQueueHandler(records)
+    logger.addHandler(queue_handler)
+    return listener
+
+
+def shutdown():
+    # Writes out whatever is still queued
+    global listener, queue_handler
+    if queue_handler:
+        logging.getLogger(ROOT).removeHandler(queue_handler)
+        queue_handler = None
+    if listener:
+        listener.stop()
+        listener = None
+
+
+def describe():
+    lines = ['root level {}'.format(logging.getLevelName(logging.getLogger(ROOT).getEffectiveLevel()))]
+    lines.extend([category.describe() for name, category in sorted(categories.items())])
+    lines.append('traced rooms: {}'.format(', '.join(sorted(traced_rooms)) or 'none'))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,252 @@
+import asyncio
+import collections
+import logs
+import time
+
+logger = logs.get('loop')
+
+# Event loop health: how late the loop runs timers (lag), which callbacks and task steps hog it
+# (slow steps), and what each slow step was doing. start() shadows call_soon, call_at (which
+# call_later goes through) and call_soon_threadsafe on the monitored loop instance only, so every
+# callback and task step scheduled on it runs timed; other loops and the asyncio classes are left
+# alone, and stop() removes the shadows. Reader/writer callbacks the selector registers directly
+# aren't timed, the task steps they wake up are. While a step runs, the code it calls leaves notes
+# saying which room, client and command it is working for (note() is a timestamp and an append);
+# a slow step is blamed on whichever note covered most of its time. Slow steps are kept for a
+# rolling window to report the worst offenders.
+
+SCHEDULERS = ('call_soon', 'call_at', 'call_soon_threadsafe')
+
+
+def describe(callback):
+    task = getattr(callback, '__self__', None)
+    if isinstance(task, asyncio.Task):
+        coro = task.get_coro()
+        return 'task {}'.format(getattr(coro, '__qualname__', coro))
+    return getattr(callback, '__qualname__', None) or repr(callback)
+
+
+class SlowStep():
+    __slots__ = ('when', 'duration', 'step', 'room', 'client', 'command', 'share')
+
+    def __init__(self, when, duration, step, room, client, command, share):
+        self.when = when
+        self.duration = duration
+        self.step = step # the callback or task that ran
+        self.room = room
+        self.client = client
+        self.command = command
+        self.share = share # fraction of the step spent on room/client/command
+
+    def culprit(self):
+        return (self.room or '-', self.client or '-', self.command or self.step)
+
+    def __repr__(self):
+        return '{:.1f}ms in {} (room {}, client {}, {} for {:.0%})'.format(self.duration * 1000, self.step, self.room or '-', self.client or '-', self.command or '-', self.share)
+
+
+class LoopHealth():
+    def __init__(self, loop=None, slow_threshold=0.05, lag_interval=0.25, window=300, registry=None, warn_interval=1, report_interval=60):
+        self.loop = loop or asyncio.get_event_loop()
+        self.slow_threshold = slow_threshold
+        self.lag_interval = lag_interval
+        self.window = window
+        self.warn_interval = warn_interval
+        self.report_interval = report_interval
+        self.last_report = self.loop.time()
+        self.lag_handle = None
+        self.schedulers = [] # the loop's shadowed call_soon, call_at and call_soon_threadsafe
+        self.watched = [] # (logging handler, its own emit)
+        self.lags = collections.deque() # (loop time, lag) for the window
+        self.slow_steps = collections.deque()
+
+        self.in_step = False
+        self.step_started = 0
+        self.notes = [] # (time, room, client, command) left by the current step
+        self.current = None
+
+        self.last_warning = 0
+        self.suppressed = 0
+
+        self.lag_histogram = None
+        self.slow_counter = None
+        if registry is not None:
+            self.lag_histogram = registry.histogram('skeleton_loop_lag_seconds', 'How late the event loop ran a timer',
+                buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+            self.slow_counter = registry.counter('skeleton_slow_steps_total', 'Loop callbacks and task steps slower than the threshold', ['room_type'])
+            registry.gauge('skeleton_loop_lag_max_seconds', 'Worst loop lag over the report window', self.max_lag)
+
+    def start(self):
+        self.install()
+        if self.lag_handle is None:
+            self.schedule_lag_sample()
+
+    def stop(self):
+        self.uninstall()
+        if self.lag_handle:
+            self.lag_handle.cancel()
+            self.lag_handle = None
+        for handler, emit in self.watched:
+            handler.emit = emit
+        self.watched = []
+
+    # Lag sampling
+
+    def schedule_lag_sample(self):
+        expected = self.loop.time() + self.lag_interval
+        self.lag_handle = self.loop.call_at(expected, self.sample_lag, expected)
+
+    def sample_lag(self, expected):
+        now = self.loop.time()
+        lag = max(0, now - expected)
+        self.lags.append((now, lag))
+        if self.lag_histogram:
+            self.lag_histogram.observe(lag)
+        self.trim(now)
+        if self.report_interval and now - self.last_report >= self.report_interval:
+            self.last_report = now
+            if self.slow_steps:
+                self.log_report()
+        self.schedule_lag_sample()
+
+    def trim(self, now):
+        horizon = now - self.window
+        while self.lags and self.lags[0][0] < horizon:
+            self.lags.popleft()
+        while self.slow_steps and self.slow_steps[0].when < horizon:
+            self.slow_steps.popleft()
+
+    def max_lag(self):
+        return max([lag for when, lag in self.lags] or [0])
+
+    # Slow step detection
+
+    def install(self):
+        if self.installed():
+            return
+        loop = self.loop
+        call_soon, call_at, call_soon_threadsafe = loop.call_soon, loop.call_at, loop.call_soon_threadsafe
+        loop.call_soon = lambda callback, *args, context=None: call_soon(self.run_step, callback, *args, context=context)
+        loop.call_at = lambda when, callback, *args, context=None: call_at(when, self.run_step, callback, *args, context=context)
+        loop.call_soon_threadsafe = lambda callback, *args, context=None: call_soon_threadsafe(self.run_step, callback, *args, context=context)
+        self.schedulers = [getattr(loop, name) for name in SCHEDULERS]
+
+    def installed(self):
+        return bool(self.schedulers) and [vars(self.loop).get(name) for name in SCHEDULERS] == self.schedulers
+
+    def uninstall(self):
+        if self.installed():
+            for name in SCHEDULERS:
+                delattr(self.loop, name)
+        self.schedulers = []
+
+    def run_step(self, callback, *args):
+        self.begin_step()
+        try:
+            return callback(*args)
+        finally:
+            self.end_step(callback)
+
+    def note(self, room=None, client=None, command=None):
+        # What the running step works on from now on
+        if self.in_step:
+            self.current = (room, client, command)
+            self.notes.append((time.perf_counter(), room, client, command))
+
+    def watch_handler(self, handler):
+        # Time spent in a logging handler's (synchronous) emit is blamed on logging
+        emit = handler.emit
+        self.watched.append((handler, emit))
+
+        def timed_emit(record):
+            previous = self.current
+            self.note(command='logging')
+            try:
+                emit(record)
+            finally:
+                if previous:
+                    self.note(*previous)
+                else:
+                    self.note()
+        handler.emit = timed_emit
+
+    def begin_step(self):
+        self.in_step = True
+        self.current = None
+        if self.notes:
+            self.notes = []
+        self.step_started = time.perf_counter()
+
+    def end_step(self, callback):
+        ended = time.perf_counter()
+        self.in_step = False
+        duration = ended - self.step_started
+        if duration >= self.slow_threshold:
+            self.slow_step(callback, duration, ended)
+
+    def blame(self, ended):
+        # The note covering most of the step: {(room, client, command): seconds}
+        spans = collections.defaultdict(float)
+        start, key = self.step_started, (None, None, None)
+        for when, room, client, command in self.notes:
+            spans[key] += when - start
+            start, key = when, (room, client, command)
+        spans[key] += ended - start
+        return max(spans.items(), key=lambda item: item[1])
+
+    def slow_step(self, callback, duration, ended):
+        (room, client, command), seconds = self.blame(ended)
+        step = SlowStep(self.loop.time(), duration, describe(callback),
+            '{} {}'.format(room.room_type, room.name) if room is not None else None,
+            client.username if client is not None else None,
+            command, seconds / duration)
+        self.slow_steps.append(step)
+        if self.slow_counter:
+            self.slow_counter.inc(room.room_type if room is not None else 'none')
+        if step.when - self.last_warning >= self.warn_interval:
+            more = ' ({} more since the last warning)'.format(self.suppressed) if self.suppressed else ''
+            self.last_warning = step.when
+            self.suppressed = 0
+            logger.warning('Slow loop step: {}{}', step, more)
+        else:
+            self.suppressed += 1
+
+    # Reports
+
+    def worst_offenders(self, top=10):
+        # Slow steps in the window grouped by culprit, most total time first
+        self.trim(self.loop.time())
+        groups = {}
+        for step in self.slow_steps:
+            group = groups.get(step.culprit())
+            if group is None:
+                group = groups[step.culprit()] = {'room': step.room, 'client': step.client, 'command': step.command, 'step': step.step, 'count': 0, 'total_ms': 0, 'max_ms': 0}
+            group['count'] += 1
+            group['total_ms'] += step.duration * 1000
+            group['max_ms'] = max(group['max_ms'], step.duration * 1000)
+        return sorted(groups.values(), key=lambda group: group['total_ms'], reverse=True)[:top]
+
+    def log_report(self, top=5):
+        report = self.report(top)
+        lines = ['{} slow steps in the last {}s, lag p99 {:.1f}ms max {:.1f}ms. Worst:'.format(
+            report['slow_steps'], self.window, report['lag_ms']['p99'], report['lag_ms']['max'])]
+        for group in report['worst_offenders']:
+            lines.append('  {:.1f}ms total, {} steps, max {:.1f}ms: room {}, client {}, {} ({})'.format(
+                group['total_ms'], group['count'], group['max_ms'], group['room'] or '-', group['client'] or '-', group['command'] or '-', group['step']))
+        logger.info('Loop health: ' + '\n'.join(lines))
+
+    def report(self, top=10):
+        self.trim(self.loop.time())
+        lags = sorted([lag for when, lag in self.lags])
+        return {
+            'window': self.window,
+            'slow_threshold_ms': self.slow_threshold * 1000,
+            'lag_ms': {
+                'samples': len(lags),
+                'p50': lags[len(lags) // 2] * 1000 if lags else 0,
+                'p99': lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000 if lags else 0,
+                'max': lags[-1] * 1000 if lags else 0,
+            },
+            'slow_steps': len(self.slow_steps),
+            'worst_offenders': self.worst_offenders(top),
+        }
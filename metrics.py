@@ -0,0 +1,207 @@
+import asyncio
+import bisect
+import collections
+import logs
+import urllib.parse
+
+logger = logs.get('metrics')
+
+# In-process metrics served in the Prometheus text format over a tiny HTTP endpoint.
+# Counters and histograms are plain dicts and lists updated inline, so they are cheap enough for
+# the hot paths. Gauges are callbacks evaluated only when the endpoint is scraped.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; command handling and broadcast fan-out are usually well under a millisecond
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+
+def frame_size(frame):
+    # Payload bytes of a text or binary frame; ASCII text (nearly all of it) needs no encoding
+    if isinstance(frame, str) and not frame.isascii():
+        return len(frame.encode('utf-8'))
+    return len(frame)
+
+
+def format_labels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric():
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def header(self):
+        return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+
+
+class Counter(Metric):
+    # inc(key) where key is the label value (one label) or tuple of values (several)
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self.values = collections.defaultdict(int)
+
+    def inc(self, key=(), amount=1):
+        self.values[key] += amount
+
+    def samples(self):
+        lines = []
+        for key, value in sorted(self.values.items()):
+            values = key if isinstance(key, tuple) else (key,)
+            lines.append('{}{} {}'.format(self.name, format_labels(self.labels, values), format_value(value)))
+        return lines
+
+
+class Gauge(Metric):
+    # function() returns the value, or a dict of label value(s) -> value when the gauge has labels
+    kind = 'gauge'
+
+    def __init__(self, name, help, function, labels=()):
+        super(Gauge, self).__init__(name, help, labels)
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        if not self.labels:
+            return ['{} {}'.format(self.name, format_value(value))]
+        lines = []
+        for key, value in sorted(value.items()):
+            values = key if isinstance(key, tuple) else (key,)
+            lines.append('{}{} {}'.format(self.name, format_labels(self.labels, values), format_value(value)))
+        return lines
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = list(buckets)
+        self.series = {} # key -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, key=()):
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        lines = []
+        for key, series in sorted(self.series.items()):
+            values = key if isinstance(key, tuple) else (key,)
+            count = 0
+            for bound, bucket in zip(self.buckets + [float('inf')], series):
+                count += bucket
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.labels, values, 'le="{}"'.format(format_value(bound))), count))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labels, values), series[-1]))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.labels, values), count))
+        return lines
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+
+    def add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('Metric {} is already registered'.format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, function, labels=()):
+        return self.add(Gauge(name, help, function, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def exposition(self):
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception:
+                logger.exception('Failed to collect metric {}', metric.name)
+                continue
+            lines.extend(metric.header())
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer():
+    # Minimal HTTP/1.0 endpoint: GET /metrics returns the registry's exposition, other pages can be
+    # added with add_page (render gets the query string as a dict), anything else is a 404
+    def __init__(self, registry, loop=None):
+        self.registry = registry
+        self.loop = loop or asyncio.get_event_loop()
+        self.server = None
+        self.pages = {
+            '/': (CONTENT_TYPE, lambda query: registry.exposition()),
+            '/metrics': (CONTENT_TYPE, lambda query: registry.exposition()),
+        }
+
+    def add_page(self, path, content_type, render):
+        self.pages[path] = (content_type, render)
+
+    async def start(self, host='', port=9765):
+        self.server = await asyncio.start_server(self.handle, host or None, port)
+        return self.server
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            while True: # skip the headers
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if not line.strip():
+                    break
+            parts = request.decode('latin-1').split()
+            url = urllib.parse.urlsplit(parts[1]) if len(parts) >= 2 and parts[0] in ('GET', 'HEAD') else None
+            page = self.pages.get(url.path) if url else None
+            if page:
+                content_type, render = page
+                query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+                body = render(query).encode('utf-8')
+                status = '200 OK'
+            else:
+                content_type = 'text/plain; charset=utf-8'
+                body = b'Not found\n'
+                status = '404 Not Found'
+            head = 'HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(status, content_type, len(body))
+            writer.write(head.encode('latin-1'))
+            if parts and parts[0] != 'HEAD':
+                writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.server:
+            self.server.close()
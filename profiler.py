@@ -0,0 +1,79 @@
+import collections
+import logs
+import os
+import sys
+import threading
+import time
+
+logger = logs.get('profiler')
+
+# Sampling profiler that can be attached to a running server. A background thread looks at the
+# event loop thread's stack every interval seconds and counts each distinct stack; when the profile
+# ends the counts are written as collapsed stacks ('outer;inner;leaf count' per line), the input
+# flamegraph.pl and speedscope take. It costs nothing while not running, and keeps sampling while
+# the loop itself is stuck.
+
+
+class SamplingProfiler():
+    def __init__(self, thread_id=None, interval=0.005, directory='.', prefix='profile'):
+        self.thread_id = thread_id or threading.main_thread().ident
+        self.interval = interval
+        self.directory = directory
+        self.prefix = prefix
+        self.labels = {} # code object -> frame label
+        self.thread = None
+        self.stopping = threading.Event()
+        self.path = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds):
+        # Returns the file the profile will be written to, None if one is already running
+        if self.running:
+            return None
+        self.stopping.clear()
+        self.path = os.path.join(self.directory, '{}-{}-{}.folded'.format(self.prefix, os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        self.thread = threading.Thread(target=self.run, args=(seconds, self.path), name='profiler', daemon=True)
+        self.thread.start()
+        logger.info('Profiling for {}s into {}', seconds, self.path)
+        return self.path
+
+    def stop(self):
+        self.stopping.set()
+
+    def toggle(self, seconds):
+        if self.running:
+            self.stop()
+        else:
+            self.start(seconds)
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            name = getattr(code, 'co_qualname', code.co_name)
+            label = self.labels[code] = '{}:{}'.format(os.path.basename(code.co_filename), name)
+        return label
+
+    def sample(self, counts):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(self.label(frame.f_code))
+            frame = frame.f_back
+        if stack:
+            counts[';'.join(reversed(stack))] += 1
+
+    def run(self, seconds, path):
+        counts = collections.Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not self.stopping.is_set():
+            self.sample(counts)
+            samples += 1
+            self.stopping.wait(self.interval)
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in counts.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        logger.info('Profile done: {} samples, {} distinct stacks in {}', samples, len(counts), path)
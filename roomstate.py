@@ -0,0 +1,74 @@
+class CreatureRecord():
+    __slots__ = ('uid', 'name', 'alive', 'max_health', 'health', 'state', 'target')
+
+    fields = 7 # per creature in a snapshot: uid, name, alive, max_health, health, state, target name
+
+    def __init__(self, uid, name, alive, max_health, health, state, target=''):
+        self.uid = uid
+        self.name = name
+        self.alive = alive
+        self.max_health = max_health
+        self.health = health
+        self.state = state
+        self.target = target
+
+    def report(self):
+        return [self.uid, self.name, str(self.alive), str(self.max_health), str(self.health), self.state, self.target]
+
+
+class RoomState():
+    # What a room's clients know about its creatures, kept up to date from the game events sent to them.
+    # Every change bumps version. A joining client gets one snapshot of the current version and
+    # everybody else keeps receiving the events themselves as deltas against it.
+    def __init__(self):
+        self.version = 0
+        self.creatures = {}
+        self.cached_snapshot = None
+        self.cached_version = None
+
+    def __len__(self):
+        return len(self.creatures)
+
+    def __contains__(self, uid):
+        return uid in self.creatures
+
+    def changed(self):
+        self.version += 1
+
+    def add(self, creature):
+        target = creature.target.name if creature.target else ''
+        record = CreatureRecord(creature.uid, creature.name, creature.alive, creature.max_health, creature.health, creature.state, target)
+        self.creatures[creature.uid] = record
+        self.changed()
+        return record
+
+    def remove(self, uid):
+        if self.creatures.pop(uid, None):
+            self.changed()
+
+    def apply(self, uid, msg_type, args):
+        record = self.creatures.get(uid)
+        if not record:
+            return
+        if msg_type == 'creature_health_report':
+            record.health = args[0]
+        elif msg_type == 'creature_changed_state':
+            record.state = args[0]
+        elif msg_type == 'creature_death':
+            record.alive = False
+        elif msg_type == 'ai_new_target':
+            target = self.creatures.get(args[0])
+            record.target = target.name if target else ''
+        else:
+            return
+        self.changed()
+
+    def snapshot(self):
+        # [version, then CreatureRecord.fields values per creature], built once per version
+        if self.cached_version != self.version:
+            args = [self.version]
+            for record in self.creatures.values():
+                args.extend(record.report())
+            self.cached_snapshot = args
+            self.cached_version = self.version
+        return self.cached_snapshot
@@ -1,31 +1,40 @@
 import asyncio
+import collections
 import websockets
 import uuid
 import signal
 import functools 
+import os
 import skeletons
+import timerwheel
+import history
+import chatlog
+import roomstate
+import wire
+import admission
+import metrics
+import loophealth
+import profiler
+import tracing
 import concurrent
 import random
+import secrets
+import json
 import logging
+import logs
 import sys
-from logging.handlers import RotatingFileHandler
+import time
 HOST =''
 PORT = 8765
+METRICS_PORT = 9765
+HISTORY_DIR = 'history'
+LOG_FILE = 'skeleton.log'
 
-logger = logging.getLogger('skeleton_fighting')
-logger.setLevel(logging.DEBUG)
-
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-
-# create console handler and set level to debug
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-logger.addHandler(ch)
-
-fh = RotatingFileHandler('skeleton.log', maxBytes=3e7, backupCount=5, encoding='utf-8')
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(formatter)
-logger.addHandler(fh)
+logger = logs.get('server')
+net_logger = logs.get('net')
+room_logger = logs.get('room')
+game_logger = logs.get('game')
+session_logger = logs.get('session')
 
 class ClientAlreadyExistsException(Exception):
     pass
@@ -35,22 +44,37 @@ class ClientNotRegisteredInRoomException(Exception):
 
 class SystemMessage():
     valid_msg_types = [
-        'registered', #client.uid, client.username
+        'registered', #client.uid, client.username, session resume token
         'joined_room', #room.uid, room.name
         'client_joined_room', #client.uid, client.username,
         'client_left_room', #client.uid, client.username,
         'username_prompt',
         'username_invalid',
-        'validation_error'
+        'validation_error',
+        'history_page', #oldest seq in the page, 1 if older messages exist
+        'resumed', #last frame seq the client had, frames after it are replayed
+        'resume_failed',
+        'protocol', #subprotocol name, msg types and creature states in code order, sent to binary clients
+        'redirect', #host and port of the node to reconnect to, handoff token to send at its username prompt
     ]
 
+    __slots__ = ('emitter', 'type_code', 'args', 'targets')
+
     def __init__(self, emitter = None, msg_type = None, args=None, targets=None):
         self.emitter = emitter 
-        self.msg_type = msg_type
+        self.type_code = msg_type_code(msg_type)
         self.args = args
         self.targets = targets
 
+    @property
+    def msg_type(self):
+        return MSG_TYPES[self.type_code]
+
+    def encode(self):
+        return "sysmsg|{}|{}|{}".format(self.emitter.uid, self.msg_type, '|'.join([str(x) for x in self.args]))
+
 class GameSystemMessage(SystemMessage):
+    __slots__ = ()
     valid_msg_types = [
             "creature_took_damage",
             "creature_health_report",
@@ -66,32 +90,392 @@ class GameSystemMessage(SystemMessage):
             "ai_new_target",
             "ply_notify",
 
-            'ui_setup_creature' #creature.uid, creature.name, creature.alive, creature.max_health, creature.health, creature.target, creature.state
+            'ui_setup_creature', #creature.uid, creature.name, creature.alive, creature.max_health, creature.health, creature.state, creature.target
+            'room_snapshot', #room state version, then the ui_setup_creature fields of every creature
             ]
 
+    # Cosmetic events a slow client can miss without its UI going out of sync
+    droppable_msg_types = {
+            "creature_took_damage",
+            "creature_blocked_damage",
+            "creature_action_interrupted",
+            "creature_attack_started",
+            "creature_attack_finished",
+            "creature_def",
+            "creature_no_def",
+            "creature_start",
+            "ply_notify",
+            }
+    # Reports where only the latest value per emitter matters
+    coalescable_msg_types = {
+            "creature_health_report",
+            "creature_changed_state",
+            }
+
+# Every system message type gets a small integer code; messages store the code instead of the name
+MSG_TYPES = SystemMessage.valid_msg_types + GameSystemMessage.valid_msg_types
+MSG_TYPE_CODES = {msg_type: code for code, msg_type in enumerate(MSG_TYPES)}
+GameSystemMessage.type_codes = {msg_type: MSG_TYPE_CODES[msg_type] for msg_type in GameSystemMessage.valid_msg_types}
+
+# Clients that negotiate wire.SUBPROTOCOL get system messages as packed binary frames
+WIRE = wire.Codec(MSG_TYPES, skeletons.Creature.states)
+
+def msg_type_code(msg_type):
+    code = MSG_TYPE_CODES.get(msg_type)
+    if code is None: # unknown types still go out, they just get a code on first use
+        code = len(MSG_TYPES)
+        MSG_TYPES.append(msg_type)
+        MSG_TYPE_CODES[msg_type] = code
+    return code
+
 
 class Message():
+    __slots__ = ('author', 'text', 'targets')
+
     def __init__(self, author = None, text = None, targets = None):
         self.author = author 
         self.text = text
         self.targets = targets
 
 class Client():
-    def __init__(self,  uid=None,websocket=None,username=None, room=None, player=None):
+    __slots__ = ('websocket', 'username', 'room', 'player', 'uid', 'outbox', 'session_token', 'session_expiry', 'binary', 'limits')
+
+    def __init__(self,  uid=None,websocket=None,username=None, room=None, player=None, binary=False):
         self.websocket = websocket
-        self.username = username
+        self.binary = binary
+        self.username = sys.intern(username) if username else username
         self.room = room
         self.player = player
-        self.uid = uid or str(uuid.uuid4())[:8]
+        self.uid = sys.intern(uid or str(uuid.uuid4())[:8])
+        self.outbox = None
+        self.session_token = None
+        self.session_expiry = None
+        self.limits = None # admission.ConnectionLimits, kept across resumed connections
 
     @property
     def chat_name(self):
         return self.username
 
+    @property
+    def queue_depth(self):
+        if self.outbox is None:
+            return 0
+        return len(self.outbox)
+
     def __repr__(self):
         return 'client|'+self.uid+'|'+self.username
 
 
+class OutboundQueue():
+    # Bounded per-client queue of outbound frames drained by its own writer task
+    overflow_policies = ['drop', 'disconnect']
+
+    def __init__(self, client, loop=None, maxsize=256, overflow_policy='drop', replay_size=256):
+        if not overflow_policy in OutboundQueue.overflow_policies:
+            raise ValueError('Unknown overflow policy {}'.format(overflow_policy))
+        self.client = client
+        self.loop = loop or asyncio.get_event_loop()
+        self.maxsize = maxsize
+        self.hard_limit = maxsize * 2 # critical frames may overshoot maxsize up to this
+        self.overflow_policy = overflow_policy
+        self.frames = collections.deque()
+        self.pending = {} # coalescing key -> queued entry
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.writer_task = None
+        # Every frame gets a sequence number when it is sent; the last replay_size are kept for resumption
+        self.seq = 0
+        self.replay = collections.deque(maxlen=replay_size)
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def start(self):
+        self.writer_task = self.loop.create_task(self.run())
+        return self.writer_task
+
+    def put(self, text, msg_type=None, key=None):
+        if self.closed:
+            return False
+        coalesce_key = None
+        if msg_type in GameSystemMessage.coalescable_msg_types:
+            coalesce_key = (msg_type, key)
+
+        if len(self.frames) >= self.maxsize:
+            entry = self.pending.get(coalesce_key) if coalesce_key else None
+            if entry:
+                # The newest report takes the stale one's place at the back of the queue, so it is
+                # not sent ahead of frames queued after the stale one
+                self.remove_entry(entry)
+                entry[0] = text
+                self.frames.append(entry)
+                self.coalesced += 1
+                return True
+            if self.overflow_policy == 'disconnect':
+                self.overflow('queue full')
+                return False
+            if msg_type in GameSystemMessage.droppable_msg_types:
+                self.dropped += 1
+                return False
+            if len(self.frames) >= self.hard_limit:
+                self.overflow('queue full of critical frames')
+                return False
+
+        entry = [text, coalesce_key, None]
+        self.frames.append(entry)
+        if coalesce_key:
+            self.pending[coalesce_key] = entry
+        self.wakeup.set()
+        return True
+
+    def remove_entry(self, entry):
+        # By identity, entries with the same text compare equal
+        for index, queued in enumerate(self.frames):
+            if queued is entry:
+                del self.frames[index]
+                return
+
+    def overflow(self, reason):
+        net_logger.warning('Disconnecting slow client {}: {} ({} frames)', self.client, reason, len(self.frames))
+        self.close()
+        self.loop.create_task(self.client.websocket.close())
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self.pending.clear()
+        self.replay.clear()
+        self.wakeup.set()
+
+    def detach(self):
+        # Connection lost: stop writing but keep queueing frames until the session resumes or expires
+        if self.writer_task:
+            self.writer_task.cancel()
+            self.writer_task = None
+
+    def can_replay(self, last_seq):
+        if self.closed or last_seq > self.seq:
+            return False
+        oldest = self.replay[0][2] if self.replay else self.seq + 1
+        return last_seq + 1 >= oldest
+
+    def attach(self, last_seq):
+        # Requeue every sent frame the client didn't get, keeping their sequence numbers, and restart the writer
+        missed = [entry for entry in self.replay if entry[2] > last_seq]
+        self.frames.extendleft(reversed(missed))
+        self.wakeup.set()
+        self.start()
+
+    async def run(self):
+        while not self.closed:
+            if not self.frames:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            entry = self.frames.popleft()
+            if entry[1] and self.pending.get(entry[1]) is entry:
+                del self.pending[entry[1]]
+            if entry[2] is None:
+                self.seq += 1
+                entry[2] = self.seq
+                self.replay.append(entry)
+            try:
+                await self.client.websocket.send(entry[0])
+                self.sent += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The frame stays in the replay buffer; the handler decides whether to drop or keep the session
+                net_logger.debug('Writer for client {} stopped: {!r}', self.client, e)
+                self.writer_task = None
+                break
+
+
+class NamePool():
+    # Set of free names supporting O(1) take, release and random pick (swap-remove list + index)
+    def __init__(self, names=None):
+        self.names = []
+        self.index = {}
+        for name in names or []:
+            self.release(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def take(self, name):
+        i = self.index.pop(name, None)
+        if i is None:
+            return False
+        last = self.names.pop()
+        if i < len(self.names):
+            self.names[i] = last
+            self.index[last] = i
+        return True
+
+    def release(self, name):
+        if name in self.index:
+            return
+        self.index[name] = len(self.names)
+        self.names.append(name)
+
+    def random(self):
+        if not self.names:
+            return None
+        return random.choice(self.names)
+
+
+class RoomRegistry():
+    # Server rooms indexed by uid and by name; also tracks which skeleton names are free
+    def __init__(self, rooms=None, skeleton_names=None, on_remove=None):
+        self.on_remove = on_remove
+        self.rooms_by_uid = {}
+        self.rooms_by_name = {}
+        self.skeleton_names = set(skeleton_names or skeletons.Skeleton.skeleton_names)
+        self.free_skeleton_names = NamePool(self.skeleton_names)
+        for room in rooms or []:
+            self.add(room)
+
+    def __iter__(self):
+        return iter(list(self.rooms_by_uid.values()))
+
+    def __len__(self):
+        return len(self.rooms_by_uid)
+
+    def __contains__(self, room):
+        return self.rooms_by_uid.get(room.uid) is room
+
+    def __repr__(self):
+        return repr(list(self.rooms_by_uid.values()))
+
+    def add(self, room):
+        if room in self:
+            return
+        self.rooms_by_uid[room.uid] = room
+        if room.name is not None:
+            self.rooms_by_name[room.name] = room
+            self.free_skeleton_names.take(room.name)
+
+    def remove(self, room):
+        if not room in self:
+            return
+        del self.rooms_by_uid[room.uid]
+        if self.rooms_by_name.get(room.name) is room:
+            del self.rooms_by_name[room.name]
+            if room.name in self.skeleton_names:
+                self.free_skeleton_names.release(room.name)
+        if self.on_remove:
+            self.on_remove(room)
+
+    def get(self, uid):
+        return self.rooms_by_uid.get(uid)
+
+    def get_by_name(self, name):
+        return self.rooms_by_name.get(name)
+
+    def random_skeleton_name(self):
+        return self.free_skeleton_names.random()
+
+
+class RoomPool():
+    # Idle, fully built rooms so a fight starts without constructing one. Rooms come back through
+    # release() when their fight ends and are reset for the next one, up to max_size idle rooms. The
+    # pool keeps at least target rooms idle: every miss raises the target by one (up to max_size) and
+    # missing rooms are built ahead, one per loop iteration. Rooms that stayed idle for a whole
+    # trim_interval were not needed; the target drops by that many (down to size) and the excess goes.
+    def __init__(self, create, size=4, max_size=64, trim_interval=60, loop=None, registry=None):
+        self.create = create
+        self.size = size
+        self.max_size = max(size, max_size)
+        self.trim_interval = trim_interval
+        self.loop = loop or asyncio.get_event_loop()
+        self.idle = []
+        self.target = size
+        self.low_water = 0 # fewest idle rooms since the last trim
+        self.refill_handle = None
+        self.trim_handle = None
+        self.events = metrics.Counter('skeleton_room_pool_events_total', 'Room pool hits, misses, recycled, discarded, built and trimmed rooms', ['event'])
+        if registry is not None:
+            registry.add(self.events)
+            registry.gauge('skeleton_room_pool_idle', 'Idle rooms ready in the room pool', lambda: len(self.idle))
+            registry.gauge('skeleton_room_pool_target', 'Idle rooms the room pool is aiming for', lambda: self.target)
+
+    def __len__(self):
+        return len(self.idle)
+
+    def start(self):
+        self.low_water = len(self.idle)
+        self.schedule_refill()
+        if self.trim_interval:
+            self.trim_handle = self.loop.call_later(self.trim_interval, self.trim)
+
+    def close(self):
+        for handle in (self.refill_handle, self.trim_handle):
+            if handle:
+                handle.cancel()
+        self.refill_handle = self.trim_handle = None
+        for room in self.idle:
+            room.close()
+        self.idle = []
+
+    def acquire(self):
+        if self.idle:
+            room = self.idle.pop()
+            self.events.inc('hit')
+            self.low_water = min(self.low_water, len(self.idle))
+        else:
+            room = self.create()
+            self.events.inc('miss')
+            self.target = min(self.max_size, self.target + 1)
+        self.schedule_refill()
+        return room
+
+    def release(self, room):
+        if room in self.idle:
+            return
+        if len(self.idle) >= self.max_size or not room.recycle():
+            room.close()
+            self.events.inc('discarded')
+            return
+        self.idle.append(room)
+        self.events.inc('recycled')
+
+    def schedule_refill(self):
+        if len(self.idle) < self.target and not self.refill_handle:
+            self.refill_handle = self.loop.call_soon(self.refill)
+
+    def refill(self):
+        self.refill_handle = None
+        if len(self.idle) < self.target:
+            self.idle.append(self.create())
+            self.events.inc('built')
+            self.schedule_refill()
+
+    def trim(self):
+        spare = self.low_water
+        if spare > 0:
+            self.target = max(self.size, self.target - spare)
+            keep = max(self.target, len(self.idle) - spare)
+            for room in self.idle[keep:]:
+                room.close()
+                self.events.inc('trimmed')
+            del self.idle[keep:]
+        self.low_water = len(self.idle)
+        self.trim_handle = self.loop.call_later(self.trim_interval, self.trim)
+
+    def stats(self):
+        hits, misses = self.events.values['hit'], self.events.values['miss']
+        stats = {'idle': len(self.idle), 'target': self.target, 'hit_ratio': hits / (hits + misses) if hits + misses else None}
+        stats.update(self.events.values)
+        return stats
+
+
 class Room():
     chat_name = 'GLOBAL'
     room_type = 'generic'
@@ -99,11 +483,18 @@ class Room():
     def __init__(self, server=None, loop=None, messages = None, clients = None, uid = None, _name = None):
         self.server = server
         self.loop = loop or asyncio.get_event_loop()
-        self.messages = messages or []
-        self.clients = clients or set()
-        self.uid = uid or str(uuid.uuid4())[:8]
         self._name = _name or None
-        logger.debug('Initialized room: {} {}'.format(self.room_type, self._name))
+        if server:
+            self.history = server.room_history(self.room_type, self._name)
+            self.history_page_size = server.history_page_size
+        else:
+            self.history = history.RoomHistory()
+            self.history_page_size = 50
+        for message in messages or []:
+            self.log_message(message)
+        self.clients = clients or set()
+        self.uid = sys.intern(uid or str(uuid.uuid4())[:8])
+        room_logger.debug('Initialized room: {} {}', self.room_type, self._name, room=self._name)
 
     @property
     def name(self):
@@ -113,17 +504,37 @@ class Room():
     def name(self, val):
         self._name = val
 
+    def log_message(self, message):
+        self.history.append('{}: {}'.format(message.author.chat_name, message.text), message.targets)
+
     def readable_history(self, client):
-        message_history = ['{}: {}'.format(message.author.chat_name, message.text) for message in self.messages if not message.targets or client in message.targets] # BUG currently on reconnection user wont get messages that were targeted at him during previous session
-        return '\n'.join(message_history)
+        return self.history.render(client) # BUG currently on reconnection user wont get messages that were targeted at him during previous session
+
+    async def handle_history(self, client, *args):
+        # ::history [before] pages back through the room history
+        max_args_len = 1
+        if len(args) > max_args_len:
+            return "Too many arguments, expected {}".format(max_args_len)
+        if args and not args[0].isdigit():
+            return "Expected a message number."
+        await self.send_history(client, int(args[0]) if args else None)
+        return 0
+
+    async def send_history(self, client, before=None):
+        lines, more = self.history.page(client, before, self.history_page_size)
+        if not lines:
+            return
+        room_logger.debug('{} {} : Sending room history page to client {}', self.room_type, self._name, client, room=self._name)
+        await self.send_system_message(SystemMessage(self, 'history_page', [lines[0][0], int(more)], targets=[client]))
+        await self.send_text('\n'.join([line for seq, line in lines]), [client])
 
     def is_command(self, message):
         return message.text.startswith('::') 
 
     def get_client(self, websocket):
-        for client in self.clients.copy():
-            if client.websocket == websocket:
-                return client
+        client = self.server.get_client(websocket)
+        if client and client in self.clients:
+            return client
         return False
 
     def preprocess_command(self, message):
@@ -140,43 +551,51 @@ class Room():
         return True
 
     async def on_client_joined(self, client):
-        logger.debug('Client joined room {} {} : {}'.format(self.room_type, self._name, client.username))
+        self.note(client, 'join')
+        room_logger.debug('Client joined room {} {} : {}', self.room_type, self._name, client.username, room=self._name)
         await self.send_system_message(SystemMessage(self, 'joined_room',[self.uid, self.name, self.room_type], targets=[client]))
-        history = self.readable_history(client)
-        if history:
-            logger.debug('{} {} : Sending room history to client {}'.format(self.room_type, self._name, client))
-            await self.send_text(history, [client])
+        await self.send_history(client)
        # message = Message(self, '{} connected'.format(client.username))
-        logger.debug('{} {} : Sending client_joined_room sysmsg {}'.format(self.room_type, self._name, client))
+        room_logger.debug('{} {} : Sending client_joined_room sysmsg {}', self.room_type, self._name, client, room=self._name)
         await self.send_system_message(SystemMessage(self, 'client_joined_room',[client.uid, client.username]))
         #await self.send_message(message)
 
     async def on_client_disconnected(self, client):
         #message = Message(self, '{} disconnected'.format(client.username))
         #await self.send_message(message)   
-        logger.debug('{} {} : Sending client_left_room sysmsg {}'.format(self.room_type, self._name, client))
+        room_logger.debug('{} {} : Sending client_left_room sysmsg {}', self.room_type, self._name, client, room=self._name)
         await self.send_system_message(SystemMessage(self, 'client_left_room',[client.uid, client.username]))
 
     async def handle_command(self, message):
-        logger.debug('{} {} : handling command by client {}: {}'.format(self.room_type, self._name, message.author, message.text))
+        room_logger.debug('{} {} : handling command by client {}: {}', self.room_type, self._name, message.author, message.text, room=self._name)
+
+    def note(self, client=None, command=None):
+        # Tell the loop health monitor what the running step is working on
+        if self.server:
+            self.server.loop_health.note(self, client, command)
 
     async def handle_message(self, client, text):
-        logger.debug('{} {} : handling message by client {}: {}'.format(self.room_type, self._name, client, text))
+        self.note(client, text.split(' ', 1)[0] if text.startswith('::') else 'chat')
+        room_logger.debug('{} {} : handling message by client {}: {}', self.room_type, self._name, client, text, room=self._name)
         if not text.strip():
             return None
         message = Message(client, text.strip())
-        if not self.get_client(client.websocket):
+        if not client in self.clients:
             raise(ClientNotRegisteredInRoomException())
 
         if self.is_command(message):
-
-            await self.handle_command(message)
+            started = time.perf_counter()
+            with tracing.span('handle_command'):
+                await self.handle_command(message)
+            if self.server:
+                self.server.command_seconds.observe(time.perf_counter() - started, self.room_type)
         else:
-            await self.send_message(message)
+            with tracing.span('send_message'):
+                await self.send_message(message)
 
     async def register_client(self, client):
         try:
-            logger.debug('{} {} : registering client {}'.format(self.room_type, self._name, client))
+            room_logger.debug('{} {} : registering client {}', self.room_type, self._name, client, room=self._name)
             self.clients.add(client)
             client.room = self
             await self.on_client_joined(client)
@@ -186,48 +605,54 @@ class Room():
 
 
     async def remove_client(self, client):
-        logger.debug('{} {} : removing client {}'.format(self.room_type, self._name, client))
-        for c in self.clients.copy():
-            if c.websocket == client.websocket:
-                self.clients.remove(client)
-                await self.on_client_disconnected(client)
-                break
+        room_logger.debug('{} {} : removing client {}', self.room_type, self._name, client, room=self._name)
+        if client in self.clients:
+            self.clients.remove(client)
+            await self.on_client_disconnected(client)
 
     async def send_text(self, text, targets): #Sending text doesn't show an author and is never logged
-        logger.debug('{} {} : sending raw text {}, {}'.format(self.room_type, self._name, text, str(targets)))
+        self.post_text(text, targets)
+
+    async def send_message(self, message, log = True, no_author = False):
+        self.post_message(message, log, no_author)
+
+    async def send_system_message(self, msg):
+        self.post_system_message(msg)
+
+    # post_* only enqueue frames on the clients' outbound queues, so they never block on a slow client
+    def post_text(self, text, targets):
+        room_logger.debug('{} {} : sending raw text {}, {}', self.room_type, self._name, text, targets, room=self._name)
         if not targets:
             targets = self.clients
-        sending_list = [self.server.send("{}".format(text), client.websocket) for client in targets]
-        if sending_list:
-            done, pending = await asyncio.wait(sending_list)
+        self.server.broadcast("{}".format(text), targets)
 
-    async def send_message(self, message, log = True, no_author = False):
+    def post_message(self, message, log = True, no_author = False):
         
         targets = message.targets
         author = message.author
         text = message.text
 
-        logger.debug('{} {} : sending chat message, author:{}, targets:{}, text:{}'.format(self.room_type, self._name, author, str(targets), text))
+        room_logger.debug('{} {} : sending chat message, author:{}, targets:{}, text:{}', self.room_type, self._name, author, targets, text, room=self._name)
 
         if not targets:
             targets = self.clients #If no target is set its a global (room) message
         if not no_author:
-            sending_list = [self.server.send("{}: {}".format(author.chat_name, text), client.websocket) for client in targets]
+            self.server.broadcast("{}: {}".format(author.chat_name, text), targets)
         else:
-            sending_list = [self.server.send("{}".format(text), client.websocket) for client in targets]
-        if sending_list:
-            done, pending = await asyncio.wait(sending_list)
+            self.server.broadcast("{}".format(text), targets)
         if log:
-            self.messages.append(message)
+            self.log_message(message)
 
-    async def send_system_message(self, msg):
+    def post_system_message(self, msg):
+        with tracing.span('send_system_message'):
+            self.publish_system_message(msg)
+
+    def publish_system_message(self, msg):
         targets = msg.targets
-        logger.debug('{} {} : sending system message, emitter:{}, msg_type:{}, targets:{}, args:{}'.format(self.room_type, self._name, msg.emitter,msg.msg_type, str(msg.targets), str(msg.args)))
+        room_logger.debug('{} {} : sending system message, emitter:{}, msg_type:{}, targets:{}, args:{}', self.room_type, self._name, msg.emitter, msg.msg_type, msg.targets, msg.args, room=self._name)
         if not targets:
             targets = self.clients #If no target is set its a global (room) message
-        sending_list = [self.server.send("sysmsg|{}|{}|{}".format(msg.emitter.uid, msg.msg_type, '|'.join([str(x) for x in msg.args])), client.websocket) for client in targets]
-        if sending_list:
-            done, pending = await asyncio.wait(sending_list)
+        self.server.broadcast(msg.encode(), targets, msg.msg_type, msg.emitter.uid, [msg])
 
     def __repr__(self):
         return 'room|'+self.uid+'|'+self.room_type+'|'+self._name
@@ -238,39 +663,139 @@ class SubRoom(Room):
     async def remove_client(self, client):
         await super(SubRoom, self).remove_client(client)
         if not self.clients: # Suicide
-            logger.debug('{} {} : destroying room.'.format(self.room_type, self._name))
+            room_logger.debug('{} {} : destroying room.', self.room_type, self._name, room=self._name)
             self.server.rooms.remove(self)
-            self = None
 
 
 class SkeletonRoom(SubRoom):
     chat_name = "Spooky voice"
     room_type = 'skeleton'
-    def __init__(self, server=None, loop=None, messages = None, clients = None, uid = None, _name = None, skeleton=None, players=None):
+    def __init__(self, server=None, loop=None, messages = None, clients = None, uid = None, _name = None, skeleton=None, players=None, batch_interval=None, start=True):
         super(SkeletonRoom, self).__init__(server, loop, messages, clients, uid, _name)
 
+        # When set, game events are collected for batch_interval seconds and sent as one sysbatch frame
+        self.batch_interval = batch_interval
+        self.pending_events = []
+        self.pending_event_index = {}
+        self.flush_handle = None
 
-        self.skeleton = skeleton or skeletons.Skeleton(loop = self.loop,name='skeleton')
         if not self._name:
             self._name = 'Skeleton fight'
-        self.skeleton.emit_message = self.handle_game_message
+        # An engine skeleton holds an engine row, which keeps the engine ticking, so pooled rooms
+        # only get theirs when reopened
+        if not skeleton and (start or self.server.combat_engine is None):
+            skeleton = self.new_skeleton()
+        self.set_skeleton(skeleton)
         self.players = players or []
-
-        logger.debug('{} {} : starting skeleton'.format(self.room_type, self._name))
+        self.ai_task = None
+        self.skeleton_running = False
+
+        # Pooled rooms are built with start=False and started by reopen()
+        if start:
+            game_logger.debug('{} {} : starting skeleton', self.room_type, self._name, room=self._name)
+            self.start_game()
+
+    def new_skeleton(self):
+        if self.server.combat_engine is not None:
+            return self.server.combat_engine.create_skeleton(name='skeleton')
+        return skeletons.Skeleton(loop = self.loop,name='skeleton', timers=self.server.timers)
+
+    def set_skeleton(self, skeleton):
+        self.skeleton = skeleton
+        self.room_state = roomstate.RoomState()
+        if skeleton:
+            skeleton.emit_message = self.handle_game_message
+            self.room_state.add(skeleton)
+
+    def reopen(self, name):
+        self._name = name or 'Skeleton fight'
+        if not self.skeleton:
+            self.set_skeleton(self.new_skeleton())
+        game_logger.debug('{} {} : starting pooled skeleton', self.room_type, self._name, room=self._name)
         self.start_game()
 
+    def recycle(self):
+        # Reset for the next fight once everybody left; False if the room can't be reused
+        if self.clients:
+            return False
+        self.close()
+        self.flush_events()
+        self.uid = sys.intern(str(uuid.uuid4())[:8])
+        self._name = 'Skeleton fight'
+        self.history = self.server.room_history(self.room_type, None)
+        self.players = []
+        if self.server.combat_engine is not None: # the old skeleton's row went back to the engine when it stopped
+            self.set_skeleton(None)
+        else:
+            self.skeleton.reset()
+            self.set_skeleton(self.skeleton)
+        return True
+
+    def close(self):
+        # The AI task of a fight that ended before it ran must not start the next one
+        if self.ai_task:
+            self.ai_task.cancel()
+            self.ai_task = None
+        self.stop_skeleton()
+
+    def stop_skeleton(self):
+        if self.skeleton_running:
+            self.skeleton_running = False
+            self.skeleton.stop()
+
     async def remove_client(self, client):
         await super(SkeletonRoom, self).remove_client(client)
-        if self and (not self.clients or not [client for client in self.clients if client.player.alive]):
+        if not self.clients or not [client for client in self.clients if client.player.alive]:
             if self in self.server.rooms:
-                logger.debug('{} {} : destroying skeleton room.'.format(self.room_type, self._name))
+                game_logger.debug('{} {} : destroying skeleton room.', self.room_type, self._name, room=self._name)
                 self.server.rooms.remove(self)  # Suicide
-            self = None
+            self.flush_events()
+        # Dead players may still be around to leave, the skeleton stops (and gives back its engine
+        # row) with the last of them
+        if not self.clients:
+            self.server.room_pool.release(self)
+
+    def post_message(self, message, log = True, no_author = False):
+        self.flush_events() # keep pending game events ahead of anything sent after them
+        super(SkeletonRoom, self).post_message(message, log, no_author)
+
+    def post_system_message(self, msg):
+        self.flush_events()
+        super(SkeletonRoom, self).post_system_message(msg)
+
+    def queue_game_event(self, msg):
+        if msg.msg_type in GameSystemMessage.coalescable_msg_types:
+            key = (msg.msg_type, msg.emitter.uid)
+            index = self.pending_event_index.get(key)
+            if index is not None:
+                self.pending_events[index] = None # superseded by the newer report
+            self.pending_event_index[key] = len(self.pending_events)
+        self.pending_events.append(msg)
+        if not self.flush_handle:
+            self.flush_handle = self.loop.call_later(self.batch_interval, self.flush_events)
+
+    def flush_events(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        events = [msg for msg in self.pending_events if msg]
+        self.pending_events = []
+        self.pending_event_index = {}
+        if not events or not self.clients:
+            return
+        self.note(command='flush_events')
+        if len(events) == 1:
+            frame = events[0].encode()
+        else:
+            frame = 'sysbatch|{}'.format('\n'.join([msg.encode() for msg in events]))
+        game_logger.debug('{} {} : sending {} batched game events', self.room_type, self._name, len(events), room=self._name)
+        self.server.broadcast(frame, self.clients, 'sysbatch', events=events)
 
     def handle_game_message(self, emitter, msg_type, *args):
-        logger.debug('{} {} : handling game message, emitter:{}, msg_type:{}, args:{}.'.format(self.room_type, self._name, emitter, msg_type, str(args)))
-        if not msg_type in GameSystemMessage.valid_msg_types:
-            logger.error("Invalid sys message received from game.")
+        self.note(command=msg_type)
+        game_logger.debug('{} {} : handling game message, emitter:{}, msg_type:{}, args:{}.', self.room_type, self._name, emitter, msg_type, args, room=self._name)
+        if not msg_type in GameSystemMessage.type_codes:
+            game_logger.error("Invalid sys message received from game.")
 
         if msg_type == 'ply_notify':
             player = emitter
@@ -281,38 +806,45 @@ class SkeletonRoom(SubRoom):
                     break
             if client:
                 message = Message(self, ' '.join([str(x) for x in args]), targets=[client])
-                self.loop.create_task(self.send_message(message, no_author=True))
+                self.post_message(message, no_author=True)
                 return 
 
         if msg_type == 'ai_new_target':
             target = args[0]
             args = [target.uid]
 
+        self.room_state.apply(emitter.uid, msg_type, args)
+
         #Send the message for the client to handle
         sys_message = SystemMessage(emitter, msg_type, list(args))
-        self.loop.create_task(self.send_system_message(sys_message))
+        if self.batch_interval:
+            self.queue_game_event(sys_message)
+        else:
+            self.post_system_message(sys_message)
 
 
     async def on_client_joined(self, client):
-        logger.debug('Client joined room {} {} : {}'.format(self.room_type, self._name, client.username))
+        self.note(client, 'join')
+        game_logger.debug('Client joined room {} {} : {}', self.room_type, self._name, client.username, room=self._name)
         await self.send_system_message(SystemMessage(self, 'joined_room',[self.uid, self.name, self.room_type], targets=[client]))
-        ply = skeletons.Player(uid=client.uid, loop = self.loop,name=client.username, target=self.skeleton, client=client)
+        if self.server.combat_engine is not None:
+            ply = self.server.combat_engine.create_player(uid=client.uid, name=client.username, target=self.skeleton, client=client)
+        else:
+            ply = skeletons.Player(uid=client.uid, loop = self.loop,name=client.username, target=self.skeleton, client=client, timers=self.server.timers)
         ply.target = self.skeleton
         ply.emit_message = self.handle_game_message
         client.player = ply
-        self.skeleton.targets.append(client.player)
-        logger.debug('{} {} : Sending client_joined_room sysmsg {}'.format(self.room_type, self._name, client))
+        record = self.room_state.add(ply)
+        self.skeleton.add_target(client.player)
+        game_logger.debug('{} {} : Sending client_joined_room sysmsg {}', self.room_type, self._name, client, room=self._name)
         await self.send_system_message(SystemMessage(self, 'client_joined_room',[client.uid, client.username]))
 
-        logger.debug('{} {} : Sending ui_setup_creature skeleton sysmsgs'.format(self.room_type, self._name))
-        ui_setup_msg = GameSystemMessage(self, 'ui_setup_creature', self.skeleton.full_report(), [client])
-        await self.send_system_message(ui_setup_msg)
-
-
-        for cl in self.clients:
-            ui_setup_msg = GameSystemMessage(self, 'ui_setup_creature', cl.player.full_report())
-            logger.debug('{} {} : Sending ui_setup_creature player sysmsg {}'.format(self.room_type, self._name, client))
-            await self.send_system_message(ui_setup_msg)
+        # The joiner gets every creature in one snapshot, everybody else only the new player
+        game_logger.debug('{} {} : Sending room_snapshot v{} to {}', self.room_type, self._name, self.room_state.version, client, room=self._name)
+        await self.send_system_message(GameSystemMessage(self, 'room_snapshot', self.room_state.snapshot(), [client]))
+        others = [cl for cl in self.clients if cl is not client]
+        if others:
+            await self.send_system_message(GameSystemMessage(self, 'ui_setup_creature', record.report(), others))
 
 
         #message = Message(self, '{} entered the skeleton fight!'.format(client.username))
@@ -323,17 +855,21 @@ class SkeletonRoom(SubRoom):
         
     async def on_client_disconnected(self, client):
         await super(SkeletonRoom, self).on_client_disconnected(client)
-        self.skeleton.targets.remove(client.player)
-        if self.skeleton.target == client.player:
-            self.skeleton.target = None
+        self.skeleton.remove_target(client.player)
+        self.room_state.remove(client.player.uid)
+        if self.server.combat_engine is not None:
+            self.server.combat_engine.release(client.player)
+        else:
+            client.player.stop() # a pending attack would land on the next fight's skeleton
         client.player = None
         #message = Message(self, '{} ran from the fight!'.format(client.username))
         #await self.send_message(message)
 
 
     def start_game(self):
-        logger.debug('{} {} : starting skeleton AI'.format(self.room_type, self._name))
-        ai_task = asyncio.ensure_future(self.skeleton.run())
+        game_logger.debug('{} {} : starting skeleton AI', self.room_type, self._name, room=self._name)
+        self.skeleton_running = True
+        self.ai_task = asyncio.ensure_future(self.skeleton.run())
         #player_task = asyncio.ensure_future(self.player.run())
 
     async def handle_command(self, message):
@@ -341,13 +877,14 @@ class SkeletonRoom(SubRoom):
         client = message.author
         text = message.text
         command, args = self.preprocess_command(message)
-        logger.debug('{} {} : handling command  author:{}, text:{}, command:{}, args:{}'.format(self.room_type, self._name, client, text, command, args))
+        game_logger.debug('{} {} : handling command  author:{}, text:{}, command:{}, args:{}', self.room_type, self._name, client, text, command, args, room=self._name)
         async def handle_attack(*args):
             max_args_len = 0
             if len(args) > max_args_len:
                 return "Too many arguments, expected {}".format(max_args_len)
 
-            await client.player.attack()
+            with tracing.span('player.attack'):
+                await client.player.attack()
             return 0
 
         async def handle_defense(*args):
@@ -355,7 +892,8 @@ class SkeletonRoom(SubRoom):
             if len(args) > max_args_len:
                 return "Too many arguments, expected {}".format(max_args_len)
 
-            await client.player.defend()
+            with tracing.span('player.defend'):
+                await client.player.defend()
             return 0
 
         async def handle_leave(*args):
@@ -367,11 +905,11 @@ class SkeletonRoom(SubRoom):
             await self.server.room.register_client(client) #back to lobby
             return 0
 
-
         available_commands = {
             "leave":handle_leave,
             'attack':handle_attack,
-            "defense":handle_defense
+            "defense":handle_defense,
+            "history":functools.partial(self.handle_history, client),
         }
         error_text = None
         
@@ -408,6 +946,7 @@ class ChatRoom(SubRoom):
 
         available_commands = {
             "leave":handle_leave,
+            "history":functools.partial(self.handle_history, client),
         }
 
         error_text = None
@@ -430,12 +969,12 @@ class LobbyRoom(Room):
     room_type = 'lobby'
     async def register_client(self, client):
         try:
-            logger.debug('{} {} : registering client {}'.format(self.room_type, self._name, client))
+            room_logger.debug('{} {} : registering client {}', self.room_type, self._name, client, room=self._name)
             self.clients.add(client)
             client.room = self
-            await self.send_system_message(SystemMessage(self, 'registered',[client.uid, client.username], targets=[client]))
+            await self.send_system_message(SystemMessage(self, 'registered',[client.uid, client.username, client.session_token or ''], targets=[client]))
             await self.on_client_joined(client)
-            logger.info('{} {} : registered client {}'.format(self.room_type, self._name, client))
+            room_logger.info('{} {} : registered client {}', self.room_type, self._name, client, room=self._name)
             return client
         except ClientAlreadyExistsException as e:
             await self.server.send('Client already registered', client.websocket)
@@ -446,7 +985,7 @@ class LobbyRoom(Room):
         text = message.text
         command, args = self.preprocess_command(message)
 
-        logger.debug('{} {} : handling command  author:{}, text:{}, command:{}, args:{}'.format(self.room_type, self._name, client, text, command, args))
+        room_logger.debug('{} {} : handling command  author:{}, text:{}, command:{}, args:{}', self.room_type, self._name, client, text, command, args, room=self._name)
 
         async def handle_join(*args):
             max_args_len = 1
@@ -454,11 +993,7 @@ class LobbyRoom(Room):
                 return "Too many arguments, expected {}".format(max_args_len)
             room_name = args[0]
 
-            new_room = None
-            for room in self.server.rooms:
-                if room.name == room_name:
-                    new_room = room
-                    break
+            new_room = self.server.rooms.get_by_name(room_name)
 
             if not new_room:
                 return "There is no room with name {}.".format(room_name)
@@ -479,15 +1014,14 @@ class LobbyRoom(Room):
                 return "Too few arguments, expected at least {}.".format(min_args_len)
             room_name = args[0]
 
-            for room in self.server.rooms:
-                if room.name == room_name:
-                    return "Room name {} is taken, choose another.".format(room_name)
+            if self.server.rooms.get_by_name(room_name):
+                return "Room name {} is taken, choose another.".format(room_name)
 
             new_room = ChatRoom(self.server, self.loop, _name=room_name)
-            
+            self.server.rooms.add(new_room)
+
             await client.room.remove_client(client)
             await new_room.register_client(client)
-            self.server.rooms.append(new_room)
             return 0
 
         async def handle_skeleton(*args):
@@ -498,31 +1032,38 @@ class LobbyRoom(Room):
 
             if len(args) > 0:
                 room_name = args[0]
+                if not self.valid_room_name(room_name):
+                    return "Invalid name"
+                owner = await self.server.claim_room(room_name)
             else:
-                room_name = random.choice([name for name in skeletons.Skeleton.skeleton_names if not name in [room.name for room in self.server.rooms]])
-            if not self.valid_room_name(room_name):
-                return "Invalid name"
+                room_name = await self.server.claim_skeleton_name()
+                if not room_name:
+                    return "All skeletons are busy, pick a name."
+                owner = None
+
+            if owner is not None: # the fight is on another worker
+                if await self.server.hand_off(client, owner, '::skeleton {}'.format(room_name)):
+                    return 0
+                return "That skeleton fight is unreachable right now."
 
-            new_room = None
-            for room in self.server.rooms:
-                if room.name == room_name:
-                    new_room = room
-                    if len(new_room.clients) > 1:
-                        return "That skeleton fight already has 2 warriors, you can't join."
+            new_room = self.server.rooms.get_by_name(room_name)
+            if new_room and len(new_room.clients) > 1:
+                return "That skeleton fight already has 2 warriors, you can't join."
 
             if not new_room:
-                new_room = SkeletonRoom(self.server, self.loop, _name = room_name)
-            
+                new_room = self.server.room_pool.acquire()
+                new_room.reopen(room_name)
+                self.server.rooms.add(new_room)
+
             await client.room.remove_client(client)
             await new_room.register_client(client)
-            self.server.rooms.append(new_room)
             return 0
 
-        
         available_commands = {
             #"join":handle_join,
             #"create":handle_create,
             "skeleton":handle_skeleton,
+            "history":functools.partial(self.handle_history, client),
         }
         error_text = None
         
@@ -537,88 +1078,578 @@ class LobbyRoom(Room):
             error_message = SystemMessage(emitter=self, msg_type='validation_error', args=[error_text], targets=[client])
             await self.send_system_message(error_message)
 
+    def post_message(self, message, log = True, no_author = False):
+        super(LobbyRoom, self).post_message(message, log, no_author)
+        if self.server and self.server.broker and not message.targets:
+            line = '{}: {}'.format(message.author.chat_name, message.text)
+            self.server.broker.publish('lobby', {'text': message.text if no_author else line, 'line': line if log else None})
+
+    async def on_client_joined(self, client):
+        await super(LobbyRoom, self).on_client_joined(client)
+        self.publish_presence('client_joined_room', client)
+
+    async def on_client_disconnected(self, client):
+        await super(LobbyRoom, self).on_client_disconnected(client)
+        self.publish_presence('client_left_room', client)
+
+    def publish_presence(self, msg_type, client):
+        if self.server and self.server.broker:
+            self.server.broker.publish('lobby', {'presence': msg_type, 'uid': client.uid, 'username': client.username})
+
+    def on_broker_message(self, message):
+        # Lobby chat, joins and leaves from another node
+        if 'presence' in message:
+            self.post_system_message(SystemMessage(self, message['presence'], [message['uid'], message['username']]))
+            return
+        self.server.broadcast(message['text'], self.clients)
+        if message['line'] is not None:
+            self.history.append(message['line'])
+
 class ChatServer:
-    def __init__(self, host=HOST, port=PORT, loop=None, messages = None, clients = None, rooms = None, skeletons = None):
+    def __init__(self, host=HOST, port=PORT, loop=None, messages = None, clients = None, rooms = None, skeletons = None, outbound_queue_size=256, overflow_policy='drop', session_grace=30, replay_size=256, binary_protocol=True, batch_interval=None, timer_tick=0.05, combat_engine=None, history_size=500, history_age=None, history_page_size=50, broker=None, metrics_host=HOST, metrics_port=None, slow_step_threshold=0.05, loop_lag_interval=0.25, trace_rate=0, trace_path='traces.jsonl', profile_dir='.', profile_seconds=30, room_pool_size=4, room_pool_max=64, admission_control=None, history_dir=None):
         self.host = host
         self.port = port
         self.loop = loop or asyncio.get_event_loop()
+        self.outbound_queue_size = outbound_queue_size
+        self.overflow_policy = overflow_policy
+        # Disconnected clients keep their place for session_grace seconds and can resume with their token
+        self.session_grace = session_grace
+        self.replay_size = replay_size
+        self.sessions = {}
+        self.binary_protocol = binary_protocol
+        # broker.Broker when this is one node of a game spread over several processes or hosts
+        self.broker = broker
+        self.batch_interval = batch_interval
+        self.history_size = history_size
+        self.history_age = history_age
+        self.history_page_size = history_page_size
+        # With history_dir, lobby and chat room history is kept on disk there and survives restarts;
+        # skeleton fights keep theirs in memory
+        self.chat_log = None
+        self.persistent_room_types = ('lobby', 'chat')
+        if history_dir:
+            if broker: # every node writes its own logs
+                history_dir = os.path.join(history_dir, broker.node)
+            self.chat_log = chatlog.ChatLogStore(history_dir, self.loop)
+        # Creature action timers share one coarse-grained wheel instead of a loop timer each
+        self.timers = timerwheel.TimerWheel(self.loop, tick=timer_tick)
+        # Optional combat.CombatEngine; when set, skeleton fights run on its vectorized arrays.
+        # True builds one on this loop, which is how cluster workers get theirs
+        if combat_engine is True:
+            import combat
+            combat_engine = combat.CombatEngine(self.loop)
+        self.combat_engine = combat_engine
         self.room = LobbyRoom(self, loop, messages, clients, _name='lobby room')
-        self.rooms = rooms or []
+        self.rooms = RoomRegistry(rooms, on_remove=self.room_removed)
+        # Server-wide indexes of connected clients, so per-frame lookups don't scan rooms
+        self.clients_by_websocket = {}
+        self.clients_by_username = {}
+        for client in self.room.clients:
+            self.register_client(client)
+        # Connection rate, per client frame rates and frame size limits
+        self.admission = admission_control or admission.AdmissionControl()
+        # Metrics are always collected; they are served over HTTP on metrics_port when it is set
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.setup_metrics()
+        # Loop lag and slow callback monitor, started with the server; slow_step_threshold=None turns it off
+        self.slow_step_threshold = slow_step_threshold
+        self.loop_health = loophealth.LoopHealth(self.loop, slow_step_threshold or 0, loop_lag_interval, registry=self.metrics)
+        # trace_rate of incoming messages are traced through the pipeline into trace_path
+        self.tracer = tracing.Tracer(trace_rate, trace_path)
+        # Sampling profiles of the loop thread, started with SIGUSR1 or the /profile admin page
+        self.profiler = profiler.SamplingProfiler(directory=profile_dir)
+        self.profile_seconds = profile_seconds
+        # Skeleton rooms built ahead and reused, so '::skeleton' doesn't construct one
+        self.room_pool = RoomPool(lambda: SkeletonRoom(self, self.loop, batch_interval=self.batch_interval, start=False),
+            room_pool_size, room_pool_max, loop=self.loop, registry=self.metrics)
+
+    def setup_metrics(self):
+        registry = self.metrics = metrics.Registry()
+        registry.add(self.admission.limited)
+        if self.chat_log:
+            registry.add(self.chat_log.records)
+            registry.add(self.chat_log.flush_seconds)
+            registry.gauge('skeleton_chatlog_unwritten_records', 'Chat log records waiting for the writer', self.chat_log.unwritten)
+        self.frames_received = registry.counter('skeleton_frames_received_total', 'Frames received from clients', ['type'])
+        self.bytes_received = registry.counter('skeleton_bytes_received_total', 'Payload bytes received from clients', ['type'])
+        self.frames_sent = registry.counter('skeleton_frames_sent_total', 'Frames broadcast to clients', ['type'])
+        self.bytes_sent = registry.counter('skeleton_bytes_sent_total', 'Payload bytes broadcast to clients', ['type'])
+        self.command_seconds = registry.histogram('skeleton_command_seconds', 'Time spent handling a :: command', ['room_type'])
+        self.broadcast_seconds = registry.histogram('skeleton_broadcast_seconds', 'Time spent fanning a frame out to client queues')
+        registry.gauge('skeleton_connected_clients', 'Clients with a live connection', lambda: len(self.clients_by_websocket))
+        registry.gauge('skeleton_detached_sessions', 'Disconnected clients waiting to resume', lambda: len([client for client in self.sessions.values() if client.session_expiry]))
+        registry.gauge('skeleton_lobby_clients', 'Clients in the lobby', lambda: len(self.room.clients))
+        registry.gauge('skeleton_rooms', 'Open rooms', self.room_counts, ['room_type'])
+        registry.gauge('skeleton_ai_running', 'Skeletons whose AI is running', lambda: len([room for room in self.rooms if room.room_type == 'skeleton' and room.skeleton.active]))
+        registry.gauge('skeleton_outbound_queued_frames', 'Frames waiting in client outbound queues', lambda: sum(self.queue_depths().values()))
+        registry.gauge('skeleton_timers_pending', 'Creature action timers pending on the timer wheel', lambda: self.timers.pending)
+
+    def room_counts(self):
+        counts = {SkeletonRoom.room_type: 0, ChatRoom.room_type: 0}
+        for room in self.rooms:
+            counts[room.room_type] = counts.get(room.room_type, 0) + 1
+        return counts
+
+    def received(self, text):
+        kind = 'command' if text.startswith('::') else 'chat'
+        self.frames_received.inc(kind)
+        self.bytes_received.inc(kind, metrics.frame_size(text))
 
     def __str__(self):
         return "ChatServer"
 
     def get_client(self, websocket):
-        client = self.room.get_client(websocket)
+        return self.clients_by_websocket.get(websocket)
+
+    def register_client(self, client):
+        if client.websocket in self.clients_by_websocket or client.username in self.clients_by_username:
+            raise ClientAlreadyExistsException()
+        self.clients_by_websocket[client.websocket] = client
+        self.clients_by_username[client.username] = client
+        if client.websocket is not None and client.outbox is None:
+            client.outbox = OutboundQueue(client, self.loop, self.outbound_queue_size, self.overflow_policy, self.replay_size)
+            client.outbox.start()
+        if self.session_grace and not client.session_token:
+            client.session_token = secrets.token_urlsafe(16)
+            if self.broker: # so any node can tell where the session lives
+                client.session_token = '{}.{}'.format(self.broker.node, client.session_token)
+            self.sessions[client.session_token] = client
+
+    def remove_client(self, client):
+        if self.clients_by_websocket.get(client.websocket) is client:
+            del self.clients_by_websocket[client.websocket]
+        if self.clients_by_username.get(client.username) is client:
+            del self.clients_by_username[client.username]
+            if self.broker:
+                self.broker.release_username(client.username)
+        if client.outbox is not None:
+            client.outbox.close()
+        if self.sessions.get(client.session_token) is client:
+            del self.sessions[client.session_token]
+        if client.session_expiry:
+            client.session_expiry.cancel()
+            client.session_expiry = None
+
+    async def drop_client(self, client):
+        self.remove_client(client)
+        if client.room:
+            await client.room.remove_client(client)
+
+    def detach_client(self, client):
+        # Keep the client (and its room, player and username) for session_grace seconds
+        session_logger.debug('Client {} disconnected, keeping session for {}s', client, self.session_grace)
+        if self.clients_by_websocket.get(client.websocket) is client:
+            del self.clients_by_websocket[client.websocket]
+        if client.outbox is not None:
+            client.outbox.detach()
+        client.session_expiry = self.loop.call_later(self.session_grace, self.expire_session, client)
+
+    def expire_session(self, client):
+        session_logger.debug('Session of client {} expired', client)
+        client.session_expiry = None
+        self.loop.create_task(self.drop_client(client))
+
+    async def resume_session(self, websocket, text):
+        # text is '::resume <token> <last received frame seq>'
+        args = text.split(' ')
+        if len(args) != 3 or not args[2].isdigit():
+            return None
+        client = self.sessions.get(args[1])
         if not client:
-            for room in self.rooms:
-                client = room.get_client(websocket)
-                if client:
-                    return client
-        else:
-            return client
+            return None
+        last_seq = int(args[2])
+        if client.outbox is None or not client.outbox.can_replay(last_seq) or client.binary != self.is_binary(websocket):
+            # Replayed frames are already encoded for the old connection's protocol
+            session_logger.debug('Cannot replay frames after {} for client {}, dropping session', last_seq, client)
+            await self.drop_client(client)
+            return None
+
+        old_websocket = client.websocket
+        if self.clients_by_websocket.get(old_websocket) is client:
+            # Resumed from a new connection before the old one noticed it was dead
+            del self.clients_by_websocket[old_websocket]
+            self.loop.create_task(old_websocket.close())
+        client.outbox.detach()
+        if client.session_expiry:
+            client.session_expiry.cancel()
+            client.session_expiry = None
+        client.websocket = websocket
+        self.clients_by_websocket[websocket] = client
+        session_logger.info('Client {} resumed session after frame {}', client, last_seq)
+        await websocket.send('sysmsg|{}|resumed|{}'.format(client.uid, last_seq))
+        client.outbox.attach(last_seq)
+        return client
+
+    async def join_broker(self):
+        await self.broker.start()
+        self.broker.subscribe('lobby', self.room.on_broker_message)
+
+    async def claim_username(self, username):
+        # Without the broker the node carries on alone, where valid_username keeps usernames unique
+        if not self.broker:
+            return True
+        try:
+            return await self.broker.claim_username(username)
+        except ConnectionError as e:
+            logger.warning('Could not claim username {} through the broker: {!r}', username, e)
+            return True
+
+    async def claim_room(self, name):
+        # None if the room is (or is now) hosted here, else the node hosting it
+        if not self.broker or self.rooms.get_by_name(name):
+            return None
+        try:
+            owner = await self.broker.claim_room(name)
+        except ConnectionError as e:
+            logger.warning('Could not claim room {} through the broker, hosting it here: {!r}', name, e)
+            return None
+        if owner == self.broker.node:
+            return None
+        return owner
+
+    async def claim_skeleton_name(self, attempts=5):
+        # A random free skeleton name that no other node is using either
+        tried = set()
+        for _ in range(attempts):
+            name = self.rooms.random_skeleton_name()
+            if not name or name in tried:
+                continue
+            if await self.claim_room(name) is None:
+                return name
+            tried.add(name)
         return None
 
+    def room_history(self, room_type, name):
+        if self.chat_log and name and room_type in self.persistent_room_types:
+            return self.chat_log.open('{}-{}'.format(room_type, name), self.history_size, self.history_age)
+        return history.RoomHistory(self.history_size, self.history_age)
+
+    def room_removed(self, room):
+        if self.broker and room.name:
+            self.broker.release_room(room.name)
+
+    def session_node(self, text):
+        # Node holding the session of a '::resume <token> <seq>' line, if it is another live one
+        args = text.split(' ')
+        if not self.broker or len(args) < 2:
+            return None
+        node, dot, token = args[1].partition('.')
+        if not dot or node == self.broker.node or not self.broker.address_of(node):
+            return None
+        return node
+
+    async def redirect(self, websocket, node, token=''):
+        # Ask the client to reconnect to another node
+        host, port = self.broker.address_of(node)
+        session_logger.debug('Redirecting {} to node {} at {}:{}', websocket, node, host, port)
+        try:
+            await websocket.send('sysmsg||redirect|{}|{}|{}'.format(host, port, token))
+            await websocket.close()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def hand_off(self, client, node, command):
+        # Move a client to another node, which runs command for it once it reconnects there
+        if not self.broker.address_of(node):
+            return False
+        try:
+            token = await self.broker.handoff(node, client.username, client.uid, command)
+        except ConnectionError as e:
+            logger.warning('Could not hand client {} off to node {}: {!r}', client, node, e)
+            return False
+        if not token:
+            return False
+        session_logger.info('Handing client {} off to node {} for {}', client, node, command)
+        websocket = client.websocket
+        await self.drop_client(client)
+        await self.redirect(websocket, node, token)
+        return True
+
+    async def take_handoff(self, websocket, text, binary):
+        # text is '::handoff <token>'
+        args = text.split(' ')
+        if len(args) != 2 or not self.broker:
+            return None
+        try:
+            handoff = await self.broker.take_handoff(args[1])
+        except ConnectionError as e:
+            logger.warning('Could not take a handoff: {!r}', e)
+            return None
+        if not handoff:
+            return None
+        client = Client(uid=handoff['uid'], websocket=websocket, username=sys.intern(handoff['username']), binary=binary)
+        self.register_client(client)
+        await self.room.register_client(client)
+        session_logger.info('Took over client {} for {}', client, handoff['command'])
+        await client.room.handle_message(client, handoff['command'])
+        return client
+
     async def send(self, text, websocket):
-        logger.debug('Server sending: {}'.format(text))
+        net_logger.debug('Server sending: {}', text)
         await websocket.send(text)
 
+    def broadcast(self, text, clients, msg_type=None, key=None, events=None):
+        # Frame is built once by the caller and only enqueued here; each client's writer task sends it.
+        # When the frame carries system messages, binary clients get them packed, encoded on first use.
+        clients = list(clients)
+        if not clients:
+            return
+        with tracing.span('broadcast'):
+            self.fan_out(text, clients, msg_type, key, events)
+
+    def fan_out(self, text, clients, msg_type, key, events):
+        started = time.perf_counter()
+        net_logger.debug('Server broadcasting to {} clients: {}', len(clients), text)
+        binary = None
+        binary_clients = 0
+        for client in clients:
+            frame = text
+            if events and client.binary:
+                if binary is None:
+                    try:
+                        binary = WIRE.encode(events)
+                    except ValueError as e:
+                        # Doesn't fit the binary format, the text frame works for every client
+                        net_logger.warning('Sending {} events as text: {}', len(events), e)
+                        binary = False
+                if binary:
+                    frame = binary
+                    binary_clients += 1
+            if client.outbox is not None:
+                client.outbox.put(frame, msg_type, key)
+            else:
+                self.loop.create_task(self.send(frame, client.websocket))
+        kind = msg_type or 'text'
+        size = metrics.frame_size(text) * (len(clients) - binary_clients)
+        if binary_clients:
+            size += len(binary) * binary_clients
+        self.frames_sent.inc(kind, len(clients))
+        self.bytes_sent.inc(kind, size)
+        self.broadcast_seconds.observe(time.perf_counter() - started)
+
+    def queue_depths(self):
+        return {client.username: client.queue_depth for client in self.clients_by_username.values()}
+
     def valid_username(self, text):
         if not text.strip() or ':' in text:
             return False
+        return not text in self.clients_by_username
+
+    def profile_page(self, query):
+        # /profile?seconds=N starts a profile, /profile/stop ends it early
+        if 'stop' in query:
+            if not self.profiler.running:
+                return 'No profile is running\n'
+            self.profiler.stop()
+            return 'Profile stopped, see {}\n'.format(self.profiler.path)
+        try:
+            seconds = float(query.get('seconds', self.profile_seconds))
+        except ValueError:
+            return 'seconds should be a number\n'
+        path = self.profiler.start(seconds)
+        if not path:
+            return 'A profile is already running into {}\n'.format(self.profiler.path)
+        return 'Profiling for {}s into {}\n'.format(seconds, path)
+
+    def trace_page(self, query):
+        # /trace?rate=0.01 traces 1% of incoming messages from now on
+        if 'rate' in query:
+            try:
+                self.tracer.rate = min(1.0, max(0.0, float(query['rate'])))
+            except ValueError:
+                return 'rate should be a number between 0 and 1\n'
+            self.tracer.flush()
+        return 'Tracing {:.2%} of messages into {}, {} traced so far\n'.format(self.tracer.rate, self.tracer.path, self.tracer.traced)
+
+    def log_page(self, query):
+        # /log?category=room&level=debug&sample=0.1&rate=100 changes a category, /log?room=name traces
+        # one room's debug records (&off=1 stops)
+        try:
+            if 'category' in query:
+                logs.configure(query['category'], query.get('level'), query.get('sample'), query.get('rate'), query.get('burst'))
+            elif 'level' in query:
+                logging.getLogger(logs.ROOT).setLevel(query['level'].upper())
+        except ValueError as e:
+            return '{}\n'.format(e)
+        if 'room' in query:
+            logs.trace_room(query['room'], 'off' not in query)
+        return logs.describe()
+
+    async def admit(self, websocket, client, limits, kind, text):
+        # Applies the admission limits to a frame; False if it must not be handled
+        verdict = self.admission.check(limits, kind, text)
+        if verdict is None:
+            return True
+        action, wait = verdict
+        if action == 'delay':
+            await asyncio.sleep(wait)
+            return True
+        if action == 'warn':
+            reason = 'Slow down.' if wait else 'Message too long, the limit is {} characters.'.format(self.admission.max_frame_size)
+            if client:
+                client.room.post_system_message(SystemMessage(client.room, 'validation_error', [reason], targets=[client]))
+            else:
+                await websocket.send('sysmsg||validation_error|{}'.format(reason))
+        elif action == 'disconnect':
+            net_logger.info('Disconnecting {} over its {} limit', client or websocket.remote_address, kind)
+            await websocket.close(1008, 'Admission limit exceeded')
+        return False
 
-        for client in self.room.clients:
-            if client.username == text:
-                return False
-        for room in self.rooms:
-            for client in room.clients:
-                if client.username == text:
-                    return False
-        return True
+    def is_binary(self, websocket):
+        return self.binary_protocol and websocket.subprotocol == wire.SUBPROTOCOL
 
     async def handler(self, websocket, path):
         client = None
+        if not self.admission.admit_connection():
+            net_logger.debug('Refusing connection from {}, too many new connections', websocket.remote_address)
+            await websocket.close(1013, 'Too many new connections, try again later')
+            return
+        limits = self.admission.connection()
+        binary = self.is_binary(websocket)
+        if binary:
+            try:
+                await websocket.send('sysmsg||protocol|{}'.format('|'.join(WIRE.setup_args())))
+            except websockets.exceptions.ConnectionClosed:
+                return
         while True:
             try:
                 client = self.get_client(websocket)
                 if not client:
-                    logger.info("Unregistered client connection")
-                    client = Client(websocket=websocket)
-                    logger.debug("Prompting for username")
+                    net_logger.info("Unregistered client connection")
+                    client = Client(websocket=websocket, binary=binary)
+                    net_logger.debug("Prompting for username")
                     await websocket.send('sysmsg||username_prompt')
                     username = await websocket.recv()
-                    
-                    if not self.valid_username(username):
-                        logger.debug("Received invalid username: {}".format(username))
+                    self.frames_received.inc('login')
+                    self.bytes_received.inc('login', metrics.frame_size(username))
+                    if not await self.admit(websocket, None, limits, 'handshake', username):
+                        continue
+
+                    if username.startswith('::resume '):
+                        node = self.session_node(username)
+                        if node is not None:
+                            await self.redirect(websocket, node)
+                            break
+                        client = await self.resume_session(websocket, username)
+                        if not client:
+                            await websocket.send('sysmsg||resume_failed')
+                        continue
+
+                    if username.startswith('::handoff '):
+                        client = await self.take_handoff(websocket, username, binary)
+                        if not client:
+                            await websocket.send('sysmsg||resume_failed')
+                        continue
+
+                    if not self.valid_username(username) or not await self.claim_username(username):
+                        net_logger.debug("Received invalid username: {}", username)
                         await websocket.send('sysmsg||username_invalid')
                         continue
-                    logger.debug("Received valid username: {}".format(username))
-                    client.username = username
+                    net_logger.debug("Received valid username: {}", username)
+                    client.username = sys.intern(username)
+                    self.register_client(client)
                     await self.room.register_client(client)
                     
                 text = await websocket.recv()
-                logger.debug(' '.join(['Received from ',client.username,':', text]))
-                response = await client.room.handle_message(client, text)
+                self.received(text)
+                if client.limits is None:
+                    client.limits = limits
+                if not await self.admit(websocket, client, client.limits, 'command' if text.startswith('::') else 'chat', text):
+                    if websocket.closed: # disconnected over a limit, don't read what it already sent
+                        await self.connection_lost(client, websocket)
+                        break
+                    continue
+                trace = self.tracer.begin(client=client.username, room=client.room.room_type, msg=text[:80])
+                try:
+                    net_logger.debug('Received from {} : {}', client.username, text, client=client.username, room=client.room._name)
+                    with tracing.span('room.handle_message'):
+                        response = await client.room.handle_message(client, text)
+                    with tracing.span('get_client'):
+                        handed_off = self.get_client(websocket) is not client
+                finally:
+                    if trace:
+                        self.tracer.end(trace)
+                if handed_off:
+                    break # handed off to another node
 
             except websockets.exceptions.ConnectionClosed as e:
-                if client and client.room:
-                    await client.room.remove_client(client)                    
+                await self.connection_lost(client, websocket)
                 break
 
+    async def connection_lost(self, client, websocket):
+        if client and client.websocket is websocket:
+            if client.session_token in self.sessions:
+                self.detach_client(client)
+            else:
+                await self.drop_client(client)
+
     def run(self):
+        setup_logging()
         logger.info('Starting server')
-        self.websocket_server = websockets.serve(self.handler, self.host, self.port, timeout=60)
-        self.loop.run_until_complete(self.websocket_server)
-        asyncio.async(wakeup()) #HACK so keyboard interrupt works on Windows
+        subprotocols = [wire.SUBPROTOCOL] if self.binary_protocol else None
+        # Frames far over the admission limit are refused by the protocol before they are buffered
+        max_size = self.admission.max_frame_size * 4 if self.admission.max_frame_size else None
+        if self.broker:
+            # Nodes on one host share the public port; each also listens on the port it is redirected to
+            self.loop.run_until_complete(self.join_broker())
+            servers = [websockets.serve(self.handler, self.host, self.port, timeout=60, subprotocols=subprotocols, max_size=max_size, reuse_port=True)]
+            if int(self.broker.address[1]) != int(self.port):
+                servers.append(websockets.serve(self.handler, self.host, self.broker.address[1], timeout=60, subprotocols=subprotocols, max_size=max_size))
+        else:
+            servers = [websockets.serve(self.handler, self.host, self.port, timeout=60, subprotocols=subprotocols, max_size=max_size)]
+        self.websocket_servers = [self.loop.run_until_complete(server) for server in servers]
+        if self.slow_step_threshold is not None:
+            for handler in logging.getLogger(logs.ROOT).handlers: # the queue handler, in case something else is added
+                self.loop_health.watch_handler(handler)
+            self.loop_health.start()
+        self.room_pool.start()
+        try:
+            self.loop.add_signal_handler(signal.SIGUSR1, self.profiler.toggle, self.profile_seconds)
+        except (AttributeError, NotImplementedError): # no SIGUSR1 on Windows
+            pass
+        if self.metrics_port is not None:
+            # The metrics port doubles as the admin interface, keep it private
+            self.metrics_server = metrics.MetricsServer(self.metrics, self.loop)
+            self.metrics_server.add_page('/loop', 'application/json', lambda query: json.dumps(self.loop_health.report(), indent=2))
+            self.metrics_server.add_page('/profile', 'text/plain; charset=utf-8', self.profile_page)
+            self.metrics_server.add_page('/profile/stop', 'text/plain; charset=utf-8', lambda query: self.profile_page({'stop': '1'}))
+            self.metrics_server.add_page('/trace', 'text/plain; charset=utf-8', self.trace_page)
+            self.metrics_server.add_page('/log', 'text/plain; charset=utf-8', self.log_page)
+            self.loop.run_until_complete(self.metrics_server.start(self.metrics_host, self.metrics_port))
+            logger.info('Serving metrics on port {}', self.metrics_port)
+        asyncio.ensure_future(wakeup()) #HACK so keyboard interrupt works on Windows
         self.loop.run_forever()
         self.loop.close()
         self.clean_up()
 
     def clean_up(self):
         logger.info('Cleaning up ')
-        self.websocket_server.close()
+        self.timers.close()
+        self.loop_health.stop()
+        self.room_pool.close()
+        if self.chat_log:
+            self.chat_log.close()
+        self.profiler.stop()
+        self.tracer.close()
+        if self.combat_engine is not None:
+            self.combat_engine.close()
+        for websocket_server in self.websocket_servers:
+            websocket_server.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+        if self.broker:
+            self.broker.close()
         for task in asyncio.Task.all_tasks():
             task.cancel()
+        logs.shutdown()
+
+
+def setup_logging():
+    # Set SKELETON_LOG_LEVEL=DEBUG for the per-message debug log, or turn it on for single categories
+    # and rooms at runtime through the /log page of the metrics port
+    logs.setup(LOG_FILE, level=os.environ.get('SKELETON_LOG_LEVEL', 'INFO'))
 
 
 async def wakeup(): # HACK  http://stackoverflow.com/questions/27480967/why-does-the-asyncios-event-loop-suppress-the-keyboardinterrupt-on-windows
@@ -627,9 +1658,22 @@ async def wakeup(): # HACK  http://stackoverflow.com/questions/27480967/why-does
 
 if __name__ == '__main__':
     args = sys.argv[1:]
+    # SKELETON_COMBAT_ENGINE=1 runs skeleton fights on the vectorized combat engine (needs numpy)
+    combat_engine = True if os.environ.get('SKELETON_COMBAT_ENGINE', '0') not in ('', '0') else None
     if len(args) > 0:
         PORT = args[0]
+    if len(args) > 1: # python server.py <port> <workers> [<broker host:port> <host clients reach this box at> <node prefix>]
+        import cluster
+        setup_logging()
+        broker_address = None
+        if len(args) > 2:
+            broker_host, broker_port = args[2].rsplit(':', 1)
+            broker_address = (broker_host, int(broker_port))
+        cluster.run(int(args[1]), HOST, PORT, ChatServer, broker_address=broker_address,
+            advertise_host=args[3] if len(args) > 3 else '127.0.0.1', node_prefix=args[4] if len(args) > 4 else None,
+            metrics_port=METRICS_PORT, history_dir=HISTORY_DIR, combat_engine=combat_engine)
+        sys.exit()
 
     loop = asyncio.get_event_loop()
-    chat = ChatServer(loop=loop, port=PORT, host=HOST)
+    chat = ChatServer(loop=loop, port=PORT, host=HOST, metrics_port=METRICS_PORT, history_dir=HISTORY_DIR, combat_engine=combat_engine)
     chat.run()
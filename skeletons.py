@@ -1,14 +1,60 @@
-from transitions import Machine
 import asyncio
 import random
 import concurrent
+import sys
 import uuid
 
+class MachineError(Exception):
+    pass
+
+class StateMachine():
+    # Transition table compiled once per class: states are integer codes, each trigger maps a source
+    # code straight to (dest code, after callback), and callbacks are resolved to functions up front.
+    def __init__(self, model_class, states, initial, transitions, after_state_change=None):
+        self.states = list(states)
+        self.codes = {state: code for code, state in enumerate(self.states)}
+        self.initial = self.codes[initial]
+        self.table = {}
+        for trigger, source, dest, after in transitions:
+            row = self.table.setdefault(trigger, [None] * len(self.states))
+            row[self.codes[source]] = (self.codes[dest], getattr(model_class, after) if after else None)
+        self.after_state_change = getattr(model_class, after_state_change) if after_state_change else None
+
+    def trigger(self, model, trigger):
+        transition = self.table[trigger][model.state_code]
+        if transition is None:
+            raise MachineError("Can't trigger event {} from state {}!".format(trigger, self.states[model.state_code]))
+        model.state_code, after = transition
+        if after:
+            after(model)
+        if self.after_state_change:
+            self.after_state_change(model)
+        return True
+
 class Creature:
+    __slots__ = ('uid', 'name', 'alive', 'max_health', 'health', 'defense', 'target', 'damage', 'action_time',
+                 'action_task', 'timers', 'death_listeners', 'machine', 'state_code', 'emit_message')
     states = ['idle', 'attacking', 'defending', 'dead']
-    def __init__(self, name, uid=None, alive=True, machine=None, max_health=100, damage=5, action_time=3, target=None):
-        self.uid = uid or str(uuid.uuid4())[:8]
+    transitions = [
+        # trigger, source, dest, after
+        ('begin_attack', 'idle', 'attacking', 'on_begin_attack'),
+        ('interrupt', 'attacking', 'idle', 'on_interrupt'),
+        ('begin_defense', 'idle', 'defending', 'on_defend'),
+        ('action_complete', 'attacking', 'idle', 'on_attack'),
+        ('action_complete', 'defending', 'idle', 'stop_defense'),
+    ] + [('die', state, 'dead', 'on_death') for state in states if state != 'dead']
+
+    @classmethod
+    def compiled_machine(cls):
+        # Built on first use for each class so subclass overrides of the callbacks are picked up
+        if not '_machine' in cls.__dict__:
+            cls._machine = StateMachine(cls, cls.states, 'idle', cls.transitions, after_state_change='alert_state_change')
+        return cls._machine
+
+    def __init__(self, name, uid=None, alive=True, machine=None, max_health=100, damage=5, action_time=3, target=None, timers=None):
+        self.uid = sys.intern(uid or str(uuid.uuid4())[:8])
         self.name = name
+        self.emit_message = self.print_message # rooms replace this to receive game events
         self.alive = alive
         self.max_health = max_health
         self.health = 100
@@ -19,17 +65,30 @@ class Creature:
         self.action_time = action_time
 
         self.action_task = None
+        self.timers = timers # shared TimerWheel, falls back to loop.call_later when not set
+        self.death_listeners = []
+
+        self.machine = machine or type(self).compiled_machine()
+        self.state_code = self.machine.initial
+
+    @property
+    def state(self):
+        return self.machine.states[self.state_code]
+
+    def begin_attack(self):
+        return self.machine.trigger(self, 'begin_attack')
 
-        self.machine = machine or Machine(model=self, states=Creature.states, initial='idle', after_state_change='alert_state_change')
-        self.machine.add_transition(trigger='begin_attack', source='idle', dest='attacking', after = 'on_begin_attack')
-        self.machine.add_transition(trigger='interrupt', source='attacking', dest='idle', after = 'on_interrupt')
-        self.machine.add_transition(trigger='begin_defense', source='idle', dest='defending', after = 'on_defend')
-        self.machine.add_transition(trigger='action_complete', source='attacking', dest='idle', after='on_attack')
-        self.machine.add_transition(trigger='action_complete', source='defending', dest='idle', after='stop_defense')
+    def interrupt(self):
+        return self.machine.trigger(self, 'interrupt')
 
-        for state in Creature.states:
-            if state != 'dead':
-                self.machine.add_transition(trigger='die', source=state, dest='dead', after='on_death')
+    def begin_defense(self):
+        return self.machine.trigger(self, 'begin_defense')
+
+    def action_complete(self):
+        return self.machine.trigger(self, 'action_complete')
+
+    def die(self):
+        return self.machine.trigger(self, 'die')
 
     def full_report(self):
         rep = [str(x) for x in [self.uid, self.name, self.alive, self.max_health, self.health, self.state]]
@@ -37,7 +96,7 @@ class Creature:
             rep.append(str(self.target.name))
         return rep
 
-    def emit_message(self, emitter, msg_type, *args):
+    def print_message(self, emitter, msg_type, *args):
         print(args)
 
     def check_alive(self):
@@ -72,6 +131,8 @@ class Creature:
 
     def on_death(self):
         self.emit_message(self, "creature_death")
+        for listener in list(self.death_listeners):
+            listener(self)
 
     def on_interrupt(self):
         self.action_task.cancel()
@@ -94,12 +155,36 @@ class Creature:
         self.emit_message(self, "creature_no_def")
         self.defense = False
 
+    def stop(self):
+        if self.action_task:
+            self.action_task.cancel()
+            self.action_task = None
+
+    def reset(self):
+        # Back to a fresh creature so the object can be reused, once it was stopped
+        self.alive = True
+        self.health = self.max_health
+        self.defense = False
+        self.target = None
+        self.death_listeners = []
+        self.state_code = self.machine.initial
+        self.emit_message = self.print_message
+
+    def call_later(self, delay, callback):
+        if self.timers:
+            return self.timers.call_later(delay, callback)
+        return self.loop.call_later(delay, callback)
+
+    def schedule_action(self):
+        self.action_task = self.call_later(self.action_time, self.action_complete)
+
     async def run(self):
         self.emit_message(self, 'creature_start')
 
     
 
 class Skeleton(Creature):
+    __slots__ = ('loop', 'targets', 'living_targets', 'think_interval', 'think_handle', 'last_think', 'active')
 
     skeleton_names = [
         "Abanquetan","Chafret","Frastin","Lebald","Roset",
@@ -147,42 +232,106 @@ class Skeleton(Creature):
         "Celota","Fraer","Launde","Rohelwynne","Zenwy",
         "Cemettig","Frames","Leasach","Rohild","Zoranz",
     ]
-    def __init__(self, name, uid = None, loop = None, alive=True, machine=None, max_health=100,  damage=5,action_time=3, target=None, targets=None):
-        super(Skeleton, self).__init__(name, uid, alive, machine, max_health, damage,action_time, target)
+    def __init__(self, name, uid = None, loop = None, alive=True, machine=None, max_health=100,  damage=5,action_time=3, target=None, targets=None, timers=None, think_interval=1):
+        super(Skeleton, self).__init__(name, uid, alive, machine, max_health, damage,action_time, target, timers=timers)
         self.loop = loop or asyncio.get_event_loop()
-        self.targets = targets or []
+        self.targets = []
+        self.living_targets = set()
+
+        # The AI only thinks when something happens (target joined/died/left, action finished),
+        # at most once per think_interval seconds
+        self.think_interval = think_interval
+        self.think_handle = None
+        self.last_think = None
+        self.active = False
+
+        for target in targets or []:
+            self.add_target(target)
+
+    def add_target(self, creature):
+        self.targets.append(creature)
+        if creature.alive:
+            self.living_targets.add(creature)
+        creature.death_listeners.append(self.on_target_died)
+        self.request_think()
+
+    def remove_target(self, creature):
+        if creature in self.targets:
+            self.targets.remove(creature)
+        self.living_targets.discard(creature)
+        if self.on_target_died in creature.death_listeners:
+            creature.death_listeners.remove(self.on_target_died)
+        if self.target == creature:
+            self.target = None
+        self.request_think()
+
+    def on_target_died(self, creature):
+        self.living_targets.discard(creature)
+        self.request_think()
+
+    def alert_state_change(self):
+        super(Skeleton, self).alert_state_change()
+        if self.state == 'idle':
+            self.request_think()
+
+    def request_think(self):
+        if not self.active or not self.alive or self.think_handle:
+            return
+        delay = 0
+        if self.last_think is not None:
+            delay = self.last_think + self.think_interval - self.loop.time()
+        if delay > 0:
+            self.think_handle = self.call_later(delay, self.think)
+        else:
+            # Deferred so the AI never fires a trigger from inside another transition's callbacks
+            self.think_handle = self.loop.call_soon(self.think)
+
+    def think(self):
+        self.think_handle = None
+        if not self.active or not self.alive:
+            return
+        self.last_think = self.loop.time()
+        if not self.target or not self.target.alive:
+            if not self.living_targets:
+                return
+            self.target = random.choice(list(self.living_targets))
+            #self.emit_message(self, 'Skeleton picked a new target: {}'.format(self.target.name))
+            self.emit_message(self,"ai_new_target", self.target)
+
+        if self.target and self.target.alive:
+            if self.state == 'idle':
+                dice_roll = random.choice([1, 2])
+                if dice_roll == 1:
+                    #defend
+                    self.begin_defense()
+                    self.schedule_action()
+                elif dice_roll:
+                    #attack
+                    self.begin_attack()
+                    self.schedule_action()
 
     async def run(self):
         await super(Skeleton, self).run()
-        while True:
-            if self.alive:
-                if not self.target or not self.target.alive:
-                    if len([x for x in self.targets if x.alive]) == 0:
-                        await asyncio.sleep(5)
-                    else:
-                        self.target = random.choice(self.targets)
-                        #self.emit_message(self, 'Skeleton picked a new target: {}'.format(self.target.name))
-                        self.emit_message(self,"ai_new_target", self.target)
-
-                if self.target and self.target.alive:
-                    if self.state == 'idle':
-                        dice_roll = random.choice([1, 2])
-                        if dice_roll == 1:
-                            #defend
-                            self.begin_defense()
-                            self.action_task = self.loop.call_later(self.action_time, self.action_complete)
-                        elif dice_roll:
-                            #attack
-                            self.begin_attack()
-                            self.action_task = self.loop.call_later(self.action_time, self.action_complete)  
-            else:
-                break
+        self.active = True
+        self.request_think()
+
+    def stop(self):
+        self.active = False
+        if self.think_handle:
+            self.think_handle.cancel()
+            self.think_handle = None
+        super(Skeleton, self).stop()
 
-            await asyncio.sleep(1)
+    def reset(self):
+        super(Skeleton, self).reset()
+        self.targets = []
+        self.living_targets = set()
+        self.last_think = None
 
 class Player(Creature):
-    def __init__(self, name, uid=None, loop = None, alive=True, machine=None, max_health=100, damage=20, action_time=2, target=None, client=None):
-        super(Player, self).__init__(name, uid, alive, machine, max_health, damage, action_time, target)
+    __slots__ = ('loop', 'client')
+    def __init__(self, name, uid=None, loop = None, alive=True, machine=None, max_health=100, damage=20, action_time=2, target=None, client=None, timers=None):
+        super(Player, self).__init__(name, uid, alive, machine, max_health, damage, action_time, target, timers=timers)
         self.loop = loop or asyncio.get_event_loop()
         self.client = client
 
@@ -190,7 +339,7 @@ class Player(Creature):
         if self.alive and self.target and self.target.alive:
             if self.state == 'idle':
                     self.begin_attack()
-                    self.action_task = self.loop.call_later(self.action_time, self.action_complete)    
+                    self.schedule_action()
             else:
                 self.emit_message(self,"ply_notify", "Can't attack now!")
 
@@ -198,7 +347,7 @@ class Player(Creature):
         if self.alive and self.target and self.target.alive:
             if self.state == 'idle':
                     self.begin_defense()
-                    self.action_task = self.loop.call_later(self.action_time, self.action_complete)
+                    self.schedule_action()
             else:
                 self.emit_message(self,"ply_notify", "Can't defend now!")      
 
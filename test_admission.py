@@ -0,0 +1,94 @@
+import pytest
+import admission
+
+
+class Clock():
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission.time, 'monotonic', clock)
+    return clock
+
+
+def test_bucket_allows_a_burst_then_the_rate():
+    bucket = admission.TokenBucket(rate=2, burst=3, now=0)
+    assert [bucket.take(0) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(0) == pytest.approx(0.5)
+    assert bucket.take(0.25) == pytest.approx(0.25)
+    assert bucket.take(0.5) == 0
+    assert bucket.take(0.5) == pytest.approx(0.5)
+
+
+def test_bucket_refills_up_to_the_burst():
+    bucket = admission.TokenBucket(rate=10, burst=2, now=0)
+    bucket.take(0)
+    bucket.take(0)
+    assert bucket.take(60) == 0
+    assert bucket.take(60) == 0
+    assert bucket.take(60) > 0
+
+
+def test_bucket_rate_over_time():
+    bucket = admission.TokenBucket(rate=5, burst=5, now=0)
+    taken = 0
+    for step in range(1000): # 10 seconds in 10ms steps
+        if bucket.take(step * 0.01) == 0:
+            taken += 1
+    assert 5 + 49 <= taken <= 5 + 50
+
+
+def test_policy_validation():
+    with pytest.raises(ValueError):
+        admission.Policy(1, 1, 'ignore')
+    assert admission.Policy(None).bucket(0) is None
+    assert admission.Policy(0.5).burst == 1
+    with pytest.raises(ValueError):
+        admission.AdmissionControl(frame_action='delay')
+
+
+def test_check_applies_the_policy_action(clock):
+    control = admission.AdmissionControl(chat=admission.Policy(1, 2, 'warn'), command=admission.Policy(1, 1, 'delay'))
+    limits = control.connection()
+    assert control.check(limits, 'chat', 'hi') is None
+    assert control.check(limits, 'chat', 'hi') is None
+    assert control.check(limits, 'chat', 'hi') == ('warn', pytest.approx(1))
+    clock.now += 1
+    assert control.check(limits, 'chat', 'hi') is None
+    assert control.limited.values[('chat', 'warn')] == 1
+
+
+def test_delayed_frames_owe_their_token(clock):
+    control = admission.AdmissionControl(command=admission.Policy(1, 1, 'delay'))
+    limits = control.connection()
+    assert control.check(limits, 'command', '::attack') is None
+    assert control.check(limits, 'command', '::attack') == ('delay', pytest.approx(1))
+    # the delayed frame was handled after its wait, so the next one waits a full interval more
+    clock.now += 1
+    assert control.check(limits, 'command', '::attack') == ('delay', pytest.approx(1))
+    clock.now += 2
+    assert control.check(limits, 'command', '::attack') is None
+
+
+def test_oversized_frames(clock):
+    control = admission.AdmissionControl(max_frame_size=10, frame_action='disconnect', chat=admission.Policy(None))
+    limits = control.connection()
+    assert limits.chat is None
+    assert control.check(limits, 'chat', 'x' * 10) is None
+    assert control.check(limits, 'chat', 'x' * 11) == ('disconnect', 0)
+    assert control.limited.values[('frame_size', 'disconnect')] == 1
+
+
+def test_connection_rate(clock):
+    control = admission.AdmissionControl(connection_rate=1, connection_burst=2)
+    assert [control.admit_connection() for _ in range(3)] == [True, True, False]
+    clock.now += 1
+    assert control.admit_connection()
+    assert control.limited.values[('connection', 'refuse')] == 1
+    assert admission.AdmissionControl(connection_rate=None).admit_connection()
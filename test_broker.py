@@ -0,0 +1,201 @@
+import asyncio
+import pytest
+import broker
+import server
+
+
+class FakeWebSocket():
+    # A connection whose client sends what the test puts in incoming
+    subprotocol = None
+    remote_address = ('127.0.0.1', 50000)
+
+    def __init__(self):
+        self.frames = []
+        self.incoming = asyncio.Queue()
+        self.closed = False
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+    async def recv(self):
+        return await self.incoming.get()
+
+    async def close(self, code=1000, reason=''):
+        self.closed = True
+
+    def sysmsgs(self, msg_type):
+        return [frame.split('|')[3:] for frame in self.frames if frame.startswith('sysmsg|') and frame.split('|')[2] == msg_type]
+
+
+class Game():
+    # Nodes of one game in this process, joined through an in-process broker
+    def __init__(self, loop, nodes=2, port=8765):
+        self.loop = loop
+        self.directory = broker.local_directory(loop)
+        self.nodes = []
+        self.handlers = []
+        for index in range(nodes):
+            link = broker.InProcessBroker(self.directory, 'w{}'.format(index), ('127.0.0.1', port + 1 + index), loop)
+            chat = server.ChatServer(loop=loop, port=port, broker=link, session_grace=0)
+            loop.run_until_complete(chat.join_broker())
+            self.nodes.append(chat)
+        self.settle()
+
+    def settle(self, rounds=10):
+        for _ in range(rounds):
+            self.loop.run_until_complete(asyncio.sleep(0))
+
+    def connect(self, node, *lines):
+        websocket = FakeWebSocket()
+        self.handlers.append(self.loop.create_task(self.nodes[node].handler(websocket, '/')))
+        self.send(websocket, *lines)
+        return websocket
+
+    def send(self, websocket, *lines):
+        for line in lines:
+            websocket.incoming.put_nowait(line)
+            self.settle()
+
+    def disconnect(self, node, username):
+        chat = self.nodes[node]
+        client = chat.clients_by_username[username]
+        self.loop.run_until_complete(chat.connection_lost(client, client.websocket))
+        self.settle()
+
+    def close(self):
+        for task in self.handlers:
+            task.cancel()
+        for chat in self.nodes:
+            for client in list(chat.clients_by_username.values()):
+                chat.remove_client(client)
+            chat.timers.close()
+            chat.broker.close()
+        self.settle()
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def test_directory_claims():
+    directory = broker.Directory(lambda node, message: None)
+    directory.join('w0', ('h', 1))
+    directory.join('w1', ('h', 2))
+    assert directory.claim_username('w0', {'name': 'ann'}) == {'ok': True}
+    assert directory.claim_username('w1', {'name': 'ann'}) == {'ok': False}
+    directory.release_username('w1', {'name': 'ann'})
+    assert directory.usernames == {'ann': 'w0'}
+    assert directory.claim_room('w1', {'name': 'Roset'}) == {'owner': 'w1'}
+    assert directory.claim_room('w0', {'name': 'Roset'}) == {'owner': 'w1'}
+    directory.leave('w1')
+    assert directory.claim_room('w0', {'name': 'Roset'}) == {'owner': 'w0'}
+    directory.leave('w0')
+    assert directory.usernames == {} and directory.rooms == {}
+
+
+def test_usernames_are_unique_across_nodes(loop):
+    game = Game(loop)
+    ann = game.connect(0, 'ann')
+    assert ann.sysmsgs('registered')
+    taken = game.connect(1, 'ann')
+    assert taken.sysmsgs('username_invalid') and not taken.sysmsgs('registered')
+    assert game.directory.usernames == {'ann': 'w0'}
+
+    # Released once ann is gone, so the other node can hand it out
+    game.disconnect(0, 'ann')
+    assert game.directory.usernames == {}
+    game.send(taken, 'ann')
+    assert taken.sysmsgs('registered')
+    assert game.directory.usernames == {'ann': 'w1'}
+    game.close()
+
+
+def test_lobby_chat_and_presence_reach_every_node(loop):
+    game = Game(loop)
+    bob = game.connect(1, 'bob')
+    ann = game.connect(0, 'ann')
+    ann_uid = game.nodes[0].clients_by_username['ann'].uid
+    assert bob.sysmsgs('client_joined_room')[-1] == [ann_uid, 'ann']
+
+    game.send(ann, 'hi all')
+    assert 'ann: hi all' in bob.frames
+    assert 'ann: hi all' in ann.frames
+    assert game.nodes[1].room.history.render(None).endswith('ann: hi all')
+
+    game.send(ann, '::skeleton Roset')
+    assert bob.sysmsgs('client_left_room')[-1] == [ann_uid, 'ann']
+    game.send(bob, 'anyone?')
+    assert 'bob: anyone?' not in ann.frames # ann is in a fight now
+    game.close()
+
+
+def test_joining_a_fight_on_another_node_hands_the_client_off(loop):
+    game = Game(loop)
+    ann = game.connect(0, 'ann', '::skeleton Roset')
+    room = game.nodes[0].rooms.get_by_name('Roset')
+    assert game.directory.rooms == {'Roset': 'w0'}
+
+    bob = game.connect(1, 'bob', '::skeleton Roset')
+    host, port, token = bob.sysmsgs('redirect')[0]
+    assert (host, port) == ('127.0.0.1', '8766') and bob.closed
+    assert 'bob' not in game.nodes[1].clients_by_username
+    assert game.directory.usernames['bob'] == 'w0'
+
+    # The client reconnects where it was sent with the token; the node runs its command for it
+    again = game.connect(0, '::handoff {}'.format(token))
+    bob_client = game.nodes[0].clients_by_username['bob']
+    assert bob_client.room is room and len(room.clients) == 2
+    assert again.sysmsgs('joined_room')[-1][1] == 'Roset'
+    replayed = game.connect(0, '::handoff {}'.format(token))
+    assert replayed.sysmsgs('resume_failed')
+
+    # Nobody left: the room is free for any node to claim again
+    game.send(ann, '::leave')
+    game.send(again, '::leave')
+    assert 'Roset' not in game.directory.rooms
+    game.close()
+
+
+def test_lost_broker_connection_fails_requests(loop):
+    async def scenario():
+        broker_server = broker.BrokerServer(loop)
+        await broker_server.start('127.0.0.1', 0)
+        link = broker.SocketBroker('w0', ('127.0.0.1', 8766), ('127.0.0.1', broker_server.port), loop, request_timeout=1)
+        chat = server.ChatServer(loop=loop, broker=link, session_grace=0)
+        await chat.join_broker()
+        assert await link.claim_username('ann')
+        assert not await chat.claim_username('ann')
+
+        for batcher in list(broker_server.connections.values()):
+            batcher.close()
+        broker_server.close()
+        await asyncio.sleep(0.05)
+        assert link.lost
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(link.claim_username('bob'), 2)
+        link.publish('lobby', {'text': 'dropped', 'line': None})
+        # The node carries on alone
+        assert await asyncio.wait_for(chat.claim_username('bob'), 2)
+        assert await asyncio.wait_for(chat.claim_room('Roset'), 2) is None
+        chat.timers.close()
+        link.close()
+
+        # A broker that never answers times out instead of hanging
+        async def mute(reader, writer):
+            await reader.read()
+        silent = await asyncio.start_server(mute, '127.0.0.1', 0)
+        link = broker.SocketBroker('w1', ('127.0.0.1', 8767), ('127.0.0.1', silent.sockets[0].getsockname()[1]), loop, request_timeout=0.1)
+        await link.start()
+        with pytest.raises(ConnectionError):
+            await link.claim_room('Roset')
+        assert link.requests == {}
+        link.close()
+        silent.close()
+        await asyncio.sleep(0.05)
+
+    loop.run_until_complete(scenario())
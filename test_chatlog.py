@@ -0,0 +1,141 @@
+import asyncio
+import os
+import random
+import pytest
+import chatlog
+import history
+
+
+class FakeClient():
+    def __init__(self, username):
+        self.username = username
+
+    def __repr__(self):
+        return self.username
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def open_log(store, clock, max_messages, max_age):
+    return chatlog.RoomLog(store, os.path.join(store.directory, 'room'), max_messages, max_age, clock)
+
+
+def flush(store, loop):
+    store.flush()
+    while store.writing or store.dirty or store.deleted:
+        loop.run_until_complete(asyncio.sleep(0.001))
+        if not store.writing:
+            store.flush()
+
+
+def fill(room_log, reference, clients, clock, rng, count):
+    for i in range(count):
+        clock.now += rng.choice([0, 0.1, 1, 5])
+        line = 'line {} {}'.format(i, 'x' * rng.randint(0, 40))
+        targets = rng.sample(clients, rng.randint(1, 2)) if rng.random() < 0.3 else None
+        room_log.append(line, targets)
+        reference.append(line, targets)
+
+
+def assert_same(room_log, reference, clients):
+    for client in clients:
+        assert room_log.render(client) == reference.render(client)
+        before = None
+        while True:
+            expected = reference.page(client, before, 7)
+            assert room_log.page(client, before, 7) == expected
+            lines, more = expected
+            if not more:
+                break
+            before = lines[0][0]
+    assert len(room_log) == len(reference)
+    assert [(entry.seq, entry.line) for entry in room_log] == [(entry.seq, entry.line) for entry in reference]
+
+
+@pytest.mark.parametrize('seed,max_messages,max_age', [(1, 50, None), (2, 20, None), (3, 500, 30), (4, 40, 60)])
+def test_matches_room_history(tmp_path, loop, seed, max_messages, max_age):
+    rng = random.Random(seed)
+    clock = Clock()
+    clients = [FakeClient('ann'), FakeClient('bob'), FakeClient('cid')]
+    store = chatlog.ChatLogStore(str(tmp_path), loop, segment_bytes=512)
+    room_log = open_log(store, clock, max_messages, max_age)
+    reference = history.RoomHistory(max_messages, max_age, clock)
+
+    fill(room_log, reference, clients, clock, rng, 150)
+    assert_same(room_log, reference, clients) # partly unflushed
+
+    flush(store, loop)
+    assert store.unwritten() == 0
+    assert_same(room_log, reference, clients)
+
+    fill(room_log, reference, clients, clock, rng, 60)
+    assert_same(room_log, reference, clients)
+    store.close()
+
+    store = chatlog.ChatLogStore(str(tmp_path), loop, segment_bytes=512)
+    recovered = open_log(store, clock, max_messages, max_age)
+    assert recovered.seq == reference.seq
+    assert_same(recovered, reference, clients)
+    store.close()
+
+
+def test_cuts_torn_tail(tmp_path, loop):
+    rng = random.Random(5)
+    clock = Clock()
+    clients = [FakeClient('ann'), FakeClient('bob')]
+    store = chatlog.ChatLogStore(str(tmp_path), loop, segment_bytes=4096)
+    room_log = open_log(store, clock, 100, None)
+    reference = history.RoomHistory(100, None, clock)
+    fill(room_log, reference, clients, clock, rng, 80)
+    store.close()
+
+    last = room_log.segments[-1].path
+    size = os.path.getsize(last)
+    with open(last, 'ab') as f:
+        f.write(chatlog.RECORD.pack(100, 0, reference.seq + 1, clock.now) + b'half a li')
+
+    store = chatlog.ChatLogStore(str(tmp_path), loop, segment_bytes=4096)
+    recovered = open_log(store, clock, 100, None)
+    assert os.path.getsize(last) == size
+    assert_same(recovered, reference, clients)
+
+    recovered.append('after the crash')
+    reference.append('after the crash')
+    assert_same(recovered, reference, clients)
+    store.close()
+
+
+def test_drops_segments_out_of_the_window(tmp_path, loop):
+    clock = Clock()
+    store = chatlog.ChatLogStore(str(tmp_path), loop, segment_bytes=256)
+    room_log = open_log(store, clock, 20, None)
+    for i in range(500):
+        room_log.append('line {}'.format(i))
+    flush(store, loop)
+    files = sorted(os.listdir(room_log.directory))
+    assert len(files) == len(room_log.segments)
+    assert room_log.segments[0].last_seq >= room_log.first_visible()
+    assert len(room_log.segments) < 10
+    assert room_log.page(None, None, 3) == ([(498, 'line 497'), (499, 'line 498'), (500, 'line 499')], True)
+    store.close()
+
+
+def test_open_reuses_room_logs(tmp_path, loop):
+    store = chatlog.ChatLogStore(str(tmp_path), loop)
+    room_log = store.open('chat-a/b')
+    assert store.open('chat-a/b') is room_log
+    assert os.path.dirname(room_log.directory) == str(tmp_path)
+    store.close()
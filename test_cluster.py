@@ -0,0 +1,84 @@
+import asyncio
+import broker
+import cluster
+import server
+
+
+class FakeWebSocket():
+    subprotocol = None
+    remote_address = ('127.0.0.1', 50000)
+
+    def __init__(self):
+        self.frames = []
+        self.incoming = asyncio.Queue()
+        self.closed = False
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+    async def recv(self):
+        return await self.incoming.get()
+
+    async def close(self, code=1000, reason=''):
+        self.closed = True
+
+    def answers(self):
+        # How the username handshake went
+        msg_types = [frame.split('|')[2] for frame in self.frames if frame.startswith('sysmsg|')]
+        return [msg_type for msg_type in msg_types if msg_type in ('username_prompt', 'username_invalid', 'registered')]
+
+
+def test_worker_specs():
+    specs = cluster.worker_specs(3, 8766, '10.0.0.5', 'w', {'metrics_port': 9765, 'history_dir': 'history'})
+    assert [node for node, address, kwargs in specs] == ['w0', 'w1', 'w2']
+    assert [address for node, address, kwargs in specs] == [('10.0.0.5', 8766), ('10.0.0.5', 8767), ('10.0.0.5', 8768)]
+    assert [kwargs for node, address, kwargs in specs] == [{'metrics_port': 9765 + i, 'history_dir': 'history'} for i in range(3)]
+    assert cluster.worker_specs(1, 8766, 'h', 'box-', {})[0] == ('box-0', ('h', 8766), {})
+
+
+def test_two_workers_on_one_port_keep_usernames_unique():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    directory = broker.local_directory(loop)
+    workers = []
+    for node, address, kwargs in cluster.worker_specs(2, 8766, '127.0.0.1', 'w', {'session_grace': 0}):
+        chat = cluster.worker(server.ChatServer, broker.InProcessBroker(directory, node, address, loop), '', 8765, kwargs)
+        loop.run_until_complete(chat.join_broker())
+        workers.append(chat)
+    assert [chat.port for chat in workers] == [8765, 8765]
+
+    tasks = []
+
+    def settle():
+        for _ in range(10):
+            loop.run_until_complete(asyncio.sleep(0))
+
+    def connect(chat, *usernames):
+        # The kernel may hand any connection to either worker
+        websocket = FakeWebSocket()
+        tasks.append(loop.create_task(chat.handler(websocket, '/')))
+        for username in usernames:
+            websocket.incoming.put_nowait(username)
+            settle()
+        return websocket
+
+    first = connect(workers[0], 'ann')
+    second = connect(workers[1], 'ann', 'bob')
+    third = connect(workers[0], 'bob', 'Ann')
+    assert first.answers() == ['username_prompt', 'registered']
+    assert second.answers() == ['username_prompt', 'username_invalid', 'username_prompt', 'registered']
+    assert third.answers() == ['username_prompt', 'username_invalid', 'username_prompt', 'registered']
+    assert directory.usernames == {'ann': 'w0', 'bob': 'w1', 'Ann': 'w0'}
+    assert set(workers[0].clients_by_username) == set(['ann', 'Ann'])
+    assert set(workers[1].clients_by_username) == set(['bob'])
+
+    for task in tasks:
+        task.cancel()
+    for chat in workers:
+        for client in list(chat.clients_by_username.values()):
+            chat.remove_client(client)
+        chat.timers.close()
+        chat.broker.close()
+    settle()
+    loop.close()
+    asyncio.set_event_loop(None)
@@ -0,0 +1,205 @@
+import asyncio
+import pytest
+import combat
+import server
+import skeletons
+
+
+class FakeHandle():
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop():
+    # The engine only reads the clock and arms its tick
+    def __init__(self):
+        self.now = 0.0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback):
+        handle = FakeHandle(callback)
+        self.handles.append(handle)
+        return handle
+
+
+class RecordingWebSocket():
+    subprotocol = None
+
+    def __init__(self):
+        self.frames = []
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+    async def close(self):
+        pass
+
+
+def recorder(events):
+    def emit(emitter, msg_type, *args):
+        events.append((emitter.name, msg_type, list(args)))
+    return emit
+
+
+def test_rows_are_allocated_and_released():
+    engine = combat.CombatEngine(FakeLoop(), capacity=2)
+    skeleton = engine.create_skeleton('skeleton')
+    players = [engine.create_player('player{}'.format(i), target=skeleton) for i in range(3)]
+    assert engine.capacity == 4
+    assert len(engine) == 4
+    for player in players:
+        skeleton.add_target(player)
+    assert set(skeleton.targets) == set(players)
+    assert players[0].target is skeleton and players[0].alive
+
+    engine.release(players[1])
+    engine.release(players[1])
+    assert len(engine) == 3
+    assert players[1].released and not players[1].alive
+    assert set(skeleton.targets) == set([players[0], players[2]])
+
+    engine.release(skeleton)
+    assert players[0].target is None
+    assert skeleton.targets == []
+    for player in players:
+        engine.release(player)
+    assert len(engine) == 0
+
+
+def test_released_rows_are_reused():
+    engine = combat.CombatEngine(FakeLoop())
+    skeleton = engine.create_skeleton('skeleton')
+    old = engine.create_player('old', target=skeleton)
+    skeleton.add_target(old)
+    engine.release(old)
+    new = engine.create_player('new', target=skeleton)
+    assert new.row == old.row
+    skeleton.add_target(new)
+
+    # Calls through the stale view must not touch the row's new owner
+    skeleton.remove_target(old)
+    skeleton.add_target(old)
+    assert skeleton.targets == [new]
+    assert not old.alive and new.alive
+
+    engine.release(skeleton)
+    fresh = engine.create_skeleton('fresh')
+    assert fresh.row == skeleton.row
+    skeleton.add_target(new)
+    skeleton.remove_target(new)
+    assert skeleton.targets == [] and fresh.targets == []
+    assert not skeleton.alive and not skeleton.active
+
+
+def test_player_blows_match_the_classic_creatures():
+    # A player hitting until the skeleton dies sends the same events both ways
+    classic_events, engine_events = [], []
+    loop = FakeLoop()
+    classic_skeleton = skeletons.Skeleton('skeleton', loop=loop)
+    classic_player = skeletons.Player('player', loop=loop, target=classic_skeleton)
+    classic_skeleton.emit_message = classic_player.emit_message = recorder(classic_events)
+
+    engine = combat.CombatEngine(loop)
+    skeleton = engine.create_skeleton('skeleton')
+    player = engine.create_player('player', target=skeleton)
+    skeleton.emit_message = player.emit_message = recorder(engine_events)
+
+    while classic_skeleton.alive:
+        classic_player.begin_attack()
+        classic_player.action_complete()
+        player.act(combat.ATTACKING, "Can't attack now!")
+        loop.now += player.engine.action_time[player.row]
+        engine.step()
+        assert (skeleton.health, skeleton.alive, skeleton.state) == (classic_skeleton.health, classic_skeleton.alive, classic_skeleton.state)
+    assert engine_events == classic_events
+    assert classic_events[-3:] == [('skeleton', 'creature_death', []), ('skeleton', 'creature_changed_state', ['dead']), ('player', 'creature_changed_state', ['idle'])]
+    assert skeleton.health == 0
+
+
+def test_blocked_and_interrupted_like_the_classic_creatures():
+    classic_events, engine_events = [], []
+    loop = FakeLoop()
+    classic_skeleton = skeletons.Skeleton('skeleton', loop=loop)
+    classic_skeleton.emit_message = recorder(classic_events)
+    engine = combat.CombatEngine(loop)
+    skeleton = engine.create_skeleton('skeleton')
+    skeleton.emit_message = recorder(engine_events)
+
+    classic_skeleton.begin_defense()
+    classic_skeleton.take_damage(20)
+    classic_skeleton.action_complete()
+    classic_skeleton.begin_attack()
+    classic_skeleton.action_task = FakeHandle(None)
+    classic_skeleton.take_damage(20)
+
+    engine.begin_action(skeleton.row, combat.DEFENDING)
+    skeleton.take_damage(20)
+    engine.step(loop.now + 3)
+    engine.begin_action(skeleton.row, combat.ATTACKING)
+    skeleton.take_damage(20)
+
+    assert engine_events == classic_events
+    assert skeleton.health == classic_skeleton.health == 80
+    assert skeleton.state == classic_skeleton.state == 'idle'
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_fight_teardown_with_dead_players_left_behind(loop):
+    engine = combat.CombatEngine(loop)
+    chat = server.ChatServer(loop=loop, combat_engine=engine, session_grace=0)
+
+    async def connect(name):
+        client = server.Client(uid=name * 2, websocket=RecordingWebSocket(), username=name)
+        chat.register_client(client)
+        await chat.room.register_client(client)
+        return client
+
+    async def fight():
+        ann, bob, cid = await connect('ann'), await connect('bob'), await connect('cid')
+        await chat.room.handle_message(ann, '::skeleton Roset')
+        await chat.room.handle_message(bob, '::skeleton Roset')
+        room = ann.room
+        assert bob.room is room and len(engine) == 3
+
+        bob.player.take_damage(1000)
+        assert not bob.player.alive
+        await room.handle_message(ann, '::leave')
+        # Nobody alive is left to fight, but bob still has to leave
+        assert room not in chat.rooms
+        assert not room.skeleton.released
+        assert len(engine) == 2
+
+        # A new fight may take rows while bob is still around
+        await chat.room.handle_message(cid, '::skeleton Frith')
+        other = cid.room
+        assert other.skeleton.targets == [cid.player]
+
+        await room.handle_message(bob, '::leave')
+        assert bob.room is chat.room and bob.player is None
+        assert room.skeleton is None
+        assert room in chat.room_pool.idle
+        assert other.skeleton.targets == [cid.player]
+        assert len(engine) == 2
+
+        await other.handle_message(cid, '::leave')
+        assert len(engine) == 0
+        for client in (ann, bob, cid):
+            client.outbox.close()
+        await asyncio.sleep(0)
+
+    loop.run_until_complete(fight())
+    engine.close()
+    chat.timers.close()
@@ -0,0 +1,81 @@
+import random
+import pytest
+import history
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class NaiveHistory():
+    # Every entry in a list, filtered on each read
+    def __init__(self, max_messages, max_age, clock):
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.clock = clock
+        self.entries = []
+
+    def append(self, line, targets=None):
+        self.entries.append((len(self.entries) + 1, self.clock(), targets, line))
+
+    def visible(self, client):
+        entries = self.entries[-self.max_messages:]
+        if self.max_age is not None:
+            entries = [entry for entry in entries if entry[1] >= self.clock() - self.max_age]
+        return [(seq, line) for seq, timestamp, targets, line in entries if not targets or client in targets]
+
+    def render(self, client):
+        return '\n'.join([line for seq, line in self.visible(client)])
+
+    def page(self, client, before=None, limit=50):
+        lines = [(seq, line) for seq, line in self.visible(client) if before is None or seq < before]
+        return lines[-limit:], len(lines) > limit
+
+
+@pytest.mark.parametrize('seed,max_messages,max_age', [(1, 30, None), (2, 500, None), (3, 100, 20), (4, 7, 3)])
+def test_matches_naive_history(seed, max_messages, max_age):
+    rng = random.Random(seed)
+    clock = Clock()
+    clients = ['ann', 'bob', 'cid']
+    room_history = history.RoomHistory(max_messages, max_age, clock)
+    naive = NaiveHistory(max_messages, max_age, clock)
+    for i in range(600):
+        clock.now += rng.choice([0, 0.1, 0.5, 2])
+        line = 'line {}'.format(i)
+        targets = rng.sample(clients, rng.randint(1, 2)) if rng.random() < 0.3 else None
+        room_history.append(line, targets)
+        naive.append(line, targets)
+        if i % 37 == 0 or i > 590:
+            for client in clients + ['nobody']:
+                assert room_history.render(client) == naive.render(client)
+                for before in [None, i + 2, i - 3, i - 20, 1]:
+                    for limit in [1, 5, 50]:
+                        assert room_history.page(client, before, limit) == naive.page(client, before, limit)
+
+
+def test_bounded_by_count_and_age():
+    clock = Clock()
+    room_history = history.RoomHistory(3, 10, clock)
+    for i in range(5):
+        room_history.append('line {}'.format(i))
+    assert len(room_history) == 3
+    assert room_history.render(None) == 'line 2\nline 3\nline 4'
+    clock.now += 11
+    assert room_history.render(None) == ''
+    assert len(room_history) == 0
+    room_history.append('fresh')
+    assert room_history.page(None) == ([(6, 'fresh')], False)
+
+
+def test_private_lines_only_reach_their_targets():
+    room_history = history.RoomHistory()
+    room_history.append('public')
+    room_history.append('for ann', ['ann'])
+    room_history.append('for both', ['ann', 'bob'])
+    assert room_history.render('ann') == 'public\nfor ann\nfor both'
+    assert room_history.render('bob') == 'public\nfor both'
+    assert room_history.render('cid') == 'public'
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+import pytest
+import loophealth
+
+
+class Room():
+    room_type = 'skeleton'
+    name = 'Roset'
+
+
+class Client():
+    username = 'ann'
+
+
+class SlowHandler(logging.Handler):
+    def emit(self, record):
+        time.sleep(0.03)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_steps_are_timed_on_the_monitored_loop_only(loop):
+    other = asyncio.new_event_loop()
+    run = asyncio.events.Handle._run
+    health = loophealth.LoopHealth(loop, slow_threshold=0.02, lag_interval=0.01)
+    health.start()
+    health.start()
+    assert asyncio.events.Handle._run is run
+    assert set(vars(loop)) >= set(loophealth.SCHEDULERS)
+    assert not set(vars(other)) & set(loophealth.SCHEDULERS)
+
+    def command():
+        health.note(Room(), Client(), '::attack')
+        time.sleep(0.03)
+        health.note()
+
+    async def task():
+        await asyncio.sleep(0)
+        time.sleep(0.03)
+
+    loop.call_soon(command)
+    loop.call_later(0, time.sleep, 0.001) # fast, not recorded
+    loop.run_until_complete(task())
+    other.run_until_complete(task())
+    other.close()
+    assert [step.step.split('.')[-1] for step in health.slow_steps] == ['command', 'task']
+    assert health.slow_steps[1].step.startswith('task ')
+    assert health.slow_steps[0].culprit() == ('skeleton Roset', 'ann', '::attack')
+    assert health.slow_steps[0].share > 0.9
+
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert health.report()['lag_ms']['samples'] >= 2
+
+    health.stop()
+    assert not set(vars(loop)) & set(loophealth.SCHEDULERS)
+    loop.call_soon(time.sleep, 0.03)
+    loop.run_until_complete(asyncio.sleep(0.02))
+    assert len(health.slow_steps) == 2 and health.lag_handle is None
+
+
+def test_logging_is_blamed_separately(loop):
+    health = loophealth.LoopHealth(loop, slow_threshold=0.02, report_interval=None)
+    handler = SlowHandler()
+    emit = handler.emit
+    health.watch_handler(handler)
+    logger = logging.getLogger('test_loophealth')
+    logger.addHandler(handler)
+    logger.propagate = False
+    health.start()
+
+    def chat():
+        health.note(Room(), Client(), 'chat')
+        time.sleep(0.005)
+        logger.warning('slow write')
+
+    for _ in range(2):
+        loop.call_soon(chat)
+    loop.run_until_complete(asyncio.sleep(0))
+    health.stop()
+    logger.removeHandler(handler)
+    assert handler.emit == emit
+    worst, = health.worst_offenders()
+    assert (worst['room'], worst['client'], worst['command'], worst['count']) == (None, None, 'logging', 2)
@@ -0,0 +1,150 @@
+import asyncio
+import pytest
+import metrics
+import server
+
+
+class FakeWebSocket():
+    subprotocol = None
+    remote_address = ('127.0.0.1', 50000)
+
+    def __init__(self):
+        self.frames = []
+        self.incoming = asyncio.Queue()
+        self.closed = False
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+    async def recv(self):
+        return await self.incoming.get()
+
+    async def close(self, code=1000, reason=''):
+        self.closed = True
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def settle(loop, rounds=10):
+    for _ in range(rounds):
+        loop.run_until_complete(asyncio.sleep(0))
+
+
+def samples(exposition):
+    # 'name{labels}' -> value of every sample line
+    values = {}
+    for line in exposition.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+async def scrape(port, path='/metrics'):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write('GET {} HTTP/1.0\r\n\r\n'.format(path).encode('latin-1'))
+    response = await reader.read()
+    writer.close()
+    head, body = response.decode('utf-8').split('\r\n\r\n', 1)
+    return head.split('\r\n')[0], body
+
+
+def test_exposition_format():
+    registry = metrics.Registry()
+    frames = registry.counter('frames_total', 'Frames', ['type'])
+    frames.inc('chat')
+    frames.inc('say "hi"\n', 2)
+    registry.gauge('rooms', 'Rooms', lambda: {'chat': 1, 'skeleton': 2.0}, ['room_type'])
+    seconds = registry.histogram('seconds', 'Seconds', buckets=(0.1, 1))
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+    registry.gauge('broken', 'Fails to collect', lambda: 1 / 0)
+    with pytest.raises(ValueError):
+        registry.counter('frames_total', 'Again')
+    assert registry.exposition().splitlines() == [
+        '# HELP frames_total Frames',
+        '# TYPE frames_total counter',
+        'frames_total{type="chat"} 1',
+        'frames_total{type="say \\"hi\\"\\n"} 2',
+        '# HELP rooms Rooms',
+        '# TYPE rooms gauge',
+        'rooms{room_type="chat"} 1',
+        'rooms{room_type="skeleton"} 2',
+        '# HELP seconds Seconds',
+        '# TYPE seconds histogram',
+        'seconds_bucket{le="0.1"} 1',
+        'seconds_bucket{le="1"} 2',
+        'seconds_bucket{le="+Inf"} 2',
+        'seconds_sum 0.55',
+        'seconds_count 2',
+    ]
+
+
+def test_server_metrics_are_scraped(loop):
+    chat = server.ChatServer(loop=loop, session_grace=5)
+    handlers = []
+
+    def connect(*lines):
+        websocket = FakeWebSocket()
+        handlers.append(loop.create_task(chat.handler(websocket, '/')))
+        for line in lines:
+            websocket.incoming.put_nowait(line)
+            settle(loop)
+        return websocket
+
+    connect('ann', 'hello', '::skeleton Roset')
+    connect('bob', 'hi')
+    values = samples(chat.metrics.exposition())
+    assert values['skeleton_connected_clients'] == 2
+    assert values['skeleton_lobby_clients'] == 1
+    assert values['skeleton_rooms{room_type="skeleton"}'] == 1
+    assert values['skeleton_rooms{room_type="chat"}'] == 0
+    assert values['skeleton_ai_running'] == 1
+    assert values['skeleton_frames_received_total{type="chat"}'] == 2
+    assert values['skeleton_frames_received_total{type="command"}'] == 1
+    assert values['skeleton_frames_sent_total{type="text"}'] >= 2
+    assert values['skeleton_outbound_queued_frames'] == 0
+    assert values['skeleton_detached_sessions'] == 0
+
+    # Frames for a dropped connection wait in its queue until the session resumes
+    bob = chat.clients_by_username['bob']
+    chat.detach_client(bob)
+    chat.broadcast('one', [bob])
+    chat.broadcast('two', [bob])
+
+    async def scrape_endpoint():
+        metrics_server = metrics.MetricsServer(chat.metrics, loop)
+        await metrics_server.start('127.0.0.1', 0)
+        try:
+            status, body = await scrape(metrics_server.port)
+            missing, _ = await scrape(metrics_server.port, '/nothing')
+        finally:
+            metrics_server.close()
+        return status, body, missing
+
+    status, body, missing = loop.run_until_complete(scrape_endpoint())
+    assert status == 'HTTP/1.0 200 OK' and missing == 'HTTP/1.0 404 Not Found'
+    assert '# TYPE skeleton_outbound_queued_frames gauge' in body.splitlines()
+    values = samples(body)
+    assert values['skeleton_outbound_queued_frames'] == 2
+    assert values['skeleton_detached_sessions'] == 1
+    assert values['skeleton_connected_clients'] == 1
+    assert 'skeleton_room_pool_idle' in values and 'skeleton_timers_pending' in values
+
+    ann = chat.clients_by_username['ann']
+    loop.run_until_complete(ann.room.handle_message(ann, '::leave'))
+    assert samples(chat.metrics.exposition())['skeleton_rooms{room_type="skeleton"}'] == 0
+    for task in handlers:
+        task.cancel()
+    for client in list(chat.clients_by_username.values()):
+        chat.remove_client(client)
+    chat.room_pool.close()
+    chat.timers.close()
+    settle(loop)
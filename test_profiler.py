@@ -0,0 +1,66 @@
+import asyncio
+import os
+import time
+import profiler
+import server
+
+
+def spin(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+def read_profile(path):
+    counts = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            stack, count = line.rsplit(' ', 1)
+            counts[stack] = int(count)
+    return counts
+
+
+def test_profile_starts_stops_and_writes_collapsed_stacks(tmp_path):
+    sampler = profiler.SamplingProfiler(interval=0.001, directory=str(tmp_path))
+    assert not sampler.running
+    path = sampler.start(30)
+    assert sampler.running and os.path.dirname(path) == str(tmp_path)
+    assert sampler.start(30) is None
+    spin(0.2)
+    sampler.stop()
+    sampler.thread.join(5)
+    assert not sampler.running
+
+    counts = read_profile(path)
+    busy = sum([count for stack, count in counts.items() if stack.split(';')[-1] == 'test_profiler.py:spin'])
+    assert busy >= 10
+    assert all([stack.split(';')[-2] == 'test_profiler.py:test_profile_starts_stops_and_writes_collapsed_stacks'
+        for stack in counts if stack.endswith(';test_profiler.py:spin')])
+
+    # Toggling (what SIGUSR1 does) starts a new profile and stops it again
+    sampler.toggle(30)
+    assert sampler.running
+    sampler.toggle(30)
+    sampler.thread.join(5)
+    assert not sampler.running and os.path.exists(sampler.path)
+
+
+def test_profile_page(tmp_path):
+    loop = asyncio.new_event_loop()
+    chat = server.ChatServer(loop=loop, profile_dir=str(tmp_path))
+    assert chat.profile_page({'seconds': 'soon'}) == 'seconds should be a number\n'
+    assert chat.profile_page({'stop': '1'}) == 'No profile is running\n'
+    started = chat.profile_page({'seconds': '30'})
+    path = chat.profiler.path
+    assert started == 'Profiling for 30.0s into {}\n'.format(path)
+    assert chat.profile_page({}) == 'A profile is already running into {}\n'.format(path)
+    spin(0.05)
+    assert chat.profile_page({'stop': '1'}) == 'Profile stopped, see {}\n'.format(path)
+    chat.profiler.thread.join(5)
+    assert read_profile(path)
+    # A profile with a deadline ends on its own
+    chat.profile_page({'seconds': '0.05'})
+    chat.profiler.thread.join(5)
+    assert not chat.profiler.running
+    chat.timers.close()
+    loop.close()
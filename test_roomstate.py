@@ -0,0 +1,193 @@
+import asyncio
+import random
+import roomstate
+import server
+
+
+class Creature():
+    def __init__(self, uid, name, max_health=100):
+        self.uid = uid
+        self.name = name
+        self.alive = True
+        self.max_health = max_health
+        self.health = max_health
+        self.state = 'idle'
+        self.target = None
+
+
+class ClientView():
+    # What client.html does with a snapshot and the events after it
+    def __init__(self):
+        self.version = None
+        self.creatures = {}
+
+    def setup(self, fields):
+        uid, name, alive, max_health, health, state, target = fields
+        self.creatures[uid] = {'name': name, 'alive': alive == 'True', 'health': int(health), 'state': state, 'target': target}
+
+    def handle(self, uid, msg_type, args):
+        if msg_type == 'room_snapshot':
+            self.version = int(args[0])
+            self.creatures = {}
+            for i in range(1, len(args), roomstate.CreatureRecord.fields):
+                self.setup(args[i:i + roomstate.CreatureRecord.fields])
+        elif msg_type == 'ui_setup_creature':
+            self.setup(args)
+        elif uid not in self.creatures:
+            return
+        elif msg_type == 'creature_health_report':
+            self.creatures[uid]['health'] = int(args[0])
+        elif msg_type == 'creature_changed_state':
+            self.creatures[uid]['state'] = args[0]
+        elif msg_type == 'creature_death':
+            self.creatures[uid]['alive'] = False
+        elif msg_type == 'ai_new_target':
+            self.creatures[uid]['target'] = self.creatures[args[0]]['name'] if args[0] in self.creatures else ''
+
+    def handle_frame(self, frame):
+        lines = frame[len('sysbatch|'):].split('\n') if frame.startswith('sysbatch|') else [frame]
+        for line in lines:
+            if line.startswith('sysmsg|'):
+                parts = line.split('|')
+                self.handle(parts[1], parts[2], parts[3:])
+
+
+def live_view(creatures):
+    return {creature.uid: {'name': creature.name, 'alive': creature.alive, 'health': creature.health, 'state': creature.state,
+        'target': creature.target.name if creature.target else ''} for creature in creatures}
+
+
+def random_event(rng, creatures):
+    creature = rng.choice(creatures)
+    roll = rng.random()
+    if roll < 0.4:
+        creature.health -= rng.randint(1, 30)
+        return creature.uid, 'creature_health_report', [creature.health]
+    if roll < 0.7:
+        creature.state = rng.choice(['idle', 'attacking', 'defending'])
+        return creature.uid, 'creature_changed_state', [creature.state]
+    if roll < 0.8:
+        creature.alive = False
+        creature.state = 'dead'
+        return creature.uid, 'creature_death', []
+    if roll < 0.9:
+        creature.target = rng.choice(creatures)
+        return creature.uid, 'ai_new_target', [creature.target.uid]
+    return creature.uid, 'creature_took_damage', [5]
+
+
+def test_snapshot_plus_deltas_match_the_live_state():
+    rng = random.Random(1)
+    creatures = [Creature('5ce1e700', 'skeleton', 150), Creature('c0000001', 'ann')]
+    state = roomstate.RoomState()
+    for creature in creatures:
+        state.add(creature)
+    early = ClientView()
+    early.handle('', 'room_snapshot', [str(arg) for arg in state.snapshot()])
+    late = None
+    for i in range(300):
+        if i == 150:
+            # Somebody joins mid-fight: everybody gets the new creature, the joiner a snapshot
+            joiner = Creature('c0000002', 'bob')
+            creatures.append(joiner)
+            early.handle('', 'ui_setup_creature', state.add(joiner).report())
+            late = ClientView()
+            late.handle('', 'room_snapshot', [str(arg) for arg in state.snapshot()])
+            assert late.version == state.version
+        uid, msg_type, args = random_event(rng, creatures)
+        version = state.version
+        state.apply(uid, msg_type, args)
+        if msg_type == 'creature_took_damage':
+            assert state.version == version
+        args = [str(arg) for arg in args]
+        early.handle(uid, msg_type, args)
+        if late:
+            late.handle(uid, msg_type, args)
+    assert early.creatures == late.creatures == live_view(creatures)
+    fresh = ClientView()
+    fresh.handle('', 'room_snapshot', [str(arg) for arg in state.snapshot()])
+    assert fresh.creatures == early.creatures
+
+
+def test_snapshot_is_cached_per_version():
+    state = roomstate.RoomState()
+    skeleton = Creature('5ce1e700', 'skeleton')
+    state.add(skeleton)
+    first = state.snapshot()
+    assert state.snapshot() is first
+    state.apply('5ce1e700', 'creature_blocked_damage', [])
+    assert state.snapshot() is first
+    state.apply('5ce1e700', 'creature_health_report', [90])
+    assert state.snapshot() is not first and state.snapshot()[0] == state.version
+    state.apply('nobody00', 'creature_health_report', [1])
+    state.remove('nobody00')
+    assert state.snapshot()[0] == state.version and len(state) == 1
+    state.remove('5ce1e700')
+    assert state.snapshot() == [state.version]
+
+
+class RecordingWebSocket():
+    subprotocol = None
+
+    def __init__(self):
+        self.frames = []
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+    async def close(self):
+        pass
+
+
+def test_mid_fight_join_through_the_room():
+    loop = asyncio.new_event_loop()
+    chat = server.ChatServer(loop=loop, session_grace=0)
+    room = chat.room_pool.acquire()
+    chat.rooms.add(room)
+    views = {}
+
+    def join(name):
+        client = server.Client(uid='{:0<8}'.format(name), websocket=RecordingWebSocket(), username=name)
+        chat.register_client(client)
+        loop.run_until_complete(room.register_client(client))
+        views[name] = ClientView()
+        return client
+
+    def sync():
+        for _ in range(5):
+            loop.run_until_complete(asyncio.sleep(0))
+        for client in room.clients:
+            for frame in client.websocket.frames:
+                views[client.username].handle_frame(frame)
+            client.websocket.frames.clear()
+
+    skeleton = room.skeleton
+    ann = join('ann')
+    sync()
+    ann.player.take_damage(30)
+    skeleton.take_damage(20)
+    skeleton.begin_attack()
+    skeleton.schedule_action()
+    room.handle_game_message(skeleton, 'ai_new_target', ann.player)
+    skeleton.target = ann.player
+    sync()
+
+    bob = join('bob')
+    sync()
+    assert views['bob'].version == room.room_state.version
+    skeleton.take_damage(20) # interrupts the attack
+    bob.player.take_damage(100)
+    skeleton.begin_defense()
+    skeleton.schedule_action()
+    sync()
+
+    live = live_view([skeleton, ann.player, bob.player])
+    assert live[bob.uid]['alive'] is False and live[skeleton.uid]['state'] == 'defending'
+    assert views['ann'].creatures == views['bob'].creatures == live
+
+    skeleton.stop()
+    for client in list(room.clients):
+        chat.remove_client(client)
+    chat.timers.close()
+    sync()
+    loop.close()
@@ -0,0 +1,374 @@
+import asyncio
+import pytest
+import roomstate
+import server
+
+
+class RecordingWebSocket():
+    subprotocol = None
+
+    def __init__(self):
+        self.frames = []
+        self.closed = False
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def settle(loop, rounds=5):
+    for _ in range(rounds):
+        loop.run_until_complete(asyncio.sleep(0))
+
+
+def outbox(loop, maxsize=3, overflow_policy='drop'):
+    client = server.Client(uid='c0000000', websocket=RecordingWebSocket(), username='ann')
+    client.outbox = server.OutboundQueue(client, loop, maxsize, overflow_policy)
+    return client
+
+
+def test_full_queue_drops_cosmetic_frames(loop):
+    client = outbox(loop)
+    queue = client.outbox
+    for i in range(3):
+        assert queue.put('chat {}'.format(i))
+    assert not queue.put('took damage', 'creature_took_damage', 'skeleton')
+    assert queue.dropped == 1
+    # Frames the UI needs overshoot maxsize, up to the hard limit
+    for i in range(3):
+        assert queue.put('death {}'.format(i), 'creature_death', 'skeleton')
+    assert len(queue) == 6
+    assert not queue.put('one too many', 'creature_death', 'skeleton')
+    settle(loop)
+    assert queue.closed and client.websocket.closed
+    assert not queue.put('chat after close')
+
+
+def test_disconnect_policy(loop):
+    client = outbox(loop, overflow_policy='disconnect')
+    for i in range(3):
+        client.outbox.put('chat {}'.format(i))
+    assert not client.outbox.put('took damage', 'creature_took_damage', 'skeleton')
+    settle(loop)
+    assert client.outbox.closed and client.websocket.closed
+    with pytest.raises(ValueError):
+        server.OutboundQueue(client, loop, 3, 'block')
+
+
+def test_health_reports_coalesce_at_the_back(loop):
+    client = outbox(loop)
+    queue = client.outbox
+    queue.put('chat 0')
+    queue.put('health 90', 'creature_health_report', 'skeleton')
+    queue.put('chat 1')
+    assert queue.put('health 70', 'creature_health_report', 'skeleton')
+    assert queue.put('health 50', 'creature_health_report', 'skeleton')
+    assert queue.coalesced == 2 and len(queue) == 3
+    # Another emitter's report is a frame of its own
+    assert queue.put('player health 80', 'creature_health_report', 'player')
+    assert len(queue) == 4
+
+    queue.start()
+    settle(loop)
+    assert client.websocket.frames == ['chat 0', 'chat 1', 'health 50', 'player health 80']
+    assert queue.sent == 4
+    # Sent reports no longer coalesce
+    for i in range(3):
+        queue.put('chat {}'.format(i + 2))
+    queue.put('health 40', 'creature_health_report', 'skeleton')
+    assert len(queue) == 4 and queue.coalesced == 2
+    queue.close()
+
+
+class Fight():
+    # A skeleton room whose AI is not running, so every game event comes from the test
+    def __init__(self, loop, batch_interval=0.01, session_grace=0, **kwargs):
+        self.loop = loop
+        self.chat = server.ChatServer(loop=loop, batch_interval=batch_interval, session_grace=session_grace, **kwargs)
+        self.room = self.chat.room_pool.acquire()
+        self.room.name = 'Roset'
+        self.chat.rooms.add(self.room)
+
+    def connect(self, name, room=None):
+        client = server.Client(uid='{:0<8}'.format(name), websocket=RecordingWebSocket(), username=name)
+        self.chat.register_client(client)
+        self.loop.run_until_complete((room or self.room).register_client(client))
+        settle(self.loop)
+        client.websocket.frames.clear()
+        return client
+
+    def wait(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+        settle(self.loop)
+
+    def close(self):
+        for client in list(self.chat.clients_by_username.values()):
+            self.chat.remove_client(client)
+        self.chat.room_pool.close()
+        self.chat.timers.close()
+        settle(self.loop)
+
+
+def test_one_batch_frame_per_tick(loop):
+    fight = Fight(loop)
+    ann = fight.connect('ann')
+    skeleton = fight.room.skeleton
+    fight.room.handle_game_message(skeleton, 'creature_attack_started')
+    fight.room.handle_game_message(skeleton, 'creature_changed_state', 'attacking')
+    fight.room.handle_game_message(ann.player, 'creature_def')
+    settle(loop)
+    assert ann.websocket.frames == []
+    fight.wait(0.03)
+    assert ann.websocket.frames == ['sysbatch|' + '\n'.join([
+        'sysmsg|{}|creature_attack_started|'.format(skeleton.uid),
+        'sysmsg|{}|creature_changed_state|attacking'.format(skeleton.uid),
+        'sysmsg|{}|creature_def|'.format(ann.uid),
+    ])]
+    # A lone event goes out as a plain frame
+    fight.room.handle_game_message(skeleton, 'creature_attack_finished')
+    fight.wait(0.03)
+    assert ann.websocket.frames[1:] == ['sysmsg|{}|creature_attack_finished|'.format(skeleton.uid)]
+    fight.close()
+
+
+def test_superseded_reports_are_coalesced(loop):
+    fight = Fight(loop)
+    ann = fight.connect('ann')
+    skeleton = fight.room.skeleton
+    fight.room.handle_game_message(skeleton, 'creature_health_report', 80)
+    fight.room.handle_game_message(skeleton, 'creature_changed_state', 'idle')
+    fight.room.handle_game_message(ann.player, 'creature_health_report', 95)
+    fight.room.handle_game_message(skeleton, 'creature_took_damage', 20)
+    fight.room.handle_game_message(skeleton, 'creature_health_report', 60)
+    fight.room.handle_game_message(skeleton, 'creature_changed_state', 'attacking')
+    fight.wait(0.03)
+    assert ann.websocket.frames == ['sysbatch|' + '\n'.join([
+        'sysmsg|{}|creature_health_report|95'.format(ann.uid),
+        'sysmsg|{}|creature_took_damage|20'.format(skeleton.uid),
+        'sysmsg|{}|creature_health_report|60'.format(skeleton.uid),
+        'sysmsg|{}|creature_changed_state|attacking'.format(skeleton.uid),
+    ])]
+    fight.close()
+
+
+def test_pending_events_go_out_before_other_messages(loop):
+    fight = Fight(loop)
+    ann = fight.connect('ann')
+    skeleton = fight.room.skeleton
+    fight.room.handle_game_message(skeleton, 'creature_attack_started')
+    fight.room.handle_game_message(skeleton, 'creature_took_damage', 20)
+    fight.room.post_message(server.Message(ann, 'hi'))
+    fight.room.handle_game_message(skeleton, 'creature_death')
+    fight.room.post_system_message(server.SystemMessage(fight.room, 'validation_error', ['nope'], targets=[ann]))
+    fight.wait(0.03)
+    assert ann.websocket.frames == [
+        'sysbatch|sysmsg|{0}|creature_attack_started|\nsysmsg|{0}|creature_took_damage|20'.format(skeleton.uid),
+        'ann: hi',
+        'sysmsg|{}|creature_death|'.format(skeleton.uid),
+        'sysmsg|{}|validation_error|nope'.format(fight.room.uid),
+    ]
+    fight.close()
+
+
+def test_resume_replays_exactly_the_missed_frames(loop):
+    fight = Fight(loop, session_grace=5)
+    ann = fight.connect('ann', fight.chat.room)
+    seen = ann.outbox.seq
+    for text in ['one', 'two', 'three']:
+        fight.chat.broadcast(text, [ann])
+    settle(loop)
+    assert ann.websocket.frames == ['one', 'two', 'three']
+
+    # The connection died after the client got 'one'
+    fight.chat.detach_client(ann)
+    fight.chat.broadcast('four', [ann])
+    settle(loop)
+    assert ann.websocket.frames == ['one', 'two', 'three']
+    assert ann.session_expiry is not None
+
+    websocket = RecordingWebSocket()
+    assert loop.run_until_complete(fight.chat.resume_session(websocket, '::resume {} {}'.format(ann.session_token, seen + 1))) is ann
+    settle(loop)
+    assert websocket.frames == ['sysmsg|{}|resumed|{}'.format(ann.uid, seen + 1), 'two', 'three', 'four']
+    assert ann.session_expiry is None
+    assert fight.chat.get_client(websocket) is ann
+    assert ann.room is fight.chat.room
+    fight.close()
+
+
+def test_resume_failures(loop):
+    fight = Fight(loop, session_grace=5, replay_size=2)
+    ann = fight.connect('ann', fight.chat.room)
+    seen = ann.outbox.seq
+    resume = lambda text: loop.run_until_complete(fight.chat.resume_session(RecordingWebSocket(), text))
+    assert resume('::resume nosuchtoken 0') is None
+    assert resume('::resume {}'.format(ann.session_token)) is None
+    assert 'ann' in fight.chat.clients_by_username
+    # A session that can't be replayed is dropped
+    bob = fight.connect('bob', fight.chat.room)
+    assert resume('::resume {} {}'.format(bob.session_token, bob.outbox.seq + 1)) is None # ahead of what was sent
+    assert bob.session_token not in fight.chat.sessions
+
+    for text in ['one', 'two', 'three']:
+        fight.chat.broadcast(text, [ann])
+    settle(loop)
+    fight.chat.detach_client(ann)
+    # 'one' fell out of the two frame replay buffer
+    assert resume('::resume {} {}'.format(ann.session_token, seen)) is None
+    settle(loop)
+    assert ann.session_token not in fight.chat.sessions
+    assert 'ann' not in fight.chat.clients_by_username
+    assert ann not in fight.chat.room.clients
+    fight.close()
+
+
+def test_detached_clients_are_reaped(loop):
+    fight = Fight(loop, session_grace=0.02)
+    ann = fight.connect('ann')
+    token = ann.session_token
+    fight.chat.detach_client(ann)
+    fight.wait(0.01)
+    assert ann in fight.room.clients
+    fight.wait(0.05)
+    assert token not in fight.chat.sessions
+    assert 'ann' not in fight.chat.clients_by_username
+    assert not fight.room.clients
+    assert fight.room in fight.chat.room_pool.idle
+    assert loop.run_until_complete(fight.chat.resume_session(RecordingWebSocket(), '::resume {} 0'.format(token))) is None
+    fight.close()
+
+
+def test_events_too_big_for_binary_frames_go_out_as_text(loop):
+    fight = Fight(loop, batch_interval=None)
+    ann = fight.connect('ann')
+    ann.binary = True
+    fight.room.handle_game_message(fight.room.skeleton, 'creature_death')
+    notice = server.GameSystemMessage(fight.room, 'ply_notify', ['x' * 70000])
+    fight.room.post_system_message(notice)
+    settle(loop)
+    assert server.WIRE.decode(ann.websocket.frames[0]) == [(fight.room.skeleton.uid, 'creature_death', [])]
+    assert ann.websocket.frames[-1] == notice.encode()
+    fight.close()
+
+
+class PooledRoom():
+    def __init__(self):
+        self.closed = False
+        self.busy = False
+
+    def recycle(self):
+        return not self.busy
+
+    def close(self):
+        self.closed = True
+
+
+def test_room_pool_acquire_refill_and_trim(loop):
+    built = []
+
+    def create():
+        built.append(PooledRoom())
+        return built[-1]
+
+    pool = server.RoomPool(create, size=2, max_size=3, trim_interval=None, loop=loop)
+    pool.start()
+    settle(loop)
+    assert len(pool) == 2 and len(built) == 2
+    rooms = [pool.acquire() for _ in range(3)]
+    assert rooms[:2] == built[1::-1] and rooms[2] is built[2]
+    assert pool.stats()['hit'] == 2 and pool.stats()['miss'] == 1 and pool.target == 3
+    # Missing rooms are built ahead, one per loop iteration
+    settle(loop)
+    assert len(pool) == 3 and pool.stats()['built'] == 5
+
+    pool.release(rooms[0])
+    assert pool.stats()['discarded'] == 1 and rooms[0].closed # over max_size
+    rooms[1].busy = True
+    pool.release(rooms[1])
+    assert pool.stats()['discarded'] == 2 and rooms[1] not in pool.idle
+    taken = pool.idle.pop()
+    pool.release(rooms[2])
+    assert pool.idle[-1] is rooms[2] and pool.stats()['recycled'] == 1 and not rooms[2].closed
+
+    # Nothing was taken since the last trim: the target falls back and the spare rooms go
+    pool.low_water = len(pool)
+    pool.trim_interval = 60
+    pool.trim()
+    assert pool.target == 2 and len(pool) == 2 and pool.stats()['trimmed'] == 1
+    pool.close()
+    assert not pool.idle and pool.trim_handle is None
+    assert all([room.closed for room in built if room is not taken])
+
+
+def test_recycled_rooms_start_clean(loop):
+    fight = Fight(loop, batch_interval=10)
+    chat = fight.chat
+    ann = fight.connect('ann', chat.room)
+    loop.run_until_complete(chat.room.handle_message(ann, '::skeleton Hazel'))
+    room, skeleton, player = ann.room, ann.room.skeleton, ann.player
+    uid, state = room.uid, room.room_state
+    assert room.skeleton_running and skeleton.targets == [player]
+    assert skeleton.on_target_died in player.death_listeners
+
+    loop.run_until_complete(room.handle_message(ann, 'hi'))
+    skeleton.take_damage(30)
+    skeleton.death_listeners.append(lambda creature: None)
+    assert room.pending_events and room.flush_handle and chat.timers.pending
+    assert len(room.history) == 1 and room.room_state.version
+
+    loop.run_until_complete(room.handle_message(ann, '::leave'))
+    settle(loop)
+    assert room in chat.room_pool.idle and room not in chat.rooms
+    assert not room.skeleton_running and not skeleton.active and room.ai_task is None
+    assert chat.timers.pending == 0 and skeleton.action_task is None and skeleton.think_handle is None
+    assert room.pending_events == [] and room.pending_event_index == {} and room.flush_handle is None
+    assert len(room.history) == 0 and room.players == []
+    assert room.uid != uid and room.name == 'Skeleton fight'
+    assert skeleton.death_listeners == [] and skeleton.targets == [] and skeleton.target is None
+    assert skeleton.health == skeleton.max_health and skeleton.state == 'idle'
+    assert skeleton.on_target_died not in player.death_listeners
+    fresh = roomstate.RoomState()
+    fresh.add(skeleton)
+    assert room.room_state is not state and room.room_state.snapshot() == fresh.snapshot()
+
+    # The next fight gets the same room and none of the last one
+    bob = fight.connect('bob', chat.room)
+    loop.run_until_complete(chat.room.handle_message(bob, '::skeleton Bigwig'))
+    assert bob.room is room and room.name == 'Bigwig' and room.skeleton is skeleton
+    assert skeleton.targets == [bob.player] and skeleton.active
+    assert len(room.room_state) == 2
+    assert not [frame for frame in bob.websocket.frames if 'ann: hi' in frame]
+    loop.run_until_complete(room.handle_message(bob, '::leave'))
+    fight.close()
+
+
+def test_skeleton_stops_when_the_room_empties(loop):
+    fight = Fight(loop)
+    chat = fight.chat
+    ann, bob = fight.connect('ann', chat.room), fight.connect('bob', chat.room)
+    loop.run_until_complete(chat.room.handle_message(ann, '::skeleton Hazel'))
+    loop.run_until_complete(chat.room.handle_message(bob, '::skeleton Hazel'))
+    room = ann.room
+    assert bob.room is room
+
+    bob.player.take_damage(1000)
+    loop.run_until_complete(room.handle_message(ann, '::leave'))
+    # The fight is over for everybody alive, but bob has yet to leave
+    assert room not in chat.rooms and room.skeleton_running
+    assert room not in chat.room_pool.idle
+    loop.run_until_complete(room.handle_message(bob, '::leave'))
+    assert not room.skeleton_running and room in chat.room_pool.idle
+    assert chat.timers.pending == 0
+    fight.close()
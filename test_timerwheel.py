@@ -0,0 +1,128 @@
+import heapq
+import random
+import timerwheel
+
+
+class FakeHandle():
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+class FakeLoop():
+    # Just enough of an event loop for the wheel, with a clock that only moves in run_until
+    def __init__(self, now=0.0):
+        self.now = now
+        self.scheduled = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        handle = FakeHandle(when, callback)
+        heapq.heappush(self.scheduled, handle)
+        return handle
+
+    def run_until(self, end, lateness=0):
+        while self.scheduled and self.scheduled[0].when <= end:
+            handle = heapq.heappop(self.scheduled)
+            if handle.cancelled:
+                continue
+            self.now = max(self.now, handle.when + lateness)
+            handle.callback()
+        self.now = max(self.now, end)
+
+
+def test_fires_on_the_first_tick_after_the_deadline():
+    loop = FakeLoop()
+    wheel = timerwheel.TimerWheel(loop, tick=0.05)
+    fired = []
+    wheel.call_later(0.12, lambda: fired.append(loop.time()))
+    loop.run_until(0.1)
+    assert fired == []
+    loop.run_until(1)
+    assert len(fired) == 1
+    assert 0.12 <= fired[0] < 0.12 + 0.05 + 1e-9
+    assert wheel.stats() == {'pending': 0, 'scheduled': 1, 'cancelled': 0, 'expired': 1}
+    assert not loop.scheduled # idle wheels don't tick
+
+
+def test_cancel():
+    loop = FakeLoop()
+    wheel = timerwheel.TimerWheel(loop, tick=1)
+    fired = []
+    first = wheel.call_later(3, fired.append, 'first')
+    wheel.call_later(5, fired.append, 'second')
+    first.cancel()
+    first.cancel()
+    assert first.cancelled()
+    loop.run_until(10)
+    assert fired == ['second']
+    assert wheel.stats() == {'pending': 0, 'scheduled': 2, 'cancelled': 1, 'expired': 1}
+
+
+def test_random_timers_across_levels_and_overflow():
+    # 4 slots and 2 levels span 16 ticks, so most of these timers cascade down or wait in overflow
+    rng = random.Random(1)
+    loop = FakeLoop(now=7.3)
+    wheel = timerwheel.TimerWheel(loop, tick=1, slots=4, levels=2)
+    fired = []
+    expected = []
+    handles = []
+    for i in range(300):
+        delay = rng.choice([rng.uniform(0, 3), rng.uniform(0, 20), rng.uniform(0, 200)])
+        when = loop.time() + delay
+        handles.append((wheel.call_at(when, lambda i=i, when=when: fired.append((i, when, loop.time()))), i))
+    for handle, i in rng.sample(handles, 50):
+        handle.cancel()
+    cancelled = set([i for handle, i in handles if handle.cancelled()])
+    loop.run_until(500)
+    assert sorted([i for i, when, at in fired]) == sorted(set(range(300)) - cancelled)
+    for i, when, at in fired:
+        assert when <= at < when + 1
+    assert [at for i, when, at in fired] == sorted([at for i, when, at in fired])
+    assert wheel.stats()['pending'] == 0
+
+
+def test_late_loop_catches_up_in_order():
+    loop = FakeLoop()
+    wheel = timerwheel.TimerWheel(loop, tick=0.05, slots=8, levels=2)
+    fired = []
+    for delay in [2.0, 0.3, 1.0, 0.07, 5.0]:
+        wheel.call_later(delay, fired.append, delay)
+    loop.run_until(10, lateness=1.5)
+    assert fired == [0.07, 0.3, 1.0, 2.0, 5.0]
+
+
+def test_timers_scheduled_from_callbacks():
+    loop = FakeLoop()
+    wheel = timerwheel.TimerWheel(loop, tick=0.1)
+    fired = []
+
+    def step(n):
+        fired.append((n, round(loop.time(), 6)))
+        if n < 5:
+            wheel.call_later(0.25, step, n + 1)
+
+    wheel.call_later(0.25, step, 0)
+    loop.run_until(5)
+    assert [n for n, at in fired] == [0, 1, 2, 3, 4, 5]
+    for (n, at), (next_n, next_at) in zip(fired, fired[1:]):
+        assert 0.25 <= next_at - at + 1e-9 < 0.35 + 1e-9
+
+
+def test_callback_errors_dont_stop_the_tick():
+    loop = FakeLoop()
+    wheel = timerwheel.TimerWheel(loop, tick=1)
+    fired = []
+    wheel.call_later(1, lambda: 1 / 0)
+    wheel.call_later(1, fired.append, 'still runs')
+    loop.run_until(3)
+    assert fired == ['still runs']
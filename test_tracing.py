@@ -0,0 +1,108 @@
+import asyncio
+import json
+import pytest
+import server
+import tracing
+
+
+class FakeWebSocket():
+    subprotocol = None
+    remote_address = ('127.0.0.1', 50000)
+
+    def __init__(self):
+        self.frames = []
+        self.incoming = asyncio.Queue()
+        self.closed = False
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+    async def recv(self):
+        return await self.incoming.get()
+
+    async def close(self, code=1000, reason=''):
+        self.closed = True
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def settle(loop, rounds=10):
+    for _ in range(rounds):
+        loop.run_until_complete(asyncio.sleep(0))
+
+
+def read_traces(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_interleaved_messages_keep_their_own_spans(loop, tmp_path):
+    tracer = tracing.Tracer(rate=1, path=str(tmp_path / 'traces.jsonl'))
+    later = []
+
+    async def handle(name):
+        trace = tracer.begin(msg=name)
+        with tracing.span('outer'):
+            await asyncio.sleep(0)
+            with tracing.span('inner ' + name):
+                await asyncio.sleep(0)
+        # Outlives the message, like a skeleton AI started by a command
+        loop.call_soon(lambda: later.append(tracing.span('after ' + name)))
+        tracer.end(trace)
+
+    assert tracing.span('untraced') is tracing.NULL_SPAN
+    loop.run_until_complete(asyncio.gather(handle('one'), handle('two')))
+    settle(loop)
+    tracer.close()
+    assert tracer.traced == 2 and tracing.current_trace.get() is None
+    assert later == [tracing.NULL_SPAN, tracing.NULL_SPAN]
+    records = read_traces(tmp_path / 'traces.jsonl')
+    assert [record['msg'] for record in records] == ['one', 'two']
+    for record in records:
+        assert [span[:2] for span in record['spans']] == [['outer', 0], ['inner ' + record['msg'], 1]]
+        outer, inner = record['spans']
+        assert outer[2] <= inner[2] and inner[3] <= outer[3]
+
+    unsampled = tracing.Tracer(rate=0, path=str(tmp_path / 'none.jsonl'))
+    assert unsampled.begin(msg='x') is None
+    assert not (tmp_path / 'none.jsonl').exists()
+
+
+def test_handled_messages_are_traced(loop, tmp_path):
+    path = str(tmp_path / 'traces.jsonl')
+    chat = server.ChatServer(loop=loop, trace_rate=1, trace_path=path, session_grace=0)
+    websocket = FakeWebSocket()
+    handler = loop.create_task(chat.handler(websocket, '/'))
+    for line in ['ann', 'hello', '::skeleton Roset', '::leave']:
+        websocket.incoming.put_nowait(line)
+        settle(loop)
+    assert tracing.current_trace.get() is None
+    assert chat.trace_page({}) == 'Tracing 100.00% of messages into {}, 3 traced so far\n'.format(path)
+    chat.tracer.flush()
+
+    hello, fight, leave = read_traces(path)
+    assert (hello['client'], hello['room'], hello['msg']) == ('ann', 'lobby', 'hello')
+    assert [span[:2] for span in hello['spans']] == [['room.handle_message', 0], ['send_message', 1], ['broadcast', 2], ['get_client', 0]]
+    # The command's spans reach down into the broadcasts it made on the way
+    spans = [span[:2] for span in fight['spans']]
+    assert spans[:2] == [['room.handle_message', 0], ['handle_command', 1]]
+    assert ['send_system_message', 2] in spans and ['broadcast', 3] in spans
+    assert leave['room'] == 'skeleton'
+
+    assert chat.trace_page({'rate': '0'}).startswith('Tracing 0.00%')
+    websocket.incoming.put_nowait('not traced')
+    settle(loop)
+    handler.cancel()
+    chat.remove_client(chat.clients_by_username['ann'])
+    chat.room_pool.close()
+    chat.timers.close()
+    chat.tracer.close()
+    settle(loop)
+    assert len(read_traces(path)) == 3
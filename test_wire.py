@@ -0,0 +1,112 @@
+import random
+import pytest
+import wire
+
+STATES = ['idle', 'attacking', 'defending', 'dead']
+MSG_TYPES = list(wire.SCHEMAS) + ['ply_notify', 'ui_setup_creature', 'room_snapshot', 'validation_error']
+
+
+class Emitter():
+    def __init__(self, uid):
+        self.uid = uid
+
+
+class Message():
+    def __init__(self, msg_types, uid, msg_type, args):
+        self.emitter = Emitter(uid) if uid is not None else None
+        self.type_code = msg_types.index(msg_type)
+        self.args = args
+
+
+def uid(rng):
+    return '{:08x}'.format(rng.getrandbits(32))
+
+
+def round_trip(codec, msg_types, events):
+    frame = codec.encode([Message(msg_types, *event) for event in events])
+    assert isinstance(frame, bytes)
+    return codec.decode(frame)
+
+
+def test_typed_messages_round_trip():
+    codec = wire.Codec(MSG_TYPES, STATES)
+    events = [
+        ('0a1b2c3d', 'creature_took_damage', [20]),
+        ('0a1b2c3d', 'creature_health_report', [-5]),
+        ('ffffffff', 'creature_changed_state', ['defending']),
+        ('00000000', 'ai_new_target', ['deadbeef']),
+        ('12345678', 'creature_death', []),
+        ('12345678', 'client_joined_room', ['9abcdef0', 'ann']),
+        ('12345678', 'joined_room', ['9abcdef0', 'Skeleton fight', 'skeleton']),
+    ]
+    assert round_trip(codec, MSG_TYPES, events) == [tuple(event) for event in events]
+
+
+def test_typed_messages_are_packed():
+    codec = wire.Codec(MSG_TYPES, STATES)
+    frame = codec.encode([Message(MSG_TYPES, '0a1b2c3d', 'creature_took_damage', [20])])
+    assert len(frame) == 2 + 1 + 4 + 2
+
+
+def test_values_outside_the_schema_fall_back_to_generic():
+    codec = wire.Codec(MSG_TYPES, STATES)
+    events = [
+        ('not-a-uid', 'creature_took_damage', [20]),
+        ('ABCDEF01', 'creature_death', []),
+        ('0a1b2c3d', 'creature_took_damage', [40000]),
+        ('0a1b2c3d', 'creature_changed_state', ['sleeping']),
+        ('0a1b2c3d', 'creature_took_damage', [1, 2]),
+        ('0a1b2c3d', 'ply_notify', ['Can\'t attack now!', 'ünïcødé']),
+        ('', 'validation_error', []),
+    ]
+    decoded = round_trip(codec, MSG_TYPES, events)
+    assert decoded == [(event[0], event[1], [str(arg) for arg in event[2]]) for event in events]
+
+
+def test_types_registered_later_are_escaped():
+    msg_types = list(MSG_TYPES)
+    codec = wire.Codec(msg_types, STATES)
+    msg_types.append('brand_new')
+    decoded = round_trip(codec, msg_types, [('0a1b2c3d', 'brand_new', ['x', 3]), ('0a1b2c3d', 'creature_death', [])])
+    assert decoded == [('0a1b2c3d', 'brand_new', ['x', '3']), ('0a1b2c3d', 'creature_death', [])]
+
+
+def test_codes_past_seven_bits_are_escaped():
+    msg_types = ['type_{}'.format(i) for i in range(200)] + list(MSG_TYPES)
+    codec = wire.Codec(msg_types, STATES)
+    decoded = round_trip(codec, msg_types, [('0a1b2c3d', 'creature_took_damage', [7]), ('0a1b2c3d', 'type_150', ['a'])])
+    assert decoded == [('0a1b2c3d', 'creature_took_damage', ['7']), ('0a1b2c3d', 'type_150', ['a'])]
+
+
+def test_random_frames_round_trip():
+    rng = random.Random(1)
+    codec = wire.Codec(MSG_TYPES, STATES)
+    for _ in range(50):
+        events = []
+        for _ in range(rng.randint(0, 30)):
+            msg_type = rng.choice(list(wire.SCHEMAS))
+            args = []
+            for field in wire.SCHEMAS[msg_type]:
+                if field == 'uid':
+                    args.append(uid(rng))
+                elif field == 'int16':
+                    args.append(rng.randint(-32768, 32767))
+                elif field == 'state':
+                    args.append(rng.choice(STATES))
+                else:
+                    args.append(''.join([rng.choice('abc |\n€') for _ in range(rng.randint(0, 10))]))
+            events.append((uid(rng), msg_type, args))
+        assert round_trip(codec, MSG_TYPES, events) == events
+
+
+def test_strings_over_the_length_field_are_rejected():
+    codec = wire.Codec(MSG_TYPES, STATES)
+    fits = 'x' * 0xFFFF
+    assert round_trip(codec, MSG_TYPES, [('0a1b2c3d', 'ply_notify', [fits])]) == [('0a1b2c3d', 'ply_notify', [fits])]
+    for event in [('0a1b2c3d', 'ply_notify', ['x' * 0x10000]), ('0a1b2c3d', 'client_joined_room', ['9abcdef0', '€' * 30000]),
+                  ('0a1b2c3d', 'ply_notify', ['x'] * 256)]:
+        with pytest.raises(ValueError):
+            codec.encode([Message(MSG_TYPES, *event)])
+    with pytest.raises(ValueError):
+        codec.encode([Message(MSG_TYPES, '0a1b2c3d', 'creature_death', [])] * 0x10000)
+
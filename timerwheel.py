@@ -0,0 +1,155 @@
+import asyncio
+import math
+import logs
+
+logger = logs.get('timers')
+
+
+class TimerHandle():
+    def __init__(self, wheel, deadline, callback, args):
+        self.wheel = wheel
+        self.deadline = deadline # in ticks
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+        self._cancelled = False
+
+    def cancel(self):
+        if not self._cancelled:
+            self._cancelled = True
+            self.wheel.remove(self)
+
+    def cancelled(self):
+        return self._cancelled
+
+    def __repr__(self):
+        return 'timer|{}|{}'.format(self.deadline, getattr(self.callback, '__qualname__', self.callback))
+
+
+class TimerWheel():
+    # Hierarchical timing wheel: O(1) insert/cancel, one loop callback per tick for all due timers.
+    # Level l has `slots` buckets of slots**l ticks each, so the wheel spans slots**levels ticks;
+    # anything further away waits in an overflow bucket.
+    def __init__(self, loop=None, tick=0.05, slots=64, levels=4):
+        self.loop = loop or asyncio.get_event_loop()
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.spans = [slots ** level for level in range(levels + 1)]
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.overflow = set()
+        self.start_time = self.loop.time()
+        self.current_tick = 0
+        self.tick_handle = None
+        self.in_tick = False
+
+        self.pending = 0
+        self.scheduled = 0
+        self.cancelled = 0
+        self.expired = 0
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'scheduled': self.scheduled,
+            'cancelled': self.cancelled,
+            'expired': self.expired,
+        }
+
+    def time_to_tick(self, when):
+        return (when - self.start_time) / self.tick
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.loop.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        idle = not self.tick_handle and not self.in_tick
+        if idle:
+            # Nothing is pending, so it is safe to jump to the present
+            self.current_tick = max(self.current_tick, int(self.time_to_tick(self.loop.time())))
+        deadline = max(self.current_tick + 1, int(math.ceil(self.time_to_tick(when))))
+        handle = TimerHandle(self, deadline, callback, args)
+        self.insert(handle)
+        self.pending += 1
+        self.scheduled += 1
+        if idle:
+            self.schedule_tick()
+        return handle
+
+    def insert(self, handle):
+        diff = handle.deadline - self.current_tick
+        for level in range(self.levels):
+            if diff < self.spans[level + 1]:
+                bucket = self.wheels[level][(handle.deadline // self.spans[level]) % self.slots]
+                break
+        else:
+            bucket = self.overflow
+        bucket.add(handle)
+        handle.bucket = bucket
+
+    def remove(self, handle):
+        if handle.bucket is not None:
+            handle.bucket.discard(handle)
+            handle.bucket = None
+            self.pending -= 1
+            self.cancelled += 1
+
+    def schedule_tick(self):
+        when = self.start_time + (self.current_tick + 1) * self.tick
+        self.tick_handle = self.loop.call_at(when, self.on_tick)
+
+    def cascade(self, level):
+        bucket = self.wheels[level][(self.current_tick // self.spans[level]) % self.slots]
+        handles = list(bucket)
+        bucket.clear()
+        for handle in handles:
+            self.insert(handle)
+        if level == self.levels - 1 and self.overflow:
+            handles = list(self.overflow)
+            self.overflow.clear()
+            for handle in handles:
+                self.insert(handle)
+
+    def advance(self):
+        self.current_tick += 1
+        # Higher levels first, so timers cascading down land in buckets processed this same tick
+        for level in range(self.levels - 1, 0, -1):
+            if self.current_tick % self.spans[level] == 0:
+                self.cascade(level)
+
+        bucket = self.wheels[0][self.current_tick % self.slots]
+        if not bucket:
+            return
+        due = list(bucket)
+        bucket.clear()
+        for handle in due:
+            handle.bucket = None
+        self.pending -= len(due)
+        self.expired += len(due)
+        for handle in due:
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                logger.exception('Error in timer callback {}', handle)
+
+    def on_tick(self):
+        self.tick_handle = None
+        # The loop may run us a hair early, or the float tick count may round down just short of the
+        # tick we were scheduled for; either way that tick is due
+        target = max(self.current_tick + 1, int(self.time_to_tick(self.loop.time())))
+        self.in_tick = True
+        try:
+            # Catch up on every tick we missed if the loop was late
+            while self.current_tick < target and self.pending:
+                self.advance()
+        finally:
+            self.in_tick = False
+        if self.pending:
+            self.schedule_tick()
+        else:
+            self.current_tick = max(self.current_tick, target)
+
+    def close(self):
+        if self.tick_handle:
+            self.tick_handle.cancel()
+            self.tick_handle = None
@@ -0,0 +1,120 @@
+import contextvars
+import json
+import logs
+import random
+import time
+
+logger = logs.get('tracing')
+
+# Per-message tracing. A sampled fraction of incoming messages get a Trace; the spans opened while
+# it is handled (span('name') around each pipeline stage) are recorded with their nesting depth.
+# The trace lives in a context variable, so interleaved tasks never mix their spans, and span()
+# outside a trace returns a shared no-op. Tasks and timers started while a message is handled (the
+# skeleton AI, the timer wheel tick) inherit its context and keep running after it; once the
+# trace has ended their spans are no-ops too, instead of piling up on a finished trace. Finished traces are appended to a JSON lines file:
+#   {"t": wall clock start, "client": ..., "msg": ..., "spans": [[name, depth, start us, duration us], ...]}
+
+current_trace = contextvars.ContextVar('trace', default=None)
+
+
+class NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span():
+    __slots__ = ('trace', 'name', 'depth', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.depth = self.trace.depth
+        self.trace.depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        trace = self.trace
+        trace.depth -= 1
+        trace.spans.append((self.name, self.depth, self.start, end))
+        return False
+
+
+def span(name):
+    trace = current_trace.get()
+    if trace is None or trace.ended:
+        return NULL_SPAN
+    return Span(trace, name)
+
+
+class Trace():
+    __slots__ = ('wall', 'start', 'depth', 'spans', 'attrs', 'token', 'ended')
+
+    def __init__(self, attrs):
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        self.depth = 0
+        self.spans = []
+        self.attrs = attrs
+        self.token = None
+        self.ended = False
+
+    def record(self):
+        record = dict(self.attrs)
+        record['t'] = round(self.wall, 6)
+        # Spans close innermost first; list them in the order they opened
+        record['spans'] = [[name, depth, int((start - self.start) * 1e6), int((end - start) * 1e6)]
+            for name, depth, start, end in sorted(self.spans, key=lambda span: span[2])]
+        return record
+
+
+class Tracer():
+    def __init__(self, rate=0, path='traces.jsonl', flush_every=64):
+        self.rate = rate
+        self.path = path
+        self.flush_every = flush_every
+        self.file = None
+        self.unflushed = 0
+        self.traced = 0
+
+    def begin(self, **attrs):
+        # A Trace for this message if it is sampled, else None; pass it to end() when handled
+        if not self.rate or random.random() >= self.rate:
+            return None
+        trace = Trace(attrs)
+        trace.token = current_trace.set(trace)
+        return trace
+
+    def end(self, trace):
+        trace.ended = True
+        current_trace.reset(trace.token)
+        self.traced += 1
+        try:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(json.dumps(trace.record(), separators=(',', ':')) + '\n')
+            self.unflushed += 1
+            if self.unflushed >= self.flush_every:
+                self.flush()
+        except OSError as e:
+            logger.error('Could not write trace to {}: {!r}', self.path, e)
+            self.rate = 0
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+        self.unflushed = 0
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
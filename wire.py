@@ -0,0 +1,202 @@
+import functools
+import struct
+
+# Binary encoding of system messages, used by clients that negotiate the SUBPROTOCOL websocket subprotocol.
+# Chat text and pre-registration prompts are still sent as text frames.
+#
+# frame   := u16 event count, events
+# event   := u8 type code, then
+#            typed:   4 byte emitter uid, fields from the type's schema
+#            generic: (code | GENERIC) str emitter, u8 arg count, str args
+# str     := u16 byte length, utf-8 bytes
+# Codes that don't fit in 7 bits, or were registered after the codec was built, are sent as ESCAPE
+# followed by the type name. A uid is the 8 lowercase hex digits every generated uid has, packed into
+# 4 bytes; events with other uids or out of range values fall back to generic.
+# All integers are little-endian. Codec.encode raises ValueError for frames the format can't carry
+# (a string over 65535 bytes, more than 255 args or 65535 events); those are sent as text frames.
+
+SUBPROTOCOL = 'skeleton.bin.v1'
+
+GENERIC = 0x80
+ESCAPE = 0x7F
+
+HEADER = struct.Struct('<H')
+U8 = struct.Struct('<B')
+U16 = struct.Struct('<H')
+MAX_STR = 0xFFFF
+MAX_ARGS = 0xFF
+MAX_EVENTS = 0xFFFF
+
+FIELD_FORMATS = {
+    'uid': '4s',
+    'int16': 'h',
+    'state': 'B',
+}
+
+# Argument layout of the message types worth packing, anything else goes out generic
+SCHEMAS = {
+    'creature_took_damage': ('int16',),
+    'creature_health_report': ('int16',),
+    'creature_changed_state': ('state',),
+    'ai_new_target': ('uid',),
+    'creature_blocked_damage': (),
+    'creature_death': (),
+    'creature_action_interrupted': (),
+    'creature_attack_started': (),
+    'creature_attack_finished': (),
+    'creature_def': (),
+    'creature_no_def': (),
+    'creature_start': (),
+    'client_joined_room': ('uid', 'str'),
+    'client_left_room': ('uid', 'str'),
+    'joined_room': ('uid', 'str', 'str'),
+}
+
+
+class Layout():
+    # Precompiled struct for one message type: the fixed-width fields up to the first str, then strs
+    def __init__(self, code, fields):
+        self.code = code
+        self.fields = fields
+        fixed = []
+        for field in fields:
+            if field == 'str':
+                break
+            fixed.append(field)
+        self.fixed = fixed
+        self.strs = len(fields) - len(fixed)
+        self.struct = struct.Struct('<B4s' + ''.join([FIELD_FORMATS[field] for field in fixed]))
+        self.pack = self.struct.pack
+        self.simple = fixed == ['int16'] and not self.strs
+        self.body = struct.Struct('<' + ''.join([FIELD_FORMATS[field] for field in fixed]))
+
+
+@functools.lru_cache(maxsize=4096)
+def pack_uid(uid):
+    if len(uid) != 8 or uid != uid.lower():
+        raise ValueError('Not a packable uid: {!r}'.format(uid))
+    return bytes.fromhex(uid)
+
+
+def pack_str(text, parts):
+    data = str(text).encode('utf-8')
+    if len(data) > MAX_STR:
+        raise ValueError('String of {} bytes is too long for a binary frame'.format(len(data)))
+    parts.append(U16.pack(len(data)))
+    parts.append(data)
+
+
+class Codec():
+    def __init__(self, msg_types, states):
+        # msg_types is the server's live table; the client gets a snapshot once at connect time and
+        # types registered after that are escaped
+        self.live_msg_types = msg_types
+        self.msg_types = list(msg_types)
+        self.states = list(states)
+        self.state_codes = {state: code for code, state in enumerate(self.states)}
+        self.layouts = {}
+        for code, msg_type in enumerate(self.msg_types):
+            if code < ESCAPE and msg_type in SCHEMAS:
+                self.layouts[code] = Layout(code, SCHEMAS[msg_type])
+
+    def setup_args(self):
+        # Arguments of the 'protocol' sysmsg telling the client how to decode frames
+        return [SUBPROTOCOL, ','.join(self.msg_types), ','.join(self.states)]
+
+    def encode(self, messages):
+        if len(messages) > MAX_EVENTS:
+            raise ValueError('{} events are too many for a binary frame'.format(len(messages)))
+        parts = [HEADER.pack(len(messages))]
+        for msg in messages:
+            self.encode_message(msg.emitter.uid if msg.emitter else '', msg.type_code, msg.args or (), parts)
+        return b''.join(parts)
+
+    def encode_message(self, uid, code, args, parts):
+        layout = self.layouts.get(code)
+        if layout and len(args) == len(layout.fields):
+            try:
+                if not args:
+                    parts.append(layout.pack(code, pack_uid(uid)))
+                elif layout.simple:
+                    parts.append(layout.pack(code, pack_uid(uid), int(args[0])))
+                else:
+                    self.encode_typed(layout, uid, args, parts)
+                return
+            except (ValueError, KeyError, TypeError, struct.error):
+                pass # uid or value doesn't fit the schema
+        self.encode_generic(uid, code, args, parts)
+
+    def encode_typed(self, layout, uid, args, parts):
+        values = [layout.code, pack_uid(uid)]
+        for field, arg in zip(layout.fixed, args):
+            if field == 'uid':
+                values.append(pack_uid(arg))
+            elif field == 'state':
+                values.append(self.state_codes[arg])
+            else:
+                values.append(int(arg))
+        # Built aside, so a str that doesn't fit leaves nothing behind for the generic fallback
+        typed = [layout.pack(*values)]
+        for arg in args[len(layout.fixed):]:
+            pack_str(arg, typed)
+        parts.extend(typed)
+
+    def encode_generic(self, uid, code, args, parts):
+        if code < len(self.msg_types) and code < ESCAPE:
+            parts.append(U8.pack(code | GENERIC))
+        else:
+            parts.append(U8.pack(ESCAPE | GENERIC))
+            pack_str(self.live_msg_types[code], parts)
+        pack_str(uid, parts)
+        if len(args) > MAX_ARGS:
+            raise ValueError('{} args are too many for a binary frame'.format(len(args)))
+        parts.append(U8.pack(len(args)))
+        for arg in args:
+            pack_str(arg, parts)
+
+    def decode(self, frame):
+        # -> [(emitter uid, msg type, args)]; typed fields come back as ints, state names and uids
+        count, = HEADER.unpack_from(frame, 0)
+        offset = HEADER.size
+        events = []
+        for _ in range(count):
+            code = frame[offset]
+            offset += 1
+            if code & GENERIC:
+                code &= ~GENERIC
+                if code == ESCAPE:
+                    msg_type, offset = unpack_str(frame, offset)
+                else:
+                    msg_type = self.msg_types[code]
+                uid, offset = unpack_str(frame, offset)
+                argc = frame[offset]
+                offset += 1
+                args = []
+                for _ in range(argc):
+                    arg, offset = unpack_str(frame, offset)
+                    args.append(arg)
+                events.append((uid, msg_type, args))
+                continue
+            layout = self.layouts[code]
+            uid = frame[offset:offset + 4].hex()
+            offset += 4
+            values = layout.body.unpack_from(frame, offset)
+            offset += layout.body.size
+            args = []
+            for field, value in zip(layout.fixed, values):
+                if field == 'uid':
+                    value = value.hex()
+                elif field == 'state':
+                    value = self.states[value]
+                args.append(value)
+            for _ in range(layout.strs):
+                arg, offset = unpack_str(frame, offset)
+                args.append(arg)
+            events.append((uid, self.msg_types[code], args))
+        return events
+
+
+def unpack_str(frame, offset):
+    length, = U16.unpack_from(frame, offset)
+    offset += U16.size
+    return frame[offset:offset + length].decode('utf-8'), offset + length